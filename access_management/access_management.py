@@ -4,6 +4,7 @@ import logging
 
 from flask import Blueprint, request, jsonify
 from utils import keycloak_utils
+from access_management import access_ninja
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -11,6 +12,8 @@ logger.setLevel(logging.INFO)
 
 access_management_blueprint = Blueprint('access_management', __name__)
 
+ACCESS_CHECK_MAX_ITEMS = 1000
+
 @access_management_blueprint.route('/login', methods=['POST'])
 def login():
     request_json = request.get_json()
@@ -105,5 +108,32 @@ def logout():
             'action': 'logout',
             'status': 'failed'
         }, 401)
-    
-    
\ No newline at end of file
+
+@access_management_blueprint.route('/access/check', methods=['POST'])
+def check_access():
+    request_json = request.get_json()
+    check_list = request_json["check_list"]
+
+    assert len(check_list) <= ACCESS_CHECK_MAX_ITEMS, f"at most {ACCESS_CHECK_MAX_ITEMS} checks per request"
+
+    effective_access_map = access_ninja.get_effective_access_map([one_check["user_id"] for one_check in check_list])
+    active_brand_profile_id_set = access_ninja.get_active_brand_profile_id_set()
+
+    allowed_p_list = []
+    for one_check in check_list:
+        module_access_id = one_check.get("module_access_id")
+        if module_access_id is None:
+            module_access_id = access_ninja.get_module_access_id(one_check["module_id"], one_check["access_level"])
+
+        allowed_p_list.append(access_ninja.check_access(effective_access_map[int(one_check["user_id"])], one_check["brand_profile_id"],
+                                                            module_access_id, active_brand_profile_id_set))
+
+    response_body = {
+        "data": {
+            "allowed_p_list": allowed_p_list
+        },
+        "action": "check_access",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
@@ -0,0 +1,158 @@
+import json
+
+from flask import g, has_request_context
+from utils import jqutils, jqcache, settings
+from user_management import user_ninja
+
+# Effective access
+#--------------------------------------------
+# user_effective_access holds one row per (user, brand profile) with the
+# sorted list of granted module access ids. brand_profile_id 0 is the all
+# brand profiles row of users with all_brand_profile_access_p. The rows are
+# derived from user_brand_profile_module_access and upserted for the affected
+# users whenever their grants change, so a check is two dict lookups and two
+# set lookups.
+# The cache is shared with the other workers the same way as the user
+# profiles: an invalidation after commit reaches every process, so revoked
+# access is not served from another worker's local copy.
+ALL_BRAND_PROFILES_ID = 0
+EMPTY_MODULE_ACCESS_ID_SET = frozenset()
+
+def build_effective_access_cache(new_settings):
+    return jqcache.TieredCache("effective-access", new_settings.user_profile_cache_size,
+                                new_settings.effective_access_cache_seconds, new_settings.redis_url)
+
+EFFECTIVE_ACCESS_CACHE = build_effective_access_cache(settings.get_settings())
+MODULE_ACCESS_CACHE = jqcache.LRUCache(1, 300)
+
+@settings.register_reload_callback
+def reset_effective_access_cache(new_settings):
+    global EFFECTIVE_ACCESS_CACHE
+    EFFECTIVE_ACCESS_CACHE = build_effective_access_cache(new_settings)
+
+def get_tenant_id():
+    return g.tenant_id if has_request_context() else 1
+
+def encode_bitmask(module_access_id_set):
+    # bit n is set when module_access_id n is granted
+    return format(sum(1 << module_access_id for module_access_id in module_access_id_set), "x")
+
+def decode_effective_access(row_list):
+    # cached as JSON [[brand_profile_id, module_access_id_list], ...]
+    return {brand_profile_id: frozenset(module_access_id_list) for brand_profile_id, module_access_id_list in row_list}
+
+def rebuild_user_effective_access(user_id_list, conn=None):
+    """
+    Recomputes the effective access rows of the given users from their grants.
+    Deleted users end up without rows.
+    """
+    user_id_list = [int(user_id) for user_id in user_id_list]
+    if not user_id_list:
+        return
+
+    if conn is None:
+        with jqutils.get_db_transaction() as conn:
+            return rebuild_user_effective_access(user_id_list, conn)
+
+    query = jqutils.cached_text("""
+        SELECT ubpma.user_id, ubpma.brand_profile_id, ubpma.module_access_id
+        FROM user_brand_profile_module_access ubpma
+        JOIN user u ON ubpma.user_id = u.user_id
+        WHERE ubpma.user_id IN :user_id_list
+        AND (ubpma.brand_profile_id IS NOT NULL OR u.all_brand_profile_access_p)
+        AND ubpma.meta_status = :meta_status
+        AND u.meta_status = :meta_status
+    """)
+    result = conn.execute(query, user_id_list=user_id_list, meta_status="active").fetchall()
+
+    module_access_id_map = {}
+    for row in result:
+        brand_profile_id = row["brand_profile_id"] if row["brand_profile_id"] is not None else ALL_BRAND_PROFILES_ID
+        module_access_id_map.setdefault((row["user_id"], brand_profile_id), set()).add(row["module_access_id"])
+
+    # upserted, so concurrent rebuilds of the same user wait on the row lock instead of hitting the unique key
+    if module_access_id_map:
+        column_list = ["user_id", "brand_profile_id", "module_access_id_list", "meta_status"]
+        query = jqutils.jq_prepare_bulk_insert_statement("user_effective_access", column_list, len(module_access_id_map)).strip().rstrip(";") + """
+            ON DUPLICATE KEY UPDATE module_access_id_list = VALUES(module_access_id_list), meta_status = VALUES(meta_status)
+        """
+        conn.execute(query, [value for (user_id, brand_profile_id), module_access_id_set in module_access_id_map.items()
+                            for value in [user_id, brand_profile_id, json.dumps(sorted(module_access_id_set)), "active"]])
+
+    query = jqutils.cached_text("""
+        SELECT user_effective_access_id, user_id, brand_profile_id
+        FROM user_effective_access
+        WHERE user_id IN :user_id_list
+    """)
+    stale_id_list = [row["user_effective_access_id"] for row in conn.execute(query, user_id_list=user_id_list).fetchall()
+                        if (row["user_id"], row["brand_profile_id"]) not in module_access_id_map]
+    if stale_id_list:
+        query = jqutils.cached_text("""
+            DELETE FROM user_effective_access
+            WHERE user_effective_access_id IN :user_effective_access_id_list
+        """)
+        conn.execute(query, user_effective_access_id_list=stale_id_list)
+
+    tenant_id = get_tenant_id()
+    jqutils.run_after_commit(lambda: [EFFECTIVE_ACCESS_CACHE.invalidate((tenant_id, user_id)) for user_id in user_id_list])
+
+def get_effective_access_map(user_id_list):
+    """
+    Returns {user_id: {brand_profile_id: module_access_id_set}} with one query for the users not cached yet.
+    """
+    tenant_id = get_tenant_id()
+    effective_access_map = {}
+    generation_map = {}
+    for user_id in dict.fromkeys(int(user_id) for user_id in user_id_list):
+        row_list = EFFECTIVE_ACCESS_CACHE.get((tenant_id, user_id))
+        if row_list is None:
+            generation_map[user_id] = EFFECTIVE_ACCESS_CACHE.get_generation((tenant_id, user_id))
+        else:
+            effective_access_map[user_id] = decode_effective_access(row_list)
+
+    if generation_map:
+        query = jqutils.cached_text("""
+            SELECT user_id, brand_profile_id, module_access_id_list
+            FROM user_effective_access
+            WHERE user_id IN :user_id_list
+            AND meta_status = :meta_status
+        """)
+        # the fill reads the primary, a lagging replica could still hold revoked access
+        with jqutils.get_db_connection(read_only=False) as conn:
+            result = conn.execute(query, user_id_list=list(generation_map), meta_status="active").fetchall()
+
+        loaded_map = {user_id: [] for user_id in generation_map}
+        for row in result:
+            loaded_map[row["user_id"]].append([row["brand_profile_id"], json.loads(row["module_access_id_list"])])
+
+        for user_id, row_list in loaded_map.items():
+            EFFECTIVE_ACCESS_CACHE.set_if_generation((tenant_id, user_id), row_list, generation_map[user_id])
+            effective_access_map[user_id] = decode_effective_access(row_list)
+
+    return effective_access_map
+
+def load_module_access_map():
+    query = jqutils.cached_text("""
+        SELECT module_access_id, module_id, access_level
+        FROM module_access
+        WHERE meta_status = :meta_status
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, meta_status="active").fetchall()
+
+    return {(row["module_id"], row["access_level"]): row["module_access_id"] for row in result}
+
+def get_module_access_id(module_id, access_level):
+    module_access_map = MODULE_ACCESS_CACHE.get_or_build("module_access", load_module_access_map)
+    return module_access_map.get((int(module_id), access_level))
+
+def check_access(brand_access_map, brand_profile_id, module_access_id, active_brand_profile_id_set):
+    if module_access_id is None or int(brand_profile_id) not in active_brand_profile_id_set:
+        return False
+
+    module_access_id = int(module_access_id)
+    return (module_access_id in brand_access_map.get(int(brand_profile_id), EMPTY_MODULE_ACCESS_ID_SET)
+            or module_access_id in brand_access_map.get(ALL_BRAND_PROFILES_ID, EMPTY_MODULE_ACCESS_ID_SET))
+
+def get_active_brand_profile_id_set():
+    return {brand_profile["brand_profile_id"] for brand_profile in user_ninja.get_active_brand_profile_list()}
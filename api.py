@@ -3,11 +3,11 @@ import json
 import logging
 
 from flask_mysqldb import MySQL
-from flask import Flask, request, g
+from flask import Flask, request, g, jsonify
 from flask_restful import Api
-from dotenv import load_dotenv
+from keycloak.exceptions import KeycloakError
 
-from utils import json_encoder
+from utils import json_encoder, jqutils, settings, email_outbox, keycloak_cleanup_queue, keycloak_utils, access_token
 
 # ===============================================================================
 # import API Blueprints
@@ -19,11 +19,14 @@ from menu_group_management.menu_group_management import menu_group_management_bl
 from access_management.access_management import access_management_blueprint
 from user_management.user_management import user_management_blueprint
 from user_management.user_image_management import user_image_management_blueprint
+from user_management import user_ninja
 from module_management.module_management import module_management_blueprint
 from role_management.role_management import role_management_blueprint
+from healthcheck_management.healthcheck_management import healthcheck_management_blueprint
 
-# import Environment variables
-load_dotenv(override=True)
+# import Environment variables, loaded once and reloaded on SIGHUP
+app_settings = settings.get_settings()
+settings.install_reload_signal_handler()
 
 # ===============================================================================
 #  Flask App Configuration
@@ -35,10 +38,10 @@ base_api_url = "/api"
 # ===============================================================================
 # Environment-specific configurations can be done here
 # ===============================================================================
-if os.environ.get('ENV') == 'development':
+if app_settings.env == 'development':
     print("Starting application in Development mode...")
     # any config ...
-elif os.environ.get('ENV') == 'production':
+elif app_settings.env == 'production':
     print("Starting application in Production mode...")
     # any config ...
 
@@ -54,12 +57,13 @@ app.register_blueprint(user_management_blueprint, url_prefix=base_api_url)
 app.register_blueprint(user_image_management_blueprint, url_prefix=base_api_url)
 app.register_blueprint(module_management_blueprint, url_prefix=base_api_url)
 app.register_blueprint(role_management_blueprint, url_prefix=base_api_url)
+app.register_blueprint(healthcheck_management_blueprint, url_prefix=base_api_url)
 
 # ===============================================================================
 # Gunicorn settings
 # ===============================================================================
 gunicorn_logger = logging.getLogger('gunicorn.error')  # pylint: disable=invalid-name
-app.debug = os.environ.get('DEBUG')
+app.debug = app_settings.debug
 app.logger.setLevel(logging.DEBUG)
 
 # ===============================================================================
@@ -78,6 +82,35 @@ except Exception:  # pylint: disable=broad-except
 # ===============================================================================
 app.sql = MySQL(app)
 
+# ===============================================================================
+# Authentication
+# ===============================================================================
+# endpoints used before a user has an access token, or with an expired one
+PUBLIC_ENDPOINT_SET = {
+    'access_management.login',
+    'access_management.refresh',
+    'access_management.logout',
+    'user_management.verify_user_otp',
+    'user_management.resend_user_otp',
+    'user_management.initiate_forgot_password_request',
+    'user_management.get_forgot_password_request',
+    'user_management.reset_user_password',
+}
+
+def unauthorized_response(message):
+    return jsonify({
+        'message': message,
+        'status': 'failed',
+        'action': 'authenticate'
+    }), 401
+
+def unavailable_response(message):
+    return jsonify({
+        'message': message,
+        'status': 'failed',
+        'action': 'authenticate'
+    }), 503
+
 # ===============================================================================
 # before_request(): function which runs before every request is routed to blueprint
 # ===============================================================================
@@ -93,8 +126,30 @@ def before_request():
 
 
     if request.path.startswith('/api/') and request.url_rule:
-        g.user_id = 1
-        g.tenant_id = 1
+        # GET endpoints only read, so their queries may be served by a read replica
+        g.db_read_only_p = request.method == 'GET'
+
+        # a bearer token is verified whenever one is sent, requests without one are rejected unless AUTH_ENFORCED=0
+        public_p = request.endpoint in PUBLIC_ENDPOINT_SET or request.blueprint == 'healthcheck_management'
+        authorization = request.headers.get('Authorization', '')
+        if not public_p and authorization.startswith('Bearer '):
+            try:
+                token_user = access_token.authenticate_access_token(authorization[len('Bearer '):].strip())
+            except KeycloakError:
+                return unavailable_response('Unable to verify access token')
+            if token_user is None:
+                return unauthorized_response('Invalid access token')
+            g.user_id = token_user["user_id"]
+            g.tenant_id = token_user["tenant_id"]
+            g.keycloak_user_id = token_user["keycloak_user_id"]
+            return
+
+        if not public_p and settings.get_settings().auth_enforced:
+            return unauthorized_response('Missing access token')
+
+        # anonymous requests act as the system, never as an existing user or tenant
+        g.user_id = keycloak_utils.SYSTEM_USER_ID
+        g.tenant_id = None
         return
 
 # ====================================================================================
@@ -115,8 +170,21 @@ def after_request(response):
             app.logger.debug('RESPONSE Status: %s %s', response.status_code, response.status)
             app.logger.debug('-' * 100)
 
+    # commit the request-scoped unit of work once, or discard it on error responses
+    if response.status_code < 400:
+        jqutils.commit_request_db_transaction()
+    else:
+        jqutils.rollback_request_db_transaction()
+
     return response
 
+# ====================================================================================
+# teardown_request(): function which runs at the end of every request, even on errors
+# ====================================================================================
+@app.teardown_request
+def teardown_request(exception=None):
+    jqutils.close_request_db_connection()
+
 # ===============================================================================
 # Override default error handler
 # ===============================================================================
@@ -139,6 +207,34 @@ class ExtendApi(Api):
 # ===============================================================================
 api = ExtendApi(app, catch_all_404s=True)  # pylint: disable=invalid-name
 
+# ===============================================================================
+# Background tasks
+# ===============================================================================
+# Threads do not survive a fork, so importing the app (tests, scripts, gunicorn
+# --preload) starts nothing. gunicorn.conf.py starts the tasks in every worker
+# after it has loaded the app; BACKGROUND_TASKS_ENABLED=0 turns them off, e.g.
+# for workers that should only serve requests.
+def start_background_tasks():
+    if not settings.get_settings().background_tasks_enabled:
+        return False
+
+    # deliver queued e-mails in the background, EMAIL_OUTBOX_WORKER_COUNT=0 disables it
+    email_outbox.start_email_outbox_dispatcher()
+
+    # expire and archive one time passwords, OTP_SWEEP_INTERVAL_SECONDS=0 disables it
+    user_ninja.start_one_time_password_sweeper()
+
+    # remove deleted users from keycloak in the background, KEYCLOAK_CLEANUP_POLL_SECONDS=0 disables it
+    keycloak_cleanup_queue.start_keycloak_cleanup_worker()
+
+    # log in to keycloak up front and refresh tokens before they expire, KEYCLOAK_TOKEN_REFRESH_INTERVAL_SECONDS=0 disables it
+    keycloak_utils.start_keycloak_token_refresher()
+
+    # keep the permission mirror complete for indexed user removal, KEYCLOAK_PERMISSION_MIRROR_REFRESH_SECONDS=0 disables it
+    keycloak_utils.start_permission_mirror_refresher()
+    return True
+
 if __name__ == '__main__':
+    start_background_tasks()
     port = os.getenv('PORT', 8000)
     app.run(debug=app.debug, port=port, host='0.0.0.0')
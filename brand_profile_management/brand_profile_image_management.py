@@ -1,8 +1,7 @@
 import os
 
-from sqlalchemy import text
 from flask import Blueprint, request, jsonify, g
-from utils import jqutils, jqimage_uploader
+from utils import jqutils, jqimage_uploader, settings
 
 brand_profile_image_management_blueprint = Blueprint('brand_profile_image_management', __name__)
 
@@ -34,24 +33,22 @@ def add_brand_profile_image():
     
     assert file_extension in allowed_filename_extension_list, "invalid file extension"
     
-    image_bucket_name = os.getenv("S3_BUCKET_NAME")
+    image_bucket_name = settings.get_settings().s3_bucket_name
     image_object_key = f"brand-profile-images/{brand_profile_id}/{filename}_{action_timestamp}.{file_extension}"
 
     # Upload image to S3 if not mocking
-    if os.getenv("MOCK_S3_UPLOAD") != '1':    
+    if settings.get_settings().mock_s3_upload != '1':    
         is_uploaded = jqimage_uploader.upload_fileobj(brand_profile_image, image_bucket_name, image_object_key)
         assert is_uploaded, "failed to upload item image to S3"
         brand_profile_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
     else:
         brand_profile_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
 
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
+    query = jqutils.cached_text("""
         INSERT INTO brand_profile_image (brand_profile_id, image_type, image_bucket_name, image_object_key, meta_status, creation_user_id)
         VALUES (:brand_profile_id, :image_type, :image_bucket_name, :image_object_key, :meta_status, :creation_user_id)
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         brand_profile_image_id = conn.execute(query, brand_profile_id=brand_profile_id, image_type=image_type, image_bucket_name=image_bucket_name, image_object_key=image_object_key, meta_status='active', creation_user_id=g.user_id).lastrowid
         assert brand_profile_image_id, "failed to insert brand profile image"
 
@@ -69,16 +66,14 @@ def add_brand_profile_image():
 def get_brand_profile_image(brand_profile_image_id):
     brand_profile_image_id = int(brand_profile_image_id)
     
-    db_engine = jqutils.get_db_engine()
-    
     # get existing brand_profile image
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT brand_profile_image_id, image_bucket_name, image_object_key, image_type
         FROM brand_profile_image
         WHERE brand_profile_image_id = :brand_profile_image_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_image_id=brand_profile_image_id, meta_status='active').fetchone()
         assert result, "failed to get brand_profile_image details"
 
@@ -87,7 +82,7 @@ def get_brand_profile_image(brand_profile_image_id):
     image_bucket_name = result['image_bucket_name']
     image_object_key = result['image_object_key']
 
-    if os.getenv("MOCK_S3_UPLOAD") != '1':
+    if settings.get_settings().mock_s3_upload != '1':
         brand_profile_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
     else:
         brand_profile_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
@@ -114,17 +109,15 @@ def get_brand_profile_images_by_brand_profile(brand_profile_id):
     if image_type:
         image_type_filter_statement = f"AND image_type = '{image_type}'"
     
-    db_engine = jqutils.get_db_engine()
-    
     # get brand_profile_image details
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT brand_profile_image_id, image_bucket_name, image_object_key, image_type
         FROM brand_profile_image
         WHERE brand_profile_id = :brand_profile_id
         {image_type_filter_statement}
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         results = conn.execute(query, brand_profile_id=brand_profile_id, meta_status='active').fetchall()
     
     brand_profile_image_list = []
@@ -134,7 +127,7 @@ def get_brand_profile_images_by_brand_profile(brand_profile_id):
         image_bucket_name = brand_profile_image['image_bucket_name']
         image_object_key = brand_profile_image['image_object_key']
 
-        if os.getenv("MOCK_S3_UPLOAD") != '1':
+        if settings.get_settings().mock_s3_upload != '1':
             brand_profile_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
         else:
             brand_profile_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
@@ -162,16 +155,14 @@ def update_brand_profile_image(brand_profile_image_id):
     image_type = request_dict["image_type"]
     brand_profile_image = request.files['brand_profile_image']
 
-    db_engine = jqutils.get_db_engine()
-    
     # get existing brand_profile image
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT brand_profile_id, image_bucket_name, image_object_key
         FROM brand_profile_image
         WHERE brand_profile_image_id = :brand_profile_image_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_image_id=brand_profile_image_id, meta_status='active').fetchone()
         assert result, "failed to get brand_profile_image details"
 
@@ -188,11 +179,11 @@ def update_brand_profile_image(brand_profile_image_id):
     
     assert file_extension in allowed_filename_extension_list, "invalid file extension"
     
-    image_bucket_name = os.getenv("S3_BUCKET_NAME")
+    image_bucket_name = settings.get_settings().s3_bucket_name
     image_object_key = f"brand-profile-images/{brand_profile_id}/{filename}_{action_timestamp}.{file_extension}"
 
     # Upload image to S3 if not mocking
-    if os.getenv("MOCK_S3_UPLOAD") != '1':
+    if settings.get_settings().mock_s3_upload != '1':
             
         is_uploaded = jqimage_uploader.upload_fileobj(brand_profile_image, image_bucket_name, image_object_key)
         assert is_uploaded, "failed to upload item image to S3"
@@ -204,7 +195,7 @@ def update_brand_profile_image(brand_profile_image_id):
     else:
         brand_profile_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
 
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE brand_profile_image
         SET image_type = :image_type,
         image_bucket_name = :image_bucket_name,
@@ -212,7 +203,7 @@ def update_brand_profile_image(brand_profile_image_id):
         modification_user_id = :modification_user_id
         WHERE brand_profile_image_id = :brand_profile_image_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, image_type=image_type, image_bucket_name=image_bucket_name, image_object_key=image_object_key, modification_user_id=g.user_id, brand_profile_image_id=brand_profile_image_id).rowcount
         assert result, "failed to update brand profile image"
 
@@ -230,15 +221,13 @@ def update_brand_profile_image(brand_profile_image_id):
 def delete_brand_profile_image(brand_profile_image_id):
     brand_profile_image_id = int(brand_profile_image_id)
     
-    db_engine = jqutils.get_db_engine()
-    
     # get existing brand_profile image
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT image_bucket_name, image_object_key, meta_status
         FROM brand_profile_image
         WHERE brand_profile_image_id = :brand_profile_image_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_image_id=brand_profile_image_id, meta_status='active').fetchone()
         assert result, "failed to get brand_profile_image details"
 
@@ -249,17 +238,17 @@ def delete_brand_profile_image(brand_profile_image_id):
 
     if meta_status != "deleted":
         
-        if os.getenv("MOCK_S3_UPLOAD") != '1':
+        if settings.get_settings().mock_s3_upload != '1':
             jqimage_uploader.delete_object_from_bucket(image_bucket_name, image_object_key)
         
-        query = text("""
+        query = jqutils.cached_text("""
             UPDATE brand_profile_image
             SET meta_status = :meta_status,
             deletion_user_id = :deletion_user_id,
             deletion_timestamp = :deletion_timestamp
             WHERE brand_profile_image_id = :brand_profile_image_id
         """)
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             result = conn.execute(query, meta_status='deleted', deletion_user_id=g.user_id, brand_profile_image_id=brand_profile_image_id, deletion_timestamp=action_timestamp).rowcount
             assert result, "failed to update brand profile image"
 
@@ -1,9 +1,9 @@
 from flask import Blueprint, request, jsonify, g
-from sqlalchemy import text
 
-from utils import jqutils
+from utils import jqutils, availability_index
 from brand_profile_management import brand_profile_ninja
 from plan_management import plan_ninja
+from user_management import user_ninja
 
 brand_profile_management_blueprint = Blueprint('brand_profile_management', __name__)
 
@@ -12,7 +12,7 @@ def check_brand_profile_name_availability():
     request_json = request.get_json()
     brand_profile_name = request_json["brand_profile_name"]
 
-    available_p = brand_profile_ninja.check_brand_profile_name_availability(brand_profile_name)
+    available_p = brand_profile_ninja.check_brand_profile_name_availability(brand_profile_name, indexed_p=True)
 
     response_body = {
         "data": {
@@ -57,42 +57,40 @@ def add_brand_profile():
                 "menu_group_id_list": list(set(menu_group_id_list))
             })
 
-    db_engine = jqutils.get_db_engine()
-    
-    with db_engine.connect() as conn:        
-        query = text("""
+    with jqutils.get_db_connection() as conn:        
+        query = jqutils.cached_text("""
             INSERT INTO brand_profile (brand_profile_name, external_brand_profile_id, meta_status, creation_user_id)
             VALUES (:brand_profile_name, :external_brand_profile_id, :meta_status, :creation_user_id)
         """)
         brand_profile_id = conn.execute(query, brand_profile_name=brand_profile_name, creation_user_id=g.user_id,
                             external_brand_profile_id=external_brand_profile_id, meta_status="active").lastrowid
         assert brand_profile_id, "unable to generate brand_profile_id"
+        availability_index.BRAND_PROFILE_NAME_INDEX.add(brand_profile_name)
    
         for one_plan in validated_plan_list:
             plan_name = one_plan["plan_name"]
             external_plan_id = one_plan["external_plan_id"]
             menu_group_id_list = one_plan["menu_group_id_list"]
             
-            query = text("""
+            query = jqutils.cached_text("""
                 INSERT INTO plan (brand_profile_id, plan_name, external_plan_id, meta_status, creation_user_id)
                 VALUES (:brand_profile_id, :plan_name, :external_plan_id, :meta_status, :creation_user_id)
             """)
             plan_id = conn.execute(query, brand_profile_id=brand_profile_id, plan_name=plan_name, external_plan_id=external_plan_id, meta_status="active", creation_user_id=g.user_id).lastrowid
             assert plan_id, f"unable to create plan_id for plan_name: {plan_name}"
+            availability_index.PLAN_NAME_INDEX.add(plan_name, brand_profile_id)
             
-            query_params = ""
-            for menu_group_id in menu_group_id_list:
-                query_params += f"({plan_id}, {menu_group_id}, 'active', {g.user_id}),"
-            
-            if query_params:
-                query_params = query_params[:-1]
-            
-                query = text(f"""
-                    INSERT INTO plan_menu_group_map (plan_id, menu_group_id, meta_status, creation_user_id)
-                    VALUES {query_params}
-                """)
-                results = conn.execute(query).rowcount
-                assert results == len(menu_group_id_list), "unable to create plan_menu_group_map"
+            plan_menu_group_map_list = [{
+                "plan_id": plan_id,
+                "menu_group_id": menu_group_id,
+                "meta_status": "active",
+                "creation_user_id": g.user_id
+            } for menu_group_id in menu_group_id_list]
+            plan_menu_group_map_id_list = jqutils.bulk_insert_db_entries(plan_menu_group_map_list, "plan_menu_group_map", capture_tenant=False, conn=conn)
+            assert len(plan_menu_group_map_id_list) == len(menu_group_id_list), "unable to create plan_menu_group_map"
+
+    # users with all brand profile access see the new brand profile without new grants
+    user_ninja.invalidate_active_brand_profile_list()
 
     response_body = {
         "data": {
@@ -107,16 +105,14 @@ def add_brand_profile():
 def get_brand_profile(brand_profile_id):
     brand_profile_id = int(brand_profile_id)
     
-    db_engine = jqutils.get_db_engine()
-    
     # get brand profile details
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT brand_profile_id, brand_profile_name, external_brand_profile_id
         FROM brand_profile
         WHERE brand_profile_id = :brand_profile_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_id=brand_profile_id, meta_status="active").fetchone()
         assert result, "brand profile does not exist"
 
@@ -133,13 +129,13 @@ def get_brand_profile(brand_profile_id):
     }
     
     # get brand profile image
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT brand_profile_image_id, image_type, image_bucket_name, image_object_key
         FROM brand_profile_image
         WHERE brand_profile_id = :brand_profile_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_id=brand_profile_id, meta_status="active").fetchone()
         
         if result:
@@ -186,11 +182,9 @@ def update_brand_profile(brand_profile_id):
         }
         return jsonify(response_body)
 
-    db_engine = jqutils.get_db_engine()
-    
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         # update brand profile details
-        query = text("""
+        query = jqutils.cached_text("""
             UPDATE brand_profile
             SET external_brand_profile_id = :external_brand_profile_id,
                 brand_profile_name = :brand_profile_name,
@@ -200,9 +194,10 @@ def update_brand_profile(brand_profile_id):
         """)
         result = conn.execute(query, external_brand_profile_id=external_brand_profile_id, brand_profile_name=brand_profile_name, modification_user_id=g.user_id, brand_profile_id=brand_profile_id, meta_status="active").rowcount
         assert result, "unable to update brand profile"
+        availability_index.BRAND_PROFILE_NAME_INDEX.add(brand_profile_name)
 
         # get existing plan_id_list
-        query = text("""
+        query = jqutils.cached_text("""
             SELECT plan_id, plan_name
             FROM plan
             WHERE brand_profile_id = :brand_profile_id
@@ -253,7 +248,7 @@ def update_brand_profile(brand_profile_id):
         plan_id_list_to_be_deleted = list(set(existing_plan_id_list) - set(expected_plan_id_list))
         
         if plan_id_list_to_be_deleted:
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE plan
                 SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
                 WHERE plan_id IN :plan_id_list
@@ -262,6 +257,9 @@ def update_brand_profile(brand_profile_id):
                             plan_id_list=plan_id_list_to_be_deleted).rowcount
             assert result == len(plan_id_list_to_be_deleted), "unable to delete plan_menu_group_map"
 
+    user_ninja.clear_user_profile_cache()
+    user_ninja.invalidate_active_brand_profile_list()
+
     response_body = {
         "data": {
             "brand_profile_id": brand_profile_id
@@ -275,21 +273,19 @@ def update_brand_profile(brand_profile_id):
 def delete_brand_profile(brand_profile_id):
     brand_profile_id = int(brand_profile_id)
     
-    db_engine = jqutils.get_db_engine()
-    
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT meta_status, deletion_user_id, deletion_timestamp
         FROM brand_profile
         WHERE brand_profile_id = :brand_profile_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_id=brand_profile_id).fetchone()
         assert result, "brand profile does not exist"
         
         if result["meta_status"] != "deleted":
             action_timestamp = jqutils.get_utc_datetime()
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE brand_profile
                 SET meta_status = :meta_status,
                 deletion_user_id = :deletion_user_id,
@@ -299,7 +295,7 @@ def delete_brand_profile(brand_profile_id):
             result = conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, brand_profile_id=brand_profile_id).rowcount
             assert result, "unable to delete brand profile"
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE brand_profile_image
                 SET meta_status = :meta_status,
                 deletion_user_id = :deletion_user_id,
@@ -309,7 +305,7 @@ def delete_brand_profile(brand_profile_id):
             """)
             conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, brand_profile_id=brand_profile_id, meta_status_active="active").rowcount
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE plan_menu_group_map
                 SET meta_status = :meta_status,
                 deletion_user_id = :deletion_user_id,
@@ -324,7 +320,7 @@ def delete_brand_profile(brand_profile_id):
             """)
             conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, brand_profile_id=brand_profile_id, meta_status_active="active").rowcount
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE plan
                 SET meta_status = :meta_status,
                 deletion_user_id = :deletion_user_id,
@@ -334,6 +330,9 @@ def delete_brand_profile(brand_profile_id):
             """)
             conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, brand_profile_id=brand_profile_id, meta_status_active="active").rowcount
 
+    user_ninja.clear_user_profile_cache()
+    user_ninja.invalidate_active_brand_profile_list()
+
     response_body = {
         "data": {},
         "action": "delete_brand_profile",
@@ -343,19 +342,34 @@ def delete_brand_profile(brand_profile_id):
 
 @brand_profile_management_blueprint.route('/brand-profiles', methods=['GET'])
 def get_brand_profiles():
-    db_engine = jqutils.get_db_engine()
+    limit, after_id, include_total_p = jqutils.get_page_args(request.args)
 
-    query = text("""
+    # page on brand_profile first so that images do not count towards the limit
+    query = jqutils.cached_text("""
         SELECT bf.brand_profile_id, bf.external_brand_profile_id, bf.brand_profile_name,
         bfi.brand_profile_image_id, bfi.image_type, bfi.image_bucket_name, bfi.image_object_key
-        FROM brand_profile bf
+        FROM (
+            SELECT brand_profile_id, external_brand_profile_id, brand_profile_name
+            FROM brand_profile
+            WHERE meta_status = :meta_status
+            AND brand_profile_id > :after_id
+            ORDER BY brand_profile_id
+            LIMIT :limit
+        ) bf
         LEFT JOIN brand_profile_image bfi ON bf.brand_profile_id = bfi.brand_profile_id
-        WHERE bf.meta_status = :meta_status
+        ORDER BY bf.brand_profile_id
     """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query, meta_status="active").fetchall()
+    with jqutils.get_db_connection() as conn:
+        results = conn.execute(query, meta_status="active", after_id=after_id, limit=limit + 1).fetchall()
         brand_profile_list = [dict(row) for row in results]
 
+    brand_profile_id_list = list(dict.fromkeys(row["brand_profile_id"] for row in brand_profile_list))
+    page_brand_profile_id_list, pagination = jqutils.paginate([{"brand_profile_id": brand_profile_id} for brand_profile_id in brand_profile_id_list],
+                                                        limit, "brand_profile_id", "brand_profile", include_total_p)
+    if len(page_brand_profile_id_list) < len(brand_profile_id_list):
+        extra_brand_profile_id = brand_profile_id_list[-1]
+        brand_profile_list = [row for row in brand_profile_list if row["brand_profile_id"] != extra_brand_profile_id]
+
     for one_brand_profile in brand_profile_list:
         if one_brand_profile["brand_profile_image_id"]:
             brand_profile_image_id = one_brand_profile["brand_profile_image_id"]
@@ -374,6 +388,7 @@ def get_brand_profiles():
 
     response_body = {
         "data": brand_profile_list,
+        "pagination": pagination,
         "action": "get_brand_profiles",
         "status": "successful"
     }
@@ -1,31 +1,30 @@
-from utils import jqutils
-from sqlalchemy import text
+from utils import jqutils, availability_index
+
+def check_brand_profile_name_availability(brand_profile_name, brand_profile_id=None, indexed_p=False):
+    if indexed_p and not brand_profile_id:
+        return availability_index.BRAND_PROFILE_NAME_INDEX.check(brand_profile_name,
+                                                                lambda: check_brand_profile_name_availability(brand_profile_name))
 
-def check_brand_profile_name_availability(brand_profile_name, brand_profile_id=None):
     brand_profile_id_filter = ""
     if brand_profile_id:
         brand_profile_id_filter = "AND brand_profile_id != :brand_profile_id"
     
-    db_engine = jqutils.get_db_engine()
-    
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT brand_profile_id
         FROM brand_profile
         WHERE brand_profile_name = :brand_profile_name
         {brand_profile_id_filter}
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, brand_profile_name=brand_profile_name, brand_profile_id=brand_profile_id, meta_status="active").fetchone()
 
     return False if result else True
 
 def get_brand_profile_plan_list(brand_profile_id, menu_group_info_p=False):    
-    db_engine = jqutils.get_db_engine()
-    
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         # get plans associated with brand_profile
-        query = text("""
+        query = jqutils.cached_text("""
             SELECT plan_id, plan_name, external_plan_id
             FROM plan
             WHERE brand_profile_id = :brand_profile_id
@@ -38,7 +37,7 @@ def get_brand_profile_plan_list(brand_profile_id, menu_group_info_p=False):
             plan_id_list = [one_plan["plan_id"] for one_plan in plan_list]
             
             # get menu groups associated with plans
-            query = text("""
+            query = jqutils.cached_text("""
                 SELECT pmgm.plan_id, mg.menu_group_id, mg.menu_group_name, mg.external_menu_group_id
                 FROM (
                     SELECT plan_id, menu_group_id
@@ -1,6 +1,7 @@
 import os
 from logging import debug
-from utils import jqutils
+from utils import jqutils, settings
+from access_management import access_ninja
 
 class DataMigrationManager:
 
@@ -11,13 +12,19 @@ class DataMigrationManager:
         if schema_name:
             self.schema_name = schema_name
         else:
-            self.schema_name = os.getenv("MYSQL_SCHEMA_NAME")
+            self.schema_name = settings.get_settings().mysql_schema_name
     
     def run(self):
         self.log("\n")
         self.log("-^-" * 50)
         
+        self.add_unique_keycloak_policy_id()
+        self.add_policy_apply_policy_map_index()
+        self.add_one_time_password_hash()
         self.upload_base_data()
+        self.compact_wildcard_brand_access()
+        self.replace_effective_access_bitmask()
+        self.rebuild_effective_access()
         
         self.log("\nCompleted!", False)
         
@@ -28,19 +35,225 @@ class DataMigrationManager:
     def upload_base_data(self):
         self.log("\nUploading base data:")
         
-        self.log("> Uploading brand_profile.. ", False)
-        jqutils.upload_csv("brand_profile", self.top_path + "brand_profile.csv")
-        self.log("Done\n> Uploading plan.. ", False)
-        jqutils.upload_csv("plan", self.top_path + "plan.csv")
-        self.log("Done\n> Uploading menu_group.. ", False)
-        jqutils.upload_csv("menu_group", self.top_path + "menu_group.csv")
-        self.log("Done\n> Uploading plan_menu_group_map.. ", False)
-        jqutils.upload_csv("plan_menu_group_map", self.top_path + "plan_menu_group_map.csv")
-        
-        self.log("Done\n> Uploading email_template.. ", False)
-        jqutils.upload_csv("email_template", self.top_path + "email_template.csv")
-        
-        self.log("Done\n")
+        for table_name in ["brand_profile", "plan", "menu_group", "plan_menu_group_map", "email_template"]:
+            self.log(f"> Uploading {table_name}.. ", False)
+            stats = jqutils.upload_csv(table_name, self.top_path + f"{table_name}.csv", progress_callback=self.log_progress)
+            self.log(f"Done, {stats['row_count']} rows in {stats['seconds']}s ({stats['rows_per_second']} rows/s, {stats['method']})")
+
+    def add_unique_keycloak_policy_id(self):
+        """
+        policy.keycloak_policy_id is unique so the permission mirror can upsert
+        policies. Databases created before that may hold duplicates: the
+        mapping rows are moved to the oldest active duplicate, the others are
+        soft-deleted without their Keycloak id, and the kept rows are resynced.
+        The mirror's keycloak_synced_timestamp column is added first.
+        """
+        self.log("\nAdding unique policy.keycloak_policy_id.. ", False)
+        query = jqutils.cached_text("""
+            SELECT COUNT(*) AS column_count
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE()
+            AND table_name = :table_name
+            AND column_name = :column_name
+        """)
+        with jqutils.get_db_connection() as conn:
+            if not conn.execute(query, table_name="policy", column_name="keycloak_synced_timestamp").fetchone()["column_count"]:
+                conn.execute(jqutils.cached_text("ALTER TABLE policy ADD COLUMN keycloak_synced_timestamp DATETIME(6)"))
+
+        query = jqutils.cached_text("""
+            SELECT COUNT(*) AS index_count
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+            AND table_name = :table_name
+            AND index_name = :index_name
+        """)
+        with jqutils.get_db_transaction() as conn:
+            if conn.execute(query, table_name="policy", index_name="uq_policy_keycloak_policy_id").fetchone()["index_count"]:
+                self.log("Done, already unique")
+                return
+
+            conn.execute(jqutils.cached_text("""
+                CREATE TEMPORARY TABLE policy_duplicate AS
+                SELECT p.policy_id, kept.kept_policy_id
+                FROM policy p
+                JOIN (
+                    SELECT keycloak_policy_id, COALESCE(MIN(CASE WHEN meta_status = :meta_status THEN policy_id END), MIN(policy_id)) AS kept_policy_id
+                    FROM policy
+                    WHERE keycloak_policy_id IS NOT NULL
+                    GROUP BY keycloak_policy_id
+                    HAVING COUNT(*) > 1
+                ) kept ON p.keycloak_policy_id = kept.keycloak_policy_id
+            """), meta_status="active")
+            for table_name, column_name in [("policy_user_map", "policy_id"), ("policy_resource_map", "policy_id"),
+                                            ("policy_apply_policy_map", "policy_id"), ("policy_apply_policy_map", "apply_policy_map_id")]:
+                conn.execute(jqutils.cached_text(f"""
+                    UPDATE {table_name} m
+                    JOIN policy_duplicate d ON m.{column_name} = d.policy_id
+                    SET m.{column_name} = d.kept_policy_id
+                    WHERE d.policy_id <> d.kept_policy_id
+                """))
+            row_count = conn.execute(jqutils.cached_text("""
+                UPDATE policy p
+                JOIN policy_duplicate d ON p.policy_id = d.policy_id
+                SET p.keycloak_policy_id = IF(p.policy_id = d.kept_policy_id, p.keycloak_policy_id, NULL),
+                p.meta_status = IF(p.policy_id = d.kept_policy_id, p.meta_status, :meta_status_deleted),
+                p.deletion_timestamp = IF(p.policy_id = d.kept_policy_id, p.deletion_timestamp, :deletion_timestamp),
+                p.keycloak_synced_timestamp = NULL
+            """), meta_status_deleted="deleted", deletion_timestamp=jqutils.get_utc_datetime()).rowcount
+            conn.execute(jqutils.cached_text("DROP TEMPORARY TABLE policy_duplicate"))
+            conn.execute(jqutils.cached_text("ALTER TABLE policy ADD UNIQUE INDEX uq_policy_keycloak_policy_id (keycloak_policy_id)"))
+        self.log(f"Done, {row_count} duplicate rows merged")
+
+    def add_policy_apply_policy_map_index(self):
+        """
+        Removing an indexed user looks up the permissions applying their
+        policy by apply_policy_map_id, which older databases do not index.
+        """
+        self.log("\nIndexing policy_apply_policy_map.apply_policy_map_id.. ", False)
+        query = jqutils.cached_text("""
+            SELECT COUNT(*) AS index_count
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+            AND table_name = :table_name
+            AND index_name = :index_name
+        """)
+        with jqutils.get_db_connection() as conn:
+            if conn.execute(query, table_name="policy_apply_policy_map", index_name="ix_policy_apply_policy_map_apply_policy_map_id").fetchone()["index_count"]:
+                self.log("Done, already indexed")
+                return
+
+            conn.execute(jqutils.cached_text("""
+                ALTER TABLE policy_apply_policy_map
+                ADD INDEX ix_policy_apply_policy_map_apply_policy_map_id (apply_policy_map_id)
+            """))
+        self.log("Done")
+
+    def add_one_time_password_hash(self):
+        """
+        one_time_password used to keep the token itself in otp, it now keeps
+        only its sha256 in otp_hash under a unique index. Tokens that can
+        still be verified are hashed in place, a token shared by two live rows
+        stays with the newest one, and every plaintext token is cleared.
+        """
+        self.log("\nAdding one_time_password.otp_hash.. ", False)
+        query = jqutils.cached_text("""
+            SELECT COUNT(*) AS index_count
+            FROM information_schema.statistics
+            WHERE table_schema = DATABASE()
+            AND table_name = :table_name
+            AND index_name = :index_name
+        """)
+        with jqutils.get_db_transaction() as conn:
+            if conn.execute(query, table_name="one_time_password", index_name="otp_hash").fetchone()["index_count"]:
+                self.log("Done, already hashed")
+                return
+
+            query = jqutils.cached_text("""
+                SELECT COUNT(*) AS column_count
+                FROM information_schema.columns
+                WHERE table_schema = DATABASE()
+                AND table_name = :table_name
+                AND column_name = :column_name
+            """)
+            if not conn.execute(query, table_name="one_time_password", column_name="otp_hash").fetchone()["column_count"]:
+                conn.execute(jqutils.cached_text("ALTER TABLE one_time_password ADD COLUMN otp_hash VARCHAR(64) AFTER otp"))
+
+            row_count = conn.execute(jqutils.cached_text("""
+                UPDATE one_time_password
+                SET otp_hash = SHA2(otp, 256)
+                WHERE otp IS NOT NULL
+                AND otp_hash IS NULL
+                AND otp_status IN :otp_status_list
+                AND otp_expiry_timestamp > :current_timestamp
+            """), otp_status_list=["pending", "sent"], current_timestamp=jqutils.get_utc_datetime()).rowcount
+            conn.execute(jqutils.cached_text("""
+                UPDATE one_time_password otp
+                JOIN (
+                    SELECT otp_hash, MAX(one_time_password_id) AS kept_one_time_password_id
+                    FROM one_time_password
+                    WHERE otp_hash IS NOT NULL
+                    GROUP BY otp_hash
+                    HAVING COUNT(*) > 1
+                ) kept ON otp.otp_hash = kept.otp_hash
+                SET otp.otp_hash = NULL,
+                otp.otp_status = :otp_status_expired
+                WHERE otp.one_time_password_id <> kept.kept_one_time_password_id
+            """), otp_status_expired="expired")
+            conn.execute(jqutils.cached_text("""
+                UPDATE one_time_password
+                SET otp = NULL
+                WHERE otp IS NOT NULL
+            """))
+            conn.execute(jqutils.cached_text("ALTER TABLE one_time_password ADD UNIQUE INDEX otp_hash (otp_hash)"))
+        self.log(f"Done, {row_count} live tokens hashed")
+
+    def compact_wildcard_brand_access(self):
+        """
+        Users with all brand profile access used to get one access row per brand
+        profile on top of their brand_profile_id NULL rows. Those copies are now
+        resolved at read time, so the redundant rows are soft-deleted.
+        """
+        self.log("\nCompacting all brand profile access.. ", False)
+        query = jqutils.cached_text("""
+            UPDATE user_brand_profile_module_access ubpma
+            JOIN user u ON ubpma.user_id = u.user_id
+            JOIN user_brand_profile_module_access wildcard ON wildcard.user_id = ubpma.user_id
+                AND wildcard.module_access_id = ubpma.module_access_id
+                AND wildcard.brand_profile_id IS NULL
+                AND wildcard.meta_status = :meta_status
+            SET ubpma.meta_status = :meta_status_deleted,
+            ubpma.deletion_timestamp = :deletion_timestamp
+            WHERE u.all_brand_profile_access_p
+            AND ubpma.brand_profile_id IS NOT NULL
+            AND ubpma.meta_status = :meta_status
+        """)
+        with jqutils.get_db_connection() as conn:
+            row_count = conn.execute(query, meta_status="active", meta_status_deleted="deleted", deletion_timestamp=jqutils.get_utc_datetime()).rowcount
+        self.log(f"Done, {row_count} rows")
+
+    def replace_effective_access_bitmask(self):
+        """
+        user_effective_access used to keep a hex bitmask indexed by
+        module_access_id, which a String(512) column caps at id 2047. It now
+        keeps the id list, filled by the rebuild that follows.
+        """
+        self.log("\nReplacing effective access bitmask.. ", False)
+        query = jqutils.cached_text("""
+            SELECT COUNT(*) AS column_count
+            FROM information_schema.columns
+            WHERE table_schema = DATABASE()
+            AND table_name = :table_name
+            AND column_name = :column_name
+        """)
+        with jqutils.get_db_connection() as conn:
+            if not conn.execute(query, table_name="user_effective_access", column_name="module_access_bitmask").fetchone()["column_count"]:
+                self.log("Done, already replaced")
+                return
+
+            conn.execute(jqutils.cached_text("""
+                ALTER TABLE user_effective_access
+                ADD COLUMN module_access_id_list JSON,
+                DROP COLUMN module_access_bitmask
+            """))
+        self.log("Done")
+
+    def rebuild_effective_access(self, chunk_size=1000):
+        self.log("\nRebuilding effective access.. ", False)
+        query = jqutils.cached_text("""
+            SELECT user_id
+            FROM user
+            WHERE meta_status = :meta_status
+            ORDER BY user_id
+        """)
+        with jqutils.get_db_connection() as conn:
+            user_id_list = [row["user_id"] for row in conn.execute(query, meta_status="active").fetchall()]
+
+        for chunk_start in range(0, len(user_id_list), chunk_size):
+            access_ninja.rebuild_user_effective_access(user_id_list[chunk_start:chunk_start + chunk_size])
+        self.log(f"Done, {len(user_id_list)} users")
+
+    def log_progress(self, stats):
+        self.log(f"{stats['row_count']}.. ", False)
 
     def log(self, message, new_line=True):
         if debug:
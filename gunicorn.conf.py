@@ -0,0 +1,12 @@
+# gunicorn settings, picked up with -c gunicorn.conf.py
+from utils.settings import get_settings
+
+# the DB pools are sized from the same values, see db_pool_manager
+workers = get_settings().web_concurrency
+threads = get_settings().gunicorn_threads
+
+def post_worker_init(worker):
+    # runs in every worker after the app is loaded, also with --preload where
+    # threads started before the fork would be lost
+    import api
+    api.start_background_tasks()
@@ -0,0 +1,119 @@
+import logging
+
+from flask import Blueprint, jsonify
+from utils import jqutils, db_pool_manager, email_outbox, background_worker, availability_index, keycloak_cleanup_queue, keycloak_executor, keycloak_utils, access_token
+from user_management import user_ninja
+
+logger = logging.getLogger(__name__)
+logging.basicConfig(format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+logger.setLevel(logging.INFO)
+
+healthcheck_management_blueprint = Blueprint('healthcheck_management', __name__)
+
+@healthcheck_management_blueprint.route('/healthcheck', methods=['GET'])
+def get_healthcheck():
+    response_body = {
+        "data": {},
+        "action": "get_healthcheck",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/statement-cache', methods=['GET'])
+def get_statement_cache_stats():
+    response_body = {
+        "data": jqutils.get_statement_cache_stats(),
+        "action": "get_statement_cache_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/db-pool', methods=['GET'])
+def get_db_pool_stats():
+    response_body = {
+        "data": db_pool_manager.get_pool_stats(),
+        "action": "get_db_pool_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/db-replicas', methods=['GET'])
+def get_db_replica_stats():
+    response_body = {
+        "data": jqutils.get_db_replica_stats(),
+        "action": "get_db_replica_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/unique-codes', methods=['GET'])
+def get_unique_code_stats():
+    response_body = {
+        "data": jqutils.get_unique_code_stats(),
+        "action": "get_unique_code_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/user-profile-cache', methods=['GET'])
+def get_user_profile_cache_stats():
+    response_body = {
+        "data": user_ninja.get_user_profile_cache_stats(),
+        "action": "get_user_profile_cache_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/email-outbox', methods=['GET'])
+def get_email_outbox_stats():
+    response_body = {
+        "data": email_outbox.get_email_outbox_stats(),
+        "action": "get_email_outbox_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/background-tasks', methods=['GET'])
+def get_background_task_stats():
+    response_body = {
+        "data": background_worker.get_periodic_task_stats(),
+        "action": "get_background_task_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/availability-index', methods=['GET'])
+def get_availability_index_stats():
+    response_body = {
+        "data": availability_index.get_availability_index_stats(),
+        "action": "get_availability_index_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/keycloak-cleanup', methods=['GET'])
+def get_keycloak_cleanup_stats():
+    response_body = {
+        "data": keycloak_cleanup_queue.get_keycloak_cleanup_stats(),
+        "action": "get_keycloak_cleanup_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/keycloak-admin', methods=['GET'])
+def get_keycloak_admin_stats():
+    response_body = {
+        "data": dict(keycloak_executor.get_keycloak_admin_stats(), client_stats=keycloak_utils.get_keycloak_client_stats()),
+        "action": "get_keycloak_admin_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@healthcheck_management_blueprint.route('/healthcheck/access-token', methods=['GET'])
+def get_access_token_stats():
+    response_body = {
+        "data": access_token.get_access_token_stats(),
+        "action": "get_access_token_stats",
+        "status": "successful"
+    }
+    return jsonify(response_body)
@@ -1,5 +1,4 @@
-from utils import jqutils
-from sqlalchemy import text
+from utils import jqutils, availability_index
 from flask import Blueprint, request, jsonify, g
 from menu_group_management import menu_group_ninja
 
@@ -11,7 +10,7 @@ def check_menu_group_name_availability():
 
     menu_group_name = request_data["menu_group_name"]
 
-    available_p = menu_group_ninja.check_menu_group_name_availability(menu_group_name)
+    available_p = menu_group_ninja.check_menu_group_name_availability(menu_group_name, indexed_p=True)
 
     response_body = {
         "data": {
@@ -41,15 +40,14 @@ def add_menu_group():
         }
         return jsonify(response_body)
 
-    db_engine = jqutils.get_db_engine()
-    
-    query = text("""
+    query = jqutils.cached_text("""
         INSERT INTO menu_group (menu_group_name, external_menu_group_id, meta_status, creation_user_id)
         VALUES (:menu_group_name, :external_menu_group_id, :meta_status, :creation_user_id)
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         menu_group_id = conn.execute(query, menu_group_name=menu_group_name, external_menu_group_id=external_menu_group_id, meta_status="active", creation_user_id=g.user_id).lastrowid
         assert menu_group_id, "unable to create menu_group"
+        availability_index.MENU_GROUP_NAME_INDEX.add(menu_group_name)
    
     response_body = {
         "data": {
@@ -66,7 +64,7 @@ def bulk_add_menu_groups():
     menu_group_list = request_json["menu_group_list"]
     assert len(menu_group_list) > 0, "menu_group_list should not be empty"
 
-    query_params = ""
+    validated_menu_group_list = []
     already_processed_menu_group_name_list = []
     for one_menu_group in menu_group_list:
         menu_group_name = one_menu_group["menu_group_name"]
@@ -93,23 +91,23 @@ def bulk_add_menu_groups():
             }
             return jsonify(response_body)
 
-        query_params += f"('{menu_group_name}', '{external_menu_group_id}', 'active', {g.user_id}),"
+        validated_menu_group_list.append({
+            "menu_group_name": menu_group_name,
+            "external_menu_group_id": external_menu_group_id,
+            "meta_status": "active",
+            "creation_user_id": g.user_id
+        })
         already_processed_menu_group_name_list.append(menu_group_name)
 
-    query_params = query_params[:-1]
-
-    db_engine = jqutils.get_db_engine()
-    
-    query = text(f"""
-        INSERT INTO menu_group (menu_group_name, external_menu_group_id, meta_status, creation_user_id)
-        VALUES {query_params}
-    """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query).rowcount
-        assert results == len(menu_group_list), "unable to create all menu_groups"
+    menu_group_id_list = jqutils.bulk_insert_db_entries(validated_menu_group_list, "menu_group", capture_tenant=False)
+    assert len(menu_group_id_list) == len(menu_group_list), "unable to create all menu_groups"
+    for one_menu_group in validated_menu_group_list:
+        availability_index.MENU_GROUP_NAME_INDEX.add(one_menu_group["menu_group_name"])
    
     response_body = {
-        "data": {},
+        "data": {
+            "menu_group_id_list": menu_group_id_list
+        },
         "action": "bulk_add_menu_groups",
         "status": "successful"
     }
@@ -119,15 +117,13 @@ def bulk_add_menu_groups():
 def get_menu_group(menu_group_id):
     menu_group_id = int(menu_group_id)
     
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT mg.menu_group_id, mg.menu_group_name, mg.external_menu_group_id
         FROM menu_group mg
         WHERE mg.menu_group_id = :menu_group_id
         AND mg.meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, menu_group_id=menu_group_id, meta_status="active").fetchone()
         assert result, f"menu_group with id {menu_group_id} not found"
 
@@ -140,21 +136,26 @@ def get_menu_group(menu_group_id):
 
 @menu_group_management_blueprint.route('/menu-groups', methods=['GET'])
 def get_menu_groups():
-    db_engine = jqutils.get_db_engine()
+    limit, after_id, include_total_p = jqutils.get_page_args(request.args)
 
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT mg.menu_group_id, mg.menu_group_name, mg.external_menu_group_id
         FROM menu_group mg
         WHERE mg.meta_status = :meta_status
+        AND mg.menu_group_id > :after_id
+        ORDER BY mg.menu_group_id
+        LIMIT :limit
     """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query, meta_status="active").fetchall()
-        menu_group_list = [dict(row) for row in results]
+    with jqutils.get_db_connection() as conn:
+        results = conn.execute(query, meta_status="active", after_id=after_id, limit=limit + 1).fetchall()
+
+    menu_group_list, pagination = jqutils.paginate([dict(row) for row in results], limit, "menu_group_id", "menu_group", include_total_p)
 
     response_body = {
         "data": {
             "menu_group_list": menu_group_list
         },
+        "pagination": pagination,
         "action": "get_menu_groups",
         "status": "successful"
     }
@@ -181,15 +182,16 @@ def update_menu_group(menu_group_id):
         }
         return jsonify(response_body)
 
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE menu_group
         SET menu_group_name = :menu_group_name, external_menu_group_id = :external_menu_group_id, modification_user_id = :modification_user_id
         WHERE menu_group_id = :menu_group_id
     """)
-    with jqutils.get_db_engine().connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, menu_group_name=menu_group_name, external_menu_group_id=external_menu_group_id,
                     modification_user_id=g.user_id, menu_group_id=menu_group_id).rowcount
         assert result, f"menu_group with id {menu_group_id} not found"
+        availability_index.MENU_GROUP_NAME_INDEX.add(menu_group_name)
    
     response_body = {
         "data": {
@@ -204,10 +206,8 @@ def update_menu_group(menu_group_id):
 def delete_menu_group(menu_group_id):
     menu_group_id = int(menu_group_id)
     
-    db_engine = jqutils.get_db_engine()
-
-    with db_engine.connect() as conn:
-        query = text("""
+    with jqutils.get_db_connection() as conn:
+        query = jqutils.cached_text("""
             SELECT meta_status
             FROM menu_group
             WHERE menu_group_id = :menu_group_id
@@ -219,7 +219,7 @@ def delete_menu_group(menu_group_id):
         if existing_meta_status != "deleted":
             action_timestamp = jqutils.get_utc_datetime()
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE menu_group
                 SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
                 WHERE menu_group_id = :menu_group_id
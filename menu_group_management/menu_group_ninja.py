@@ -1,21 +1,22 @@
-from utils import jqutils
-from sqlalchemy import text
+from utils import jqutils, availability_index
+
+def check_menu_group_name_availability(menu_group_name, menu_group_id=None, indexed_p=False):
+    if indexed_p and not menu_group_id:
+        return int(availability_index.MENU_GROUP_NAME_INDEX.check(menu_group_name,
+                                                                  lambda: check_menu_group_name_availability(menu_group_name)))
 
-def check_menu_group_name_availability(menu_group_name, menu_group_id=None):
     menu_group_id_filter = ""
     if menu_group_id:
         menu_group_id_filter = "AND menu_group_id != :menu_group_id"
 
-    db_engine = jqutils.get_db_engine()
-    
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT menu_group_id
         FROM menu_group
         WHERE menu_group_name = :menu_group_name
         {menu_group_id_filter}
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, menu_group_name=menu_group_name, menu_group_id=menu_group_id, meta_status="active").fetchone()
 
     return 0 if result else 1
\ No newline at end of file
@@ -44,3 +44,22 @@ class Model(Base):
     insertion_timestamp = MetaDataColumn(DATETIME(fsp=6), nullable=False, server_default=text("CURRENT_TIMESTAMP(6)"))
     modification_timestamp = MetaDataColumn(DATETIME(fsp=6), nullable=False)
 
+# ----------------------------------------------------------------------------------------------------------------------
+
+class ArchiveOneTimePassword(Model):
+    __tablename__ = 'archive_one_time_password'
+
+    one_time_password_id = Column(Integer, primary_key=True, autoincrement=False)
+    user_id = Column(Integer)
+
+    intent = Column(String(32))
+    contact_method = Column(String(32))
+
+    otp_hash = Column(String(64))
+    otp_request_count = Column(Integer)
+
+    otp_requested_timestamp = Column(DATETIME(fsp=6))
+    otp_expiry_timestamp = Column(DATETIME(fsp=6))
+    otp_verified_timestamp = Column(DATETIME(fsp=6))
+
+    otp_status = Column(String(32))
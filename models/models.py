@@ -3,7 +3,7 @@ import json
 from email.policy import default
 from enum import unique
 from sqlalchemy import Column, DateTime, Integer, JSON, Numeric, SmallInteger, String, Boolean, Date, Time
-from sqlalchemy.schema import FetchedValue, UniqueConstraint, ForeignKeyConstraint, ForeignKey
+from sqlalchemy.schema import FetchedValue, UniqueConstraint, ForeignKeyConstraint, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.mysql import DATETIME
 from sqlalchemy import text
@@ -55,6 +55,9 @@ class Scope(Model):
 
 class Resource(Model):
     __tablename__ = 'resource'
+    __table_args__ = (
+        Index('ix_resource_keycloak_resource_id', 'keycloak_resource_id'),
+    )
     resource_id = Column(Integer, primary_key=True)
     
     keycloak_resource_id = Column(String(256))
@@ -74,6 +77,9 @@ class ResourceScopeMap(Model):
 
 class Policy(Model):
     __tablename__ = 'policy'
+    __table_args__ = (
+        UniqueConstraint('keycloak_policy_id', name='uq_policy_keycloak_policy_id'),
+    )
     
     policy_id = Column(Integer, primary_key=True)
     keycloak_policy_id = Column(String(256))
@@ -83,6 +89,7 @@ class Policy(Model):
     logic = Column(String(32)) # POSITIVE, NEGATIVE
     decision_strategy = Column(String(32)) # AFFIRMATIVE, UNANIMOUS, CONSENSUS
     policy_config = Column(JSON)
+    keycloak_synced_timestamp = Column(DATETIME(fsp=6)) # resources and applied policies last read from or written to keycloak
 
 class PolicyUserMap(Model):
     __tablename__ = 'policy_user_map'
@@ -94,6 +101,9 @@ class PolicyUserMap(Model):
 
 class PolicyResourceMap(Model):
     __tablename__ = 'policy_resource_map'
+    __table_args__ = (
+        Index('ix_policy_resource_map_policy_id', 'policy_id'),
+    )
     
     policy_resource_map_id = Column(Integer, primary_key=True)
     policy_id = Column(Integer) # all:*:menu-management:admin
@@ -101,10 +111,25 @@ class PolicyResourceMap(Model):
 
 class PolicyApplyPolicyMap(Model):
     __tablename__ = 'policy_apply_policy_map'
+    __table_args__ = (
+        Index('ix_policy_apply_policy_map_policy_id', 'policy_id'),
+        Index('ix_policy_apply_policy_map_apply_policy_map_id', 'apply_policy_map_id'),
+    )
     
     policy_apply_policy_map = Column(Integer, primary_key=True)
     policy_id = Column(Integer) # all:*:menu-management:admin
-    apply_policy_map_id = Column(Integer) # cody
+    apply_policy_map_id = Column(Integer) # policy_id of the applied policy, e.g. cody's user policy
+
+class PermissionMirrorBuild(Model):
+    __tablename__ = 'permission_mirror_build'
+    __table_args__ = (
+        Index('ix_permission_mirror_build_client_built', 'keycloak_client_uuid', 'built_timestamp'),
+    )
+
+    permission_mirror_build_id = Column(Integer, primary_key=True)
+    keycloak_client_uuid = Column(String(256))
+    permission_count = Column(Integer)
+    built_timestamp = Column(DATETIME(fsp=6)) # every permission read from keycloak after this was mirrored
 
 # ----------------------------------------------------------------------------------------------------------------------
 
@@ -118,6 +143,11 @@ class Role(Model):
 
 class User(Model):
     __tablename__ = 'user'
+    __table_args__ = (
+        Index('ix_user_username', 'username'),
+        Index('ix_user_modification_timestamp', 'modification_timestamp'),
+        Index('ix_user_keycloak_user_id', 'keycloak_user_id'),
+    )
 
     user_id = Column(Integer, primary_key=True)
     keycloak_user_id = Column(String(256))
@@ -160,8 +190,23 @@ class UserBrandProfileModuleAccess(Model):
     brand_profile_id = Column(Integer)
     module_access_id = Column(Integer)
 
+class UserEffectiveAccess(Model):
+    __tablename__ = 'user_effective_access'
+    __table_args__ = (
+        UniqueConstraint('user_id', 'brand_profile_id', name='uq_user_effective_access_user_brand_profile'),
+    )
+
+    user_effective_access_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    brand_profile_id = Column(Integer)  # 0 for all brand profiles
+    module_access_id_list = Column(JSON)  # sorted granted module_access_ids
+
 class OneTimePassword(Model):
     __tablename__ = 'one_time_password'
+    __table_args__ = (
+        Index('ix_one_time_password_user_intent', 'user_id', 'intent', 'otp_requested_timestamp'),
+        Index('ix_one_time_password_status_expiry', 'otp_status', 'otp_expiry_timestamp'),
+    )
 
     one_time_password_id = Column(Integer, primary_key=True)
     user_id = Column(Integer)
@@ -169,7 +214,8 @@ class OneTimePassword(Model):
     intent = Column(String(32))  # user_signup, user_forgot_password
     contact_method = Column(String(32))  # email, sms
 
-    otp = Column(String(128))
+    otp = Column(String(128))  # legacy, only otp_hash is written
+    otp_hash = Column(String(64), unique=True)  # sha256 hex of the token sent to the user
     otp_request_count = Column(Integer)
     
     otp_requested_timestamp = Column(DATETIME(fsp=6))
@@ -178,6 +224,45 @@ class OneTimePassword(Model):
 
     otp_status = Column(String(32))  # pending, sent, verified, expired
 
+class EmailOutbox(Model):
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        Index('ix_email_outbox_status_next_attempt', 'outbox_status', 'next_attempt_timestamp'),
+        Index('ix_email_outbox_claim_token', 'claim_token'),
+    )
+
+    email_outbox_id = Column(Integer, primary_key=True)
+    email_type = Column(String(64))  # user_signup, forgot_password
+    recipient_email = Column(String(256))
+    payload = Column(JSON)  # renderer input, e.g. name and verification link
+
+    outbox_status = Column(String(32))  # pending, sending, sent, failed
+    attempt_count = Column(Integer)
+    next_attempt_timestamp = Column(DATETIME(fsp=6))
+    claim_token = Column(String(64))
+    claimed_timestamp = Column(DATETIME(fsp=6))
+    sent_timestamp = Column(DATETIME(fsp=6))
+    last_error = Column(String(1024))
+
+class KeycloakCleanupQueue(Model):
+    __tablename__ = 'keycloak_cleanup_queue'
+    __table_args__ = (
+        Index('ix_keycloak_cleanup_queue_status_next_attempt', 'cleanup_status', 'next_attempt_timestamp'),
+        Index('ix_keycloak_cleanup_queue_claim_token', 'claim_token'),
+    )
+
+    keycloak_cleanup_queue_id = Column(Integer, primary_key=True)
+    user_id = Column(Integer)
+    keycloak_user_id = Column(String(256))
+
+    cleanup_status = Column(String(32))  # pending, processing, done, failed
+    attempt_count = Column(Integer)
+    next_attempt_timestamp = Column(DATETIME(fsp=6))
+    claim_token = Column(String(64))
+    claimed_timestamp = Column(DATETIME(fsp=6))
+    completed_timestamp = Column(DATETIME(fsp=6))
+    last_error = Column(String(1024))
+
 class Module(Model):
     __tablename__ = 'module'
     
@@ -197,6 +282,10 @@ class ModuleAccess(Model):
 
 class BrandProfile(Model):
     __tablename__ = 'brand_profile'
+    __table_args__ = (
+        Index('ix_brand_profile_name', 'brand_profile_name'),
+        Index('ix_brand_profile_modification_timestamp', 'modification_timestamp'),
+    )
 
     brand_profile_id = Column(Integer, primary_key=True)
     brand_profile_name = Column(String(128))
@@ -221,6 +310,10 @@ class PlanMenuGroupMap(Model):
 
 class Plan(Model):
     __tablename__ = 'plan'
+    __table_args__ = (
+        Index('ix_plan_brand_profile_plan_name', 'brand_profile_id', 'plan_name'),
+        Index('ix_plan_modification_timestamp', 'modification_timestamp'),
+    )
 
     plan_id = Column(Integer, primary_key=True)
     brand_profile_id = Column(Integer)
@@ -229,6 +322,10 @@ class Plan(Model):
 
 class MenuGroup(Model):
     __tablename__ = 'menu_group'
+    __table_args__ = (
+        Index('ix_menu_group_name', 'menu_group_name'),
+        Index('ix_menu_group_modification_timestamp', 'modification_timestamp'),
+    )
 
     menu_group_id = Column(Integer, primary_key=True)
     menu_group_name = Column(String(128))
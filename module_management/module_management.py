@@ -3,7 +3,6 @@ import json
 import traceback
 import logging
 
-from sqlalchemy import text
 from flask import Blueprint, request, jsonify, g
 from utils import keycloak_utils, jqutils, jqimage_uploader
 
@@ -15,14 +14,12 @@ module_management_blueprint = Blueprint('module_management', __name__)
 
 @module_management_blueprint.route('/modules', methods=['GET'])
 def get_modules():
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT module_id, module_name, module_description
         FROM module
         WHERE meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, meta_status="active").fetchall()
 
     module_list = [dict(row) for row in result]
@@ -31,13 +28,13 @@ def get_modules():
         module_id = one_module["module_id"]
 
         # get module accesses
-        query = text("""
+        query = jqutils.cached_text("""
             SELECT module_access_id, access_level
             FROM module_access
             WHERE module_id = :module_id
             AND meta_status = :meta_status
         """)
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             module_access_result = conn.execute(query, module_id=module_id, meta_status="active").fetchall()
 
         module_access_list = []
@@ -1,5 +1,4 @@
 from flask import Blueprint, request, jsonify, g
-from sqlalchemy import text
 
 from utils import jqutils
 from plan_management import plan_ninja
@@ -13,7 +12,7 @@ def check_plan_name_availability():
     plan_name = request_json["plan_name"]
     brand_profile_id = request_json["brand_profile_id"]
 
-    available_p = plan_ninja.check_plan_name_availability(plan_name, brand_profile_id)
+    available_p = plan_ninja.check_plan_name_availability(plan_name, brand_profile_id, indexed_p=True)
 
     response_body = {
         "data": {
@@ -59,10 +58,8 @@ def add_plan():
 
 @plan_management_blueprint.route('/plan/<plan_id>', methods=['GET'])
 def get_plan(plan_id):    
-    db_engine = jqutils.get_db_engine()
-
-    with db_engine.connect() as conn:
-        query = text("""
+    with jqutils.get_db_connection() as conn:
+        query = jqutils.cached_text("""
             SELECT plan_id, external_plan_id, brand_profile_id, plan_name
             FROM plan
             WHERE plan_id = :plan_id
@@ -78,7 +75,7 @@ def get_plan(plan_id):
             "external_plan_id": result["external_plan_id"],
         }
         
-        query = text("""
+        query = jqutils.cached_text("""
             SELECT mg.menu_group_id, mg.menu_group_name, mg.external_menu_group_id
             FROM plan_menu_group_map pmgm
             JOIN menu_group mg ON pmgm.menu_group_id = mg.menu_group_id
@@ -129,10 +126,8 @@ def update_plan(plan_id):
 
 @plan_management_blueprint.route('/plan/<plan_id>', methods=['DELETE'])
 def delete_plan(plan_id):
-    db_engine = jqutils.get_db_engine()
-    
-    with db_engine.connect() as conn:
-        query = text("""
+    with jqutils.get_db_connection() as conn:
+        query = jqutils.cached_text("""
             SELECT meta_status
             FROM plan
             WHERE plan_id = :plan_id
@@ -143,14 +138,14 @@ def delete_plan(plan_id):
         if result["meta_status"] != "deleted":
             action_timestamp = jqutils.get_utc_datetime()
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE plan_menu_group_map
                 SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
                 WHERE plan_id = :plan_id
             """)
             conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, plan_id=plan_id)
             
-            query = text("""
+            query = jqutils.cached_text("""
                 UPDATE plan
                 SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
                 WHERE plan_id = :plan_id
@@ -169,14 +164,15 @@ def get_plans():
     request_args = request.args
     brand_profile_id_list = request_args.get("brand_profile_id_list")
     
+    limit, after_id, include_total_p = jqutils.get_page_args(request_args)
+
     brand_profile_id_filter_statement = ""
     if brand_profile_id_list:
         brand_profile_id_list = brand_profile_id_list.split(",")
         brand_profile_id_filter_statement = "AND brand_profile_id IN :brand_profile_id_list"
     
-    db_engine = jqutils.get_db_engine()
-
-    query = text(f"""
+    # pages are taken over plans, a brand profile can continue on the next page
+    query = jqutils.cached_text(f"""
         SELECT p.plan_id, p.plan_name, p.external_plan_id, bp.brand_profile_id, bp.brand_profile_name, bp.external_brand_profile_id
         FROM (
             SELECT plan_id, plan_name, external_plan_id, brand_profile_id
@@ -186,9 +182,14 @@ def get_plans():
         ) p
         JOIN brand_profile bp ON p.brand_profile_id = bp.brand_profile_id
         WHERE bp.meta_status = :meta_status
+        AND p.plan_id > :after_id
+        ORDER BY p.plan_id
+        LIMIT :limit
     """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query, brand_profile_id_list=brand_profile_id_list, meta_status="active").fetchall()
+    with jqutils.get_db_connection() as conn:
+        results = conn.execute(query, brand_profile_id_list=brand_profile_id_list, meta_status="active",
+                                after_id=after_id, limit=limit + 1).fetchall()
+        results, pagination = jqutils.paginate(results, limit, "plan_id", "plan", include_total_p)
         
         brand_profile_id_plan_map = {}
         for one_plan in results:
@@ -210,6 +211,7 @@ def get_plans():
 
     response_body = {
         "data": brand_profile_id_plan_map.values(),
+        "pagination": pagination,
         "action": "get_plans",
         "status": "successful"
     }
@@ -219,9 +221,7 @@ def get_plans():
 def get_menu_groups_by_plan(plan_id):
     plan_id = int(plan_id)
     
-    db_engine = jqutils.get_db_engine()
-    
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT pmgm.plan_menu_group_map_id, mg.menu_group_id, mg.menu_group_name, mg.external_menu_group_id
         FROM (
             SELECT plan_menu_group_map_id, menu_group_id
@@ -232,7 +232,7 @@ def get_menu_groups_by_plan(plan_id):
         JOIN menu_group mg ON pmgm.menu_group_id = mg.menu_group_id
         WHERE mg.meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         results = conn.execute(query, plan_id=plan_id, meta_status="active").fetchall()
         menu_group_list = [dict(row) for row in results]
     
@@ -3,7 +3,6 @@ import json
 import traceback
 import logging
 
-from sqlalchemy import text
 from flask import Blueprint, request, jsonify, g
 from utils import keycloak_utils, jqutils, jqimage_uploader
 
@@ -15,14 +14,12 @@ role_management_blueprint = Blueprint('role_management', __name__)
 
 @role_management_blueprint.route('/roles', methods=['GET'])
 def get_roles():
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT role_id, role_name
         FROM role
         WHERE meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, meta_status="active").fetchall()
 
     response_body = {
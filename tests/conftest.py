@@ -1,14 +1,18 @@
 import pytest
 import os
 import json
+import time
 
 from sqlalchemy import text
+from jwcrypto import jwk, jwt
 from dotenv import load_dotenv
 load_dotenv(override=True)
+# importing api starts no background threads, and start_background_tasks() stays a no-op in tests
+os.environ["BACKGROUND_TASKS_ENABLED"] = "0"
 
 from data_migration_management.data_migration_manager import DataMigrationManager
 from models import models, archive_models
-from utils import jqutils, keycloak_utils
+from utils import jqutils, keycloak_utils, access_token
 
 @pytest.fixture(scope="session", autouse=True)
 def flask_app():
@@ -53,8 +57,7 @@ def landscape():
                 for one_row in rows:
                     one_row["meta_status"] = "active"
                     one_row["creation_user_id"] = 1
-                    query, params = jqutils.jq_prepare_insert_statement(table_name, one_row)
-                    conn.execute(query, params)
+                jqutils.bulk_insert_db_entries(rows, table_name, capture_tenant=False, conn=conn)
     
         with open('tests/testdata/users.json', 'r') as fp:
             user_list = json.load(fp)
@@ -74,10 +77,45 @@ def landscape():
                 user_id, policy_id, keycloak_user_id = create_user_on_keycloak_and_database(conn, userdata, allowed_resource_list=allowed_resource_list, role_name_list=role_name_list)
 
 @pytest.fixture(scope="session", autouse=True)
-def content_team_headers():
-    yield {
-        
-    }
+def content_team_headers(landscape):
+    """
+    Bearer token of the first landscape user, signed with a test key that is trusted next to the realm's keys
+    """
+    signing_key = jwk.JWK.generate(kty="RSA", size=2048, kid="content-team-test-key", alg="RS256", use="sig")
+
+    fetch_jwk_set = access_token.fetch_jwk_set
+    def fetch_jwk_set_with_test_key():
+        fetch_jwk_set()
+        access_token.JWK_SET.add(signing_key)
+
+    with open('tests/testdata/users.json', 'r') as fp:
+        email = json.load(fp)[0]["email"]
+
+    query = text("""
+        SELECT keycloak_user_id
+        FROM user
+        WHERE email = :email
+        AND meta_status = :meta_status
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        keycloak_user_id = conn.execute(query, email=email, meta_status="active").fetchone()["keycloak_user_id"]
+
+    current_time = int(time.time())
+    token = jwt.JWT(header={"alg": "RS256", "kid": signing_key.key_id, "typ": "JWT"}, claims={
+        "iss": access_token.get_token_issuer(),
+        "aud": access_token.get_token_audience(),
+        "sub": keycloak_user_id,
+        "iat": current_time,
+        "exp": current_time + 24 * 3600
+    })
+    token.make_signed_token(signing_key)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(access_token, "fetch_jwk_set", fetch_jwk_set_with_test_key)
+        monkeypatch.setattr(access_token, "JWK_SET", None)
+        yield {
+            "Authorization": f"Bearer {token.serialize()}"
+        }
 
 def create_user_on_keycloak_and_database(conn, userdata, allowed_resource_list=[], role_name_list=[]):
     username = userdata["username"]
@@ -149,31 +187,10 @@ def assign_policies_to_user(conn, user_id, keycloak_user_policy_id, policy_name_
     results = conn.execute(query, policy_name_list=policy_name_list, policy_type="resource", meta_status="active").fetchall()
     assert results, "Failed to find policies"
     
-    policy_name_id_map = {}
-    keycloak_policy_id_list = []
-    for one_policy in results:
-        policy_id = one_policy["policy_id"]
-        policy_name = one_policy["policy_name"]
-        keycloak_policy_id = one_policy["keycloak_policy_id"]
-        
-        policy_name_id_map[policy_name] = policy_id
-        keycloak_policy_id_list.append(keycloak_policy_id)
-    
-    # attach user to correct policies on keycloak
-    keycloak_utils.attach_user_to_policies(keycloak_user_policy_id, keycloak_policy_id_list)
-    
-    # attach user to correct policies in database
-    for policy_name in policy_name_list:
-        policy_id = policy_name_id_map[policy_name]
-        policy_user_map_dict = {
-            "policy_id": policy_id,
-            "user_id": user_id,
-            "meta_status": "active",
-            "creation_user_id": 1,
-        }
-        query, params = jqutils.jq_prepare_insert_statement('policy_user_map', policy_user_map_dict)
-        result = conn.execute(query, params).lastrowid
-        assert result, "Failed to attach user to policy"
+    keycloak_policy_id_list = [one_policy["keycloak_policy_id"] for one_policy in results]
+
+    # attach user to correct policies on keycloak, the user's policies are recorded in policy_user_map
+    keycloak_utils.attach_user_to_policies(keycloak_user_policy_id, keycloak_policy_id_list, user_id=user_id)
 
 def assign_realm_roles_to_user(conn, user_id, keycloak_user_id, role_name_list):
     
@@ -0,0 +1,124 @@
+import time
+import pytest
+
+from jwcrypto import jwk, jwt
+from keycloak.exceptions import KeycloakConnectionError
+from sqlalchemy import text
+from utils import jqutils, keycloak_utils, access_token
+
+base_api_url = "/api"
+
+class RealmCerts:
+    """
+    Serves the realm's JWKS in place of Keycloak, the keys can be rotated or made unreachable
+    """
+    def __init__(self, key):
+        self.key_list = [key]
+        self.unavailable_p = False
+
+    def certs(self):
+        if self.unavailable_p:
+            raise KeycloakConnectionError("Can't connect to server")
+        return {"keys": [key.export_public(as_dict=True) for key in self.key_list]}
+
+def generate_signing_key(kid):
+    return jwk.JWK.generate(kty="RSA", size=2048, kid=kid, alg="RS256", use="sig")
+
+def sign_token(key, **claims):
+    current_time = int(time.time())
+    token_claims = {
+        "iss": access_token.get_token_issuer(),
+        "aud": access_token.get_token_audience(),
+        "sub": token_user["keycloak_user_id"],
+        "iat": current_time,
+        "exp": current_time + 300
+    }
+    token_claims.update(claims)
+
+    token = jwt.JWT(header={"alg": "RS256", "kid": key.key_id, "typ": "JWT"}, claims=token_claims)
+    token.make_signed_token(key)
+    return token.serialize()
+
+def do_get_modules(client, token):
+    response = client.get(base_api_url + "/modules", headers={"Authorization": f"Bearer {token}"})
+    return response
+
+token_user = None
+
+@pytest.fixture
+def realm_certs(monkeypatch):
+    global token_user
+
+    query = text("""
+        SELECT user_id, tenant_id, keycloak_user_id
+        FROM user
+        WHERE keycloak_user_id IS NOT NULL
+        AND meta_status = :meta_status
+        ORDER BY user_id
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        token_user = dict(conn.execute(query, meta_status="active").fetchone())
+
+    realm_certs = RealmCerts(generate_signing_key("test-key-1"))
+    monkeypatch.setattr(keycloak_utils, "get_keycloak_client_openid", lambda: realm_certs)
+    monkeypatch.setattr(access_token, "JWK_SET", None)
+    monkeypatch.setattr(access_token, "JWKS_FETCHED_AT", 0)
+    return realm_certs
+
+def test_valid_token_maps_subject_to_user(client, realm_certs):
+    """
+    Test: a token signed by the realm authenticates as the user holding its subject
+    """
+    token = sign_token(realm_certs.key_list[0])
+    assert access_token.authenticate_access_token(token) == token_user
+
+    response = do_get_modules(client, token)
+    assert response.status_code == 200
+
+def test_missing_token_is_rejected(client):
+    """
+    Test: a request without a token does not run as any user
+    """
+    response = client.get(base_api_url + "/modules")
+    assert response.status_code == 401
+    assert response.get_json()["status"] == "failed"
+
+def test_expired_token_is_rejected(client, realm_certs):
+    expired_time = int(time.time()) - 3600
+    response = do_get_modules(client, sign_token(realm_certs.key_list[0], iat=expired_time - 300, exp=expired_time))
+    assert response.status_code == 401
+
+def test_token_for_another_audience_is_rejected(client, realm_certs):
+    response = do_get_modules(client, sign_token(realm_certs.key_list[0], aud="another-client"))
+    assert response.status_code == 401
+
+def test_token_from_another_issuer_is_rejected(client, realm_certs):
+    response = do_get_modules(client, sign_token(realm_certs.key_list[0], iss="http://127.0.0.1:8080/realms/another-realm"))
+    assert response.status_code == 401
+
+def test_token_from_an_unknown_key_is_rejected(client, realm_certs):
+    response = do_get_modules(client, sign_token(generate_signing_key("test-key-1")))
+    assert response.status_code == 401
+
+def test_rotated_signing_key_is_refetched(client, realm_certs, monkeypatch):
+    """
+    Test: a token signed with a key id the cached JWKS does not know refetches the JWKS once
+    """
+    assert do_get_modules(client, sign_token(realm_certs.key_list[0])).status_code == 200
+    jwks_fetch_count = access_token.JWKS_FETCH_COUNT
+
+    monkeypatch.setattr(access_token, "JWKS_MIN_REFETCH_SECONDS", 0)
+    realm_certs.key_list = [generate_signing_key("test-key-2")]
+    rotated_token = sign_token(realm_certs.key_list[0])
+    assert do_get_modules(client, rotated_token).status_code == 200
+    assert access_token.JWKS_FETCH_COUNT == jwks_fetch_count + 1
+
+    # the new key is cached
+    assert do_get_modules(client, rotated_token).status_code == 200
+    assert access_token.JWKS_FETCH_COUNT == jwks_fetch_count + 1
+
+def test_unreachable_realm_keys_answer_service_unavailable(client, realm_certs):
+    realm_certs.unavailable_p = True
+    response = do_get_modules(client, sign_token(realm_certs.key_list[0]))
+    assert response.status_code == 503
+    assert response.get_json()["status"] == "failed"
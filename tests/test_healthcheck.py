@@ -0,0 +1,369 @@
+import json
+import pytest
+import threading
+import dataclasses
+
+from utils import jqutils, db_pool_manager, keycloak_executor
+from utils.settings import get_settings, reload_settings
+
+base_api_url = "/api"
+
+##########################
+# TEST - HEALTHCHECK
+##########################
+def do_get_healthcheck(client, content_team_headers):
+    """
+    GET HEALTHCHECK
+    """
+    response = client.get(base_api_url + "/healthcheck", headers=content_team_headers)
+    return response
+
+def do_get_statement_cache_stats(client, content_team_headers):
+    """
+    GET STATEMENT CACHE STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/statement-cache", headers=content_team_headers)
+    return response
+
+def do_get_db_pool_stats(client, content_team_headers):
+    """
+    GET DB POOL STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/db-pool", headers=content_team_headers)
+    return response
+
+def do_get_user_profile_cache_stats(client, content_team_headers):
+    """
+    GET USER PROFILE CACHE STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/user-profile-cache", headers=content_team_headers)
+    return response
+
+def do_get_availability_index_stats(client, content_team_headers):
+    """
+    GET AVAILABILITY INDEX STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/availability-index", headers=content_team_headers)
+    return response
+
+def do_get_keycloak_admin_stats(client, content_team_headers):
+    """
+    GET KEYCLOAK ADMIN STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/keycloak-admin", headers=content_team_headers)
+    return response
+
+##########################
+# TEST CASES
+##########################
+@pytest.fixture
+def replica_settings(monkeypatch):
+    """
+    Uses the primary as the only "replica", so routed reads still find the test data
+    """
+    settings = dataclasses.replace(get_settings(), mysql_replica_ip_address_list=(get_settings().mysql_ip_address,))
+    monkeypatch.setattr(jqutils, "get_settings", lambda: settings)
+    yield settings
+
+    for engine_name in [engine_name for engine_name in jqutils.ENGINES if engine_name.startswith("REPLICA")]:
+        db_pool_manager.unregister_engine(engine_name)
+        del jqutils.ENGINES[engine_name]
+    jqutils.REPLICA_LAG_CHECKS.clear()
+
+def get_replica_checkout_count(client, content_team_headers):
+    pool_stats_map = json.loads(do_get_db_pool_stats(client, content_team_headers).data)["data"]
+    return sum(pool_stats["checkout_count"] for engine_name, pool_stats in pool_stats_map.items() if engine_name.startswith("REPLICA"))
+
+def test_get_healthcheck(client, content_team_headers):
+    """
+    Test: Get Healthcheck
+    """
+    response = do_get_healthcheck(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+
+def test_statement_cache_is_warm(client, content_team_headers):
+    """
+    Test: repeated requests are served from the statement cache
+    """
+    client.get(base_api_url + "/modules", headers=content_team_headers)
+    response = do_get_statement_cache_stats(client, content_team_headers)
+    assert response.status_code == 200
+    hits = json.loads(response.data)["data"]["hits"]
+
+    client.get(base_api_url + "/modules", headers=content_team_headers)
+    response = do_get_statement_cache_stats(client, content_team_headers)
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+    assert response_json["data"]["hits"] > hits
+    assert response_json["data"]["size"] <= response_json["data"]["maxsize"]
+
+def test_get_db_pool_stats(client, content_team_headers):
+    """
+    Test: Get DB pool telemetry
+    """
+    client.get(base_api_url + "/modules", headers=content_team_headers)
+    response = do_get_db_pool_stats(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+
+    pool_stats_list = list(response_json["data"].values())
+    assert sum(pool_stats["checkout_count"] for pool_stats in pool_stats_list) > 0
+    for pool_stats in pool_stats_list:
+        assert sum(pool_stats["checkout_wait_histogram"].values()) == pool_stats["checkout_count"]
+        assert pool_stats["pool_size"] + pool_stats["max_overflow"] > 0
+
+def test_db_pools_share_the_connection_budget(client, content_team_headers):
+    """
+    Test: every pool keeps one connection per request thread and all engines of a worker stay within its budget
+    """
+    client.get(base_api_url + "/modules", headers=content_team_headers)
+    response = do_get_db_pool_stats(client, content_team_headers)
+    assert response.status_code == 200
+
+    settings = get_settings()
+    engine_count = 1 + len(settings.mysql_replica_ip_address_list)
+    engine_budget = max(1, settings.db_connection_budget // settings.web_concurrency // engine_count)
+    for pool_stats in json.loads(response.data)["data"].values():
+        assert pool_stats["pool_size"] == min(settings.gunicorn_threads, engine_budget)
+        assert pool_stats["pool_size"] + pool_stats["max_overflow"] <= engine_budget
+        assert pool_stats["max_overflow"] <= max(2, pool_stats["pool_size"])
+
+def test_primary_pool_holds_a_connection_per_background_thread(client, content_team_headers, monkeypatch):
+    """
+    Test: the outbox workers, OTP sweeper, cleanup worker and mirror refresher get their own primary connections within the budget
+    """
+    settings = dataclasses.replace(get_settings(), background_tasks_enabled=True, gunicorn_threads=2, email_outbox_worker_count=4,
+                                    otp_sweep_interval_seconds=300, keycloak_cleanup_poll_seconds=5, keycloak_permission_mirror_refresh_seconds=1800,
+                                    db_connection_budget=1000, web_concurrency=1, mysql_replica_ip_address_list=())
+    monkeypatch.setattr(db_pool_manager, "get_settings", lambda: settings)
+
+    assert db_pool_manager.get_background_db_thread_count(settings) == 8
+    assert db_pool_manager.get_engine_kwargs(background_p=True)["pool_size"] == 2 + 8
+    assert db_pool_manager.get_engine_kwargs()["pool_size"] == 2
+
+    settings = dataclasses.replace(settings, db_connection_budget=4)
+    assert db_pool_manager.get_engine_kwargs(background_p=True)["pool_size"] == 4
+
+def test_get_user_profile_cache_stats(client, content_team_headers):
+    """
+    Test: repeated get_user requests hit the user profile cache
+    """
+    client.get(base_api_url + "/user/1", headers=content_team_headers)
+    response = do_get_user_profile_cache_stats(client, content_team_headers)
+    assert response.status_code == 200
+    hits = json.loads(response.data)["data"]["local"]["hits"]
+
+    client.get(base_api_url + "/user/1", headers=content_team_headers)
+    response = do_get_user_profile_cache_stats(client, content_team_headers)
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+    assert response_json["data"]["local"]["hits"] > hits
+
+def test_get_availability_index_stats(client, content_team_headers):
+    """
+    Test: a free brand profile name is answered from the availability index
+    """
+    payload = {
+        "brand_profile_name": "never-used-brand-profile-name"
+    }
+    response = client.post(base_api_url + "/brand-profile/availability", headers=content_team_headers, json=payload)
+    assert response.get_json()["data"]["available_p"] == True
+
+    response = do_get_availability_index_stats(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+    assert response_json["data"]["brand_profile_name"]["definitely_available_count"] > 0
+
+def test_get_keycloak_admin_stats(client, content_team_headers):
+    """
+    Test: the landscape's keycloak user cleanup is recorded per operation
+    """
+    response = do_get_keycloak_admin_stats(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+
+    operation_stats = response_json["data"]["operation_stats"]["get_users"]
+    assert operation_stats["call_count"] > 0
+    assert sum(operation_stats["latency_histogram"].values()) == operation_stats["call_count"]
+
+def test_get_keycloak_client_stats(client, content_team_headers):
+    """
+    Test: the realm admin client is shared and reported with its token expiry
+    """
+    response = do_get_keycloak_admin_stats(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+
+    client_stats_list = [client_stats for client_stats in response_json["data"]["client_stats"] if client_stats["kind"] == "admin"]
+    assert len(client_stats_list) > 0
+    for client_stats in client_stats_list:
+        assert client_stats["expires_at"] is not None
+
+def do_get_access_token_stats(client, content_team_headers):
+    """
+    GET ACCESS TOKEN STATS
+    """
+    response = client.get(base_api_url + "/healthcheck/access-token", headers=content_team_headers)
+    return response
+
+def test_invalid_access_token_is_rejected(client, content_team_headers):
+    """
+    Test: a bearer token that fails verification is answered with 401
+    """
+    response = do_get_access_token_stats(client, content_team_headers)
+    rejected_count = json.loads(response.data)["data"]["rejected_count"]
+
+    headers = dict(content_team_headers, Authorization="Bearer not-a-token")
+    response = client.get(base_api_url + "/modules", headers=headers)
+    assert response.status_code == 401
+    assert response.get_json()["status"] == "failed"
+
+    response = do_get_access_token_stats(client, content_team_headers)
+    assert response.status_code == 200
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+    assert response_json["data"]["rejected_count"] == rejected_count + 1
+
+def test_get_requests_read_from_a_healthy_replica(client, content_team_headers, replica_settings, monkeypatch):
+    """
+    Test: GET requests read from a replica within the lag limit, other requests stay on the primary
+    """
+    monkeypatch.setattr(jqutils, "get_db_replica_lag_seconds", lambda engine: 0)
+
+    response = client.get(base_api_url + "/modules", headers=content_team_headers)
+    assert response.status_code == 200
+    checkout_count = get_replica_checkout_count(client, content_team_headers)
+    assert checkout_count > 0
+
+    payload = {
+        "brand_profile_name": "never-used-brand-profile-name"
+    }
+    response = client.post(base_api_url + "/brand-profile/availability", headers=content_team_headers, json=payload)
+    assert response.status_code == 200
+    assert get_replica_checkout_count(client, content_team_headers) == checkout_count
+
+def test_get_requests_fall_back_from_a_lagging_replica(client, content_team_headers, replica_settings, monkeypatch):
+    """
+    Test: a replica lagging behind MYSQL_REPLICA_MAX_LAG_SECONDS is skipped
+    """
+    monkeypatch.setattr(jqutils, "get_db_replica_lag_seconds", lambda engine: replica_settings.mysql_replica_max_lag_seconds + 1)
+
+    response = client.get(base_api_url + "/modules", headers=content_team_headers)
+    assert response.status_code == 200
+    assert response.get_json()["data"]
+    assert get_replica_checkout_count(client, content_team_headers) == 0
+
+def test_get_requests_fall_back_from_a_host_that_does_not_replicate(client, content_team_headers, replica_settings):
+    """
+    Test: the lag probe reports a host without replication as unusable and reads go to the primary
+    """
+    response = client.get(base_api_url + "/modules", headers=content_team_headers)
+    assert response.status_code == 200
+    assert response.get_json()["data"]
+
+    response = client.get(base_api_url + "/healthcheck/db-replicas", headers=content_team_headers)
+    replica_stats_list = response.get_json()["data"]
+    assert len(replica_stats_list) == 1
+    assert replica_stats_list[0]["lag_seconds"] is None
+    # the probe connection is not a routed read
+    assert get_replica_checkout_count(client, content_team_headers) == 0
+
+def test_settings_reload_rebuilds_derived_state(client, content_team_headers, monkeypatch):
+    """
+    Test: a settings reload runs the registered callbacks, e.g. the user profile cache is rebuilt with the new size
+    """
+    monkeypatch.setenv("USER_PROFILE_CACHE_SIZE", "17")
+    try:
+        assert reload_settings().user_profile_cache_size == 17
+
+        response = do_get_user_profile_cache_stats(client, content_team_headers)
+        assert response.status_code == 200
+        assert response.get_json()["data"]["local"]["maxsize"] == 17
+        # the rebuilt engines still serve requests
+        assert client.get(base_api_url + "/modules", headers=content_team_headers).status_code == 200
+    finally:
+        monkeypatch.delenv("USER_PROFILE_CACHE_SIZE")
+        reload_settings()
+
+    response = do_get_user_profile_cache_stats(client, content_team_headers)
+    assert response.get_json()["data"]["local"]["maxsize"] == get_settings().user_profile_cache_size
+
+def test_settings_reload_shuts_down_the_keycloak_executor(client, content_team_headers):
+    """
+    Test: a reload lets the running call finish on the old pool and then its threads exit
+    """
+    release_event = threading.Event()
+    future = keycloak_executor.submit(release_event.wait, 10)
+    old_executor = keycloak_executor.EXECUTOR
+
+    reload_settings()
+    assert keycloak_executor.EXECUTOR is None
+    assert not future.done()
+
+    release_event.set()
+    assert future.result(timeout=10) is True
+    for thread in list(old_executor._threads):  # pylint: disable=protected-access
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+
+    assert keycloak_executor.submit(lambda: "new pool").result(timeout=10) == "new pool"
+    assert keycloak_executor.EXECUTOR is not old_executor
+
+def get_unique_code_stats(client, content_team_headers, key):
+    response = client.get(base_api_url + "/healthcheck/unique-codes", headers=content_team_headers)
+    return response.get_json()["data"].get(key, {"query_count": 0, "collision_count": 0})
+
+def test_unique_code_batch_skips_taken_codes(client, content_team_headers, monkeypatch):
+    """
+    Test: a batch of candidates is checked with one query and the first free candidate wins
+    """
+    module_name = client.get(base_api_url + "/modules", headers=content_team_headers).get_json()["data"][0]["module_name"]
+    stats = get_unique_code_stats(client, content_team_headers, "module.module_name")
+
+    candidate_iterator = iter([module_name, "free-module-code", "never-used-code"])
+    code = jqutils.pick_unique_code("module", "module_name", lambda: next(candidate_iterator), retries=3)
+    assert code == "free-module-code"
+
+    new_stats = get_unique_code_stats(client, content_team_headers, "module.module_name")
+    assert new_stats["query_count"] == stats["query_count"] + 1
+    assert new_stats["collision_count"] == stats["collision_count"] + 1
+
+def test_insert_with_unique_code_retries_on_duplicate(client, content_team_headers, monkeypatch):
+    """
+    Test: reservation mode lets the unique index reject a taken code and inserts the next candidate
+    """
+    taken_code, free_code = "a" * 64, "b" * 64
+    one_dict = {"user_id": 1, "intent": "unique_code_test", "contact_method": "email", "meta_status": "deleted"}
+
+    monkeypatch.setattr(jqutils, "build_unique_code_candidate", lambda keyword, length, method: taken_code)
+    jqutils.insert_with_unique_code(one_dict, "one_time_password", "otp_hash", "otp", 64)
+    stats = get_unique_code_stats(client, content_team_headers, "one_time_password.otp_hash")
+
+    candidate_iterator = iter([taken_code, free_code])
+    monkeypatch.setattr(jqutils, "build_unique_code_candidate", lambda keyword, length, method: next(candidate_iterator))
+    code, one_time_password_id = jqutils.insert_with_unique_code(one_dict, "one_time_password", "otp_hash", "otp", 64)
+    assert code == free_code
+    assert one_time_password_id
+
+    new_stats = get_unique_code_stats(client, content_team_headers, "one_time_password.otp_hash")
+    assert new_stats["collision_count"] == stats["collision_count"] + 1
+
+def test_importing_the_app_starts_no_background_tasks(flask_app, client, content_team_headers):
+    """
+    Test: background threads are only started by start_background_tasks(), which tests disable
+    """
+    import api
+    assert api.start_background_tasks() == False
+
+    response = client.get(base_api_url + "/healthcheck/background-tasks", headers=content_team_headers)
+    assert response.status_code == 200
+    assert response.get_json()["data"] == {}
+
+    response = client.get(base_api_url + "/healthcheck/email-outbox", headers=content_team_headers)
+    assert response.get_json()["data"]["dispatcher_running_p"] == False
@@ -44,11 +44,11 @@ def do_update_menu_group(client, content_team_headers, menu_group_id, payload):
     response = client.put(base_api_url + f"/menu-group/{menu_group_id}", headers=content_team_headers, json=payload)
     return response
 
-def do_get_menu_groups(client, content_team_headers):
+def do_get_menu_groups(client, content_team_headers, query_string=None):
     """
     Get menu groups
     """
-    response = client.get(base_api_url + "/menu-groups", headers=content_team_headers)
+    response = client.get(base_api_url + "/menu-groups", headers=content_team_headers, query_string=query_string)
     return response
 
 def do_delete_menu_group(client, content_team_headers, menu_group_id):
@@ -129,6 +129,14 @@ def test_bulk_add_menu_groups(client, content_team_headers):
     assert response.status_code == 200
     response_json = response.get_json()
     assert response_json["status"] == "successful"
+    menu_group_id_list = response_json["data"]["menu_group_id_list"]
+    assert len(menu_group_id_list) == len(menu_group_name_list)
+
+    # validate that generated ids are returned in payload order
+    for menu_group_id, menu_group_name in zip(menu_group_id_list, menu_group_name_list):
+        response = do_get_menu_group(client, content_team_headers, menu_group_id)
+        assert response.status_code == 200
+        assert response.get_json()["data"]["menu_group_name"] == menu_group_name
 
     # validate that same menu group name cannot be added again
     response = do_bulk_add_menu_groups(client, content_team_headers, payload)
@@ -244,6 +252,35 @@ def test_get_menu_groups(client, content_team_headers, existing_menu_group_count
     menu_group_list = response_data["menu_group_list"]
     assert len(menu_group_list) == expected_count, f"Menu Group List should have {expected_count} item(s)."
 
+def test_get_menu_groups_paginated(client, content_team_headers):
+    """
+    Test: Walk all menu groups one page at a time
+    """
+    response = do_get_menu_groups(client, content_team_headers)
+    all_menu_group_id_list = [one_menu_group["menu_group_id"] for one_menu_group in response.get_json()["data"]["menu_group_list"]]
+    assert len(all_menu_group_id_list) > 1
+
+    paged_menu_group_id_list = []
+    query_string = {"limit": 1, "include_total": "true"}
+    while True:
+        response = do_get_menu_groups(client, content_team_headers, query_string)
+        assert response.status_code == 200
+        response_json = response.get_json()
+        assert response_json["status"] == "successful"
+
+        menu_group_list = response_json["data"]["menu_group_list"]
+        pagination = response_json["pagination"]
+        assert len(menu_group_list) <= 1
+        assert "approximate_total" in pagination
+        paged_menu_group_id_list += [one_menu_group["menu_group_id"] for one_menu_group in menu_group_list]
+
+        if not pagination["has_more_p"]:
+            assert pagination["next_cursor"] is None
+            break
+        query_string["after"] = pagination["next_cursor"]
+
+    assert paged_menu_group_id_list == all_menu_group_id_list
+
 def test_delete_menu_group(client, content_team_headers, existing_menu_group_count):
     """
     Test: Delete menu group
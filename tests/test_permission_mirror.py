@@ -0,0 +1,222 @@
+from sqlalchemy import text
+from utils import jqutils, keycloak_utils
+
+def get_permission_keycloak_id_list(policy_name_list):
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        SELECT keycloak_policy_id
+        FROM policy
+        WHERE policy_name IN :policy_name_list
+        AND policy_type = :policy_type
+        AND meta_status = :meta_status
+    """)
+    with db_engine.connect() as conn:
+        result = conn.execute(query, policy_name_list=policy_name_list, policy_type="resource", meta_status="active").fetchall()
+
+    assert len(result) == len(policy_name_list), "permissions not found"
+    return [row["keycloak_policy_id"] for row in result]
+
+def count_keycloak_calls(monkeypatch):
+    """
+    Counts the permissions read from and written to Keycloak
+    """
+    call_map = {"fetch_permission": [], "put_permission_policies": [], "get_all_permission_list": 0}
+
+    fetch_permission = keycloak_utils.fetch_permission
+    def count_fetch_permission(keycloak_admin_openid, permission):
+        call_map["fetch_permission"].append(permission["id"])
+        return fetch_permission(keycloak_admin_openid, permission)
+    monkeypatch.setattr(keycloak_utils, "fetch_permission", count_fetch_permission)
+
+    put_permission_policies = keycloak_utils.put_permission_policies
+    def count_put_permission_policies(keycloak_admin_openid, permission, policy_id_list):
+        call_map["put_permission_policies"].append(permission["id"])
+        return put_permission_policies(keycloak_admin_openid, permission, policy_id_list)
+    monkeypatch.setattr(keycloak_utils, "put_permission_policies", count_put_permission_policies)
+
+    get_all_permission_list = keycloak_utils.get_all_permission_list
+    def count_get_all_permission_list(keycloak_admin_openid):
+        call_map["get_all_permission_list"] += 1
+        return get_all_permission_list(keycloak_admin_openid)
+    monkeypatch.setattr(keycloak_utils, "get_all_permission_list", count_get_all_permission_list)
+
+    return call_map
+
+def create_attached_user(username, policy_name_list, indexed_p):
+    """
+    Creates a Keycloak user with a user policy applied to the named permissions.
+    Returns the keycloak_user_id, local user_id and keycloak_policy_id.
+    """
+    keycloak_user_id = keycloak_utils.create_user(username, f"{username}123", email=f"{username}@something.com")
+    keycloak_user_policy_id = keycloak_utils.create_user_policy(username)
+    user_id = jqutils.bulk_insert_db_entries([{
+        "keycloak_user_id": keycloak_user_id,
+        "first_names_en": username,
+        "email": f"{username}@something.com",
+        "meta_status": "active",
+        "creation_user_id": 1
+    }], "user", capture_tenant=False)[0]
+
+    keycloak_utils.attach_user_to_policies(keycloak_user_policy_id, get_permission_keycloak_id_list(policy_name_list),
+                                            user_id=user_id if indexed_p else None)
+    return keycloak_user_id, user_id, keycloak_user_policy_id
+
+def get_applying_permission_count(keycloak_user_policy_id, policy_name_list):
+    keycloak_admin_openid = keycloak_utils.get_keycloak_admin_openid()
+    return sum(keycloak_user_policy_id in [policy["id"] for policy in
+                keycloak_admin_openid.get_client_authz_permission_associated_policies(keycloak_utils.client_uuid, keycloak_policy_id)]
+                for keycloak_policy_id in get_permission_keycloak_id_list(policy_name_list))
+
+def get_policy_user_map_count(user_id):
+    query = text("""
+        SELECT COUNT(*) AS policy_user_map_count
+        FROM policy_user_map
+        WHERE user_id = :user_id
+        AND meta_status = :meta_status
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        return conn.execute(query, user_id=user_id, meta_status="active").fetchone()["policy_user_map_count"]
+
+def test_refresh_permission_mirror_mirrors_applied_policies(client, content_team_headers):
+    """
+    Test: one pass mirrors every permission with the policies Keycloak applies
+    """
+    permission_count = keycloak_utils.refresh_permission_mirror()
+    assert permission_count
+
+    keycloak_policy_id = get_permission_keycloak_id_list(["all:*:menu-management:admin"])[0]
+    keycloak_admin_openid = keycloak_utils.get_keycloak_admin_openid()
+    keycloak_policy_list = keycloak_admin_openid.get_client_authz_permission_associated_policies(keycloak_utils.client_uuid, keycloak_policy_id)
+
+    with jqutils.get_db_transaction() as conn:
+        permission = keycloak_utils.load_permission_mirror([keycloak_policy_id], conn)[keycloak_policy_id]
+    assert permission["keycloak_synced_timestamp"]
+    assert sorted(permission["policy_id_list"]) == sorted(policy["id"] for policy in keycloak_policy_list)
+
+def test_attach_user_to_policies_costs_one_update_per_missing_permission(client, content_team_headers, monkeypatch):
+    """
+    Test: a fresh mirror is not re-read, and only permissions without the user policy are updated
+    """
+    keycloak_user_id = keycloak_utils.create_user("mirror.tester", "mirror123", email="mirror.tester@something.com")
+    keycloak_user_policy_id = keycloak_utils.create_user_policy("mirror.tester")
+    keycloak_policy_id_list = get_permission_keycloak_id_list(["all:*:menu-management:admin", "all:*:kitchen-provider:admin"])
+    keycloak_utils.refresh_permission_mirror()
+
+    call_map = count_keycloak_calls(monkeypatch)
+    keycloak_utils.attach_user_to_policies(keycloak_user_policy_id, keycloak_policy_id_list)
+    assert call_map["fetch_permission"] == []
+    assert sorted(call_map["put_permission_policies"]) == sorted(keycloak_policy_id_list)
+
+    keycloak_admin_openid = keycloak_utils.get_keycloak_admin_openid()
+    for keycloak_policy_id in keycloak_policy_id_list:
+        keycloak_policy_list = keycloak_admin_openid.get_client_authz_permission_associated_policies(keycloak_utils.client_uuid, keycloak_policy_id)
+        assert keycloak_user_policy_id in [policy["id"] for policy in keycloak_policy_list]
+
+    # attaching again finds the policy in the mirror
+    keycloak_utils.attach_user_to_policies(keycloak_user_policy_id, keycloak_policy_id_list)
+    assert len(call_map["put_permission_policies"]) == len(keycloak_policy_id_list)
+
+    keycloak_utils.disassociate_user_from_policies(keycloak_user_id)
+    keycloak_utils.delete_user(keycloak_user_id)
+
+def test_mirrored_policy_rows_are_upserted(client, content_team_headers):
+    """
+    Test: a known keycloak_policy_id is reactivated instead of inserted twice
+    """
+    policy_dict = {
+        "keycloak_policy_id": "upsert-test-policy",
+        "policy_name": "upsert-test-policy",
+        "policy_type": "user",
+        "meta_status": "deleted",
+        "creation_user_id": 1
+    }
+    policy_id = jqutils.bulk_insert_db_entries([policy_dict], "policy", capture_tenant=False)[0]
+
+    with jqutils.get_db_transaction() as conn:
+        local_id_map = keycloak_utils.get_local_id_map("policy", "keycloak_policy_id", [{"id": "upsert-test-policy", "type": "user"}],
+                                                        keycloak_utils.build_policy_row, conn, upsert_p=True)
+    assert local_id_map == {"upsert-test-policy": policy_id}
+
+    query = text("""
+        SELECT COUNT(*) AS policy_count
+        FROM policy
+        WHERE keycloak_policy_id = :keycloak_policy_id
+        AND meta_status = :meta_status
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        assert conn.execute(query, keycloak_policy_id="upsert-test-policy", meta_status="active").fetchone()["policy_count"] == 1
+
+def test_disassociate_indexed_user_updates_only_applying_permissions(client, content_team_headers, monkeypatch):
+    """
+    Test: with a built mirror an indexed user is removed through the reverse index, without reading every permission
+    """
+    policy_name_list = ["all:*:menu-management:admin", "all:*:kitchen-provider:admin"]
+    keycloak_utils.refresh_permission_mirror()
+    keycloak_user_id, user_id, keycloak_user_policy_id = create_attached_user("index.tester", policy_name_list, indexed_p=True)
+    assert get_policy_user_map_count(user_id) == len(policy_name_list) + 1
+    assert get_applying_permission_count(keycloak_user_policy_id, policy_name_list) == len(policy_name_list)
+
+    call_map = count_keycloak_calls(monkeypatch)
+    keycloak_utils.disassociate_user_from_policies(keycloak_user_id, user_id)
+    assert call_map["get_all_permission_list"] == 0
+    assert sorted(call_map["put_permission_policies"]) == sorted(get_permission_keycloak_id_list(policy_name_list))
+    assert get_applying_permission_count(keycloak_user_policy_id, policy_name_list) == 0
+    assert get_policy_user_map_count(user_id) == 0
+
+    keycloak_utils.delete_user(keycloak_user_id)
+
+def test_disassociate_falls_back_to_a_scan_without_a_mirror_build(client, content_team_headers, monkeypatch):
+    """
+    Test: without a recent full build the user is removed by scanning Keycloak, and the scan records a new build
+    """
+    policy_name_list = ["all:*:delivery-provider:admin"]
+    keycloak_user_id, user_id, keycloak_user_policy_id = create_attached_user("scan.tester", policy_name_list, indexed_p=True)
+
+    query = text("""
+        UPDATE permission_mirror_build
+        SET meta_status = :meta_status
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        conn.execute(query, meta_status="deleted")
+
+    call_map = count_keycloak_calls(monkeypatch)
+    keycloak_utils.disassociate_user_from_policies(keycloak_user_id, user_id)
+    assert call_map["get_all_permission_list"] == 1
+    assert call_map["put_permission_policies"] == get_permission_keycloak_id_list(policy_name_list)
+    assert get_applying_permission_count(keycloak_user_policy_id, policy_name_list) == 0
+
+    with jqutils.get_db_transaction() as conn:
+        assert keycloak_utils.is_permission_mirror_complete(conn)
+
+    keycloak_utils.delete_user(keycloak_user_id)
+
+def test_mirror_build_backfills_the_user_policy_index(client, content_team_headers, monkeypatch):
+    """
+    Test: attaching without a local user_id still indexes the user, and a full build restores a lost index
+    """
+    policy_name_list = ["all:*:menu-management:admin"]
+    keycloak_user_id, user_id, keycloak_user_policy_id = create_attached_user("backfill.tester", policy_name_list, indexed_p=False)
+    assert get_policy_user_map_count(user_id) == len(policy_name_list) + 1
+
+    query = text("""
+        UPDATE policy_user_map
+        SET meta_status = :meta_status
+        WHERE user_id = :user_id
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        conn.execute(query, meta_status="deleted", user_id=user_id)
+
+    keycloak_utils.refresh_permission_mirror()
+    assert get_policy_user_map_count(user_id) == 1
+
+    # a fresh build is not repeated by the periodic task
+    call_map = count_keycloak_calls(monkeypatch)
+    assert keycloak_utils.refresh_stale_permission_mirror() == 0
+    assert call_map["get_all_permission_list"] == 0
+
+    keycloak_utils.disassociate_user_from_policies(keycloak_user_id, user_id)
+    assert call_map["get_all_permission_list"] == 0
+    assert get_applying_permission_count(keycloak_user_policy_id, policy_name_list) == 0
+
+    keycloak_utils.delete_user(keycloak_user_id)
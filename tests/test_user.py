@@ -1,7 +1,10 @@
 import json
 import pytest
 
-from utils import jqutils
+from utils import jqutils, jqcache, email_outbox
+from utils.settings import get_settings
+from user_management import user_ninja, user_management
+from access_management import access_ninja
 from sqlalchemy import text
 
 base_api_url = "/api"
@@ -20,18 +23,25 @@ def do_check_username_availability(client, headers, payload):
     response = client.post(base_api_url + "/username-availability", json=payload, headers=headers)
     return response
 
-def do_get_user(client, headers, user_id):
+def do_get_user(client, headers, user_id, query_string=None):
     """
     Get user
     """
-    response = client.get(base_api_url + f"/user/{user_id}", headers=headers)
+    response = client.get(base_api_url + f"/user/{user_id}", headers=headers, query_string=query_string)
     return response
 
-def do_get_users(client, headers):
+def do_bulk_add_users(client, headers, payload):
+    """
+    Bulk add users
+    """
+    response = client.post(base_api_url + "/users/bulk", json=payload, headers=headers)
+    return response
+
+def do_get_users(client, headers, query_string=None):
     """
     Get users
     """
-    response = client.get(base_api_url + "/users", headers=headers)
+    response = client.get(base_api_url + "/users", headers=headers, query_string=query_string)
     return response
 
 def do_update_user(client, headers, user_id, payload):
@@ -48,6 +58,13 @@ def do_delete_user(client, headers, user_id):
     response = client.delete(base_api_url + f"/user/{user_id}", headers=headers)
     return response
 
+def do_delete_users(client, headers, payload):
+    """
+    Delete users
+    """
+    response = client.delete(base_api_url + "/users", headers=headers, json=payload)
+    return response
+
 def do_verify_user_otp(client, headers, user_id, payload):
     """
     Verify user otp
@@ -69,6 +86,26 @@ def do_initiate_forgot_password_request(client, headers, payload):
     response = client.post(f'{base_api_url}/forgot-password', headers=headers, json=payload)
     return response
 
+def get_latest_email_payload(recipient_email, email_type):
+    """
+    Only the hash of an OTP is stored, the token itself is in the queued e-mail
+    """
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        SELECT payload
+        FROM email_outbox
+        WHERE recipient_email = :recipient_email
+        AND email_type = :email_type
+        AND meta_status = :meta_status
+        ORDER BY email_outbox_id DESC
+    """)
+    with db_engine.connect() as conn:
+        result = conn.execute(query, recipient_email=recipient_email, email_type=email_type, meta_status="active").fetchone()
+        assert result, "email not found in outbox"
+
+    return json.loads(result["payload"])
+
 def do_get_forgot_password_request(client, headers, otp):
     """
     Get forgot password request
@@ -138,6 +175,84 @@ def test_add_user(client, content_team_headers):
     global user_id
     user_id = data["user_id"]
 
+def test_add_user_enqueues_signup_email(client, content_team_headers):
+    """
+    Test: the signup e-mail is written to the outbox instead of being sent inline
+    """
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        SELECT email_type, payload
+        FROM email_outbox
+        WHERE recipient_email = :recipient_email
+        AND email_type = :email_type
+        AND meta_status = :meta_status
+    """)
+    with db_engine.connect() as conn:
+        result = conn.execute(query, recipient_email="john.doe@something.com", email_type="user_signup", meta_status="active").fetchone()
+        assert result, "signup email not found in outbox"
+
+    payload = json.loads(result["payload"])
+    assert f"/user-signup/{user_id}?otp=" in payload["verification_link"]
+
+def claim_test_email(email_type, recipient_email, attempt_count=0):
+    """
+    Enqueues one e-mail and claims only that row, other tests still read their queued payloads
+    """
+    email_outbox_id = email_outbox.enqueue_email(email_type, recipient_email, {"otp": "123456"})
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        UPDATE email_outbox
+        SET outbox_status = :outbox_status, attempt_count = :attempt_count, claim_token = :claim_token
+        WHERE email_outbox_id = :email_outbox_id
+    """)
+    with db_engine.connect() as conn:
+        conn.execute(query, outbox_status="sending", attempt_count=attempt_count, claim_token=f"test-{email_outbox_id}", email_outbox_id=email_outbox_id)
+
+    query = text("""
+        SELECT email_outbox_id, email_type, recipient_email, payload, attempt_count, claim_token
+        FROM email_outbox
+        WHERE email_outbox_id = :email_outbox_id
+    """)
+    with db_engine.connect() as conn:
+        return dict(conn.execute(query, email_outbox_id=email_outbox_id).fetchone())
+
+def get_email_outbox_row(email_outbox_id):
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        SELECT outbox_status, payload
+        FROM email_outbox
+        WHERE email_outbox_id = :email_outbox_id
+    """)
+    with db_engine.connect() as conn:
+        return dict(conn.execute(query, email_outbox_id=email_outbox_id).fetchone())
+
+def test_delivered_email_payload_is_cleared(client, content_team_headers, monkeypatch):
+    """
+    Test: the OTP leaves the outbox with the e-mail, sent and finally failed rows keep no payload
+    """
+    monkeypatch.setattr(email_outbox.aws_utils, "publish_email", lambda **kwargs: None)
+    one_email = claim_test_email("forgot_password", "outbox.sent@something.com")
+    assert email_outbox.deliver_email(one_email)
+    assert get_email_outbox_row(one_email["email_outbox_id"]) == {"outbox_status": "sent", "payload": None}
+
+    def fail_publish_email(**kwargs):
+        raise RuntimeError("ses is down")
+    monkeypatch.setattr(email_outbox.aws_utils, "publish_email", fail_publish_email)
+
+    # a retry still needs the payload
+    one_email = claim_test_email("forgot_password", "outbox.retry@something.com")
+    assert not email_outbox.deliver_email(one_email)
+    email_outbox_row = get_email_outbox_row(one_email["email_outbox_id"])
+    assert email_outbox_row["outbox_status"] == "pending"
+    assert json.loads(email_outbox_row["payload"]) == {"otp": "123456"}
+
+    one_email = claim_test_email("forgot_password", "outbox.failed@something.com", get_settings().email_outbox_max_attempts - 1)
+    assert not email_outbox.deliver_email(one_email)
+    assert get_email_outbox_row(one_email["email_outbox_id"]) == {"outbox_status": "failed", "payload": None}
+
 def test_check_username_availability(client, content_team_headers):
     payload = {
         "username": "john.doe"
@@ -184,6 +299,21 @@ def test_get_user_before_complete_signup(client, content_team_headers):
     assert data["role_list"]
     assert data["brand_profile_list"]
 
+def test_get_user_projection(client, content_team_headers):
+    global user_id
+
+    response = do_get_user(client, content_team_headers, user_id, query_string={"fields": "email", "include": "role_list"})
+    assert response.status_code == 200
+
+    response_json = response.get_json()
+    assert response_json["status"] == "successful"
+
+    data = response_json["data"]
+    assert data["email"]
+    assert data["role_list"]
+    assert "first_names_en" not in data
+    assert "brand_profile_list" not in data
+
 def test_get_users(client, content_team_headers, existing_user_count):
     """
     Test: Get Users
@@ -199,6 +329,21 @@ def test_get_users(client, content_team_headers, existing_user_count):
     expected_user_count = existing_user_count + 1
     assert len(response_data) == expected_user_count, f"User List should have {expected_user_count} item."
 
+def test_get_users_include(client, content_team_headers):
+    """
+    Test: Get Users with hydrated relations
+    """
+    response = do_get_users(client, content_team_headers, query_string={"include": "role_list,brand_profile_list"})
+    assert response.status_code == 200
+
+    response_json = json.loads(response.data)
+    assert response_json["status"] == "successful"
+
+    for one_user in response_json["data"]:
+        assert "role_list" in one_user
+        assert "brand_profile_list" in one_user
+        assert "user_image_list" not in one_user
+
 def test_update_user(client, content_team_headers):
     global user_id
 
@@ -224,21 +369,114 @@ def test_update_user(client, content_team_headers):
     assert response_json["status"] == "successful"
     assert response_json["action"] == "update_user"
 
+def test_get_user_projection_is_not_cached(client, content_team_headers):
+    """
+    Test: a projected request on an uncached profile reads only its projection and does not fill the cache
+    """
+    global user_id
+
+    response = client.get(base_api_url + "/healthcheck/user-profile-cache", headers=content_team_headers)
+    cache_size = response.get_json()["data"]["local"]["size"]
+
+    response = do_get_user(client, content_team_headers, user_id, query_string={"fields": "last_name_en", "include": "role_list"})
+    assert response.status_code == 200
+    data = response.get_json()["data"]
+    assert data == {
+        "user_id": user_id,
+        "last_name_en": "Doe-1",
+        "role_list": data["role_list"]
+    }
+    assert [one_role["role_id"] for one_role in data["role_list"]] == [1]
+
+    response = client.get(base_api_url + "/healthcheck/user-profile-cache", headers=content_team_headers)
+    assert response.get_json()["data"]["local"]["size"] == cache_size
+
+def test_get_user_projection_order_shares_one_statement(client, content_team_headers):
+    """
+    Test: the same projection asked in another order reuses the cached statement
+    """
+    global user_id
+
+    user_ninja.load_user_aggregate(user_id, ["email", "username"], ["user_image_list", "role_list"])
+    misses = jqutils.get_statement_cache_stats()["misses"]
+
+    user_dict = user_ninja.load_user_aggregate(user_id, ["username", "email"], ["role_list", "user_image_list"])
+    assert jqutils.get_statement_cache_stats()["misses"] == misses
+    assert list(user_dict) == ["user_id", "username", "email", "role_list", "user_image_list"]
+
+def test_get_user_after_update(client, content_team_headers):
+    """
+    Test: the cached profile is invalidated by update_user
+    """
+    global user_id
+
+    response = do_get_user(client, content_team_headers, user_id)
+    assert response.status_code == 200
+
+    data = response.get_json()["data"]
+    assert data["last_name_en"] == "Doe-1"
+    assert [one_role["role_id"] for one_role in data["role_list"]] == [1]
+
+def test_get_user_does_not_cache_a_profile_invalidated_while_loading(client, content_team_headers, monkeypatch):
+    """
+    Test: a profile loaded before a concurrent write commits is not stored after the write's invalidation
+    """
+    global user_id
+
+    cache_key = (1, user_id)
+    user_ninja.USER_PROFILE_CACHE.invalidate(cache_key)
+    load_user_aggregate = user_ninja.load_user_aggregate
+
+    def load_then_invalidate(*args, **kwargs):
+        user_profile = load_user_aggregate(*args, **kwargs)
+        # a writer commits and invalidates while this reader is still loading
+        user_ninja.USER_PROFILE_CACHE.invalidate(cache_key)
+        return user_profile
+
+    monkeypatch.setattr(user_ninja, "load_user_aggregate", load_then_invalidate)
+    stale_fill_count = user_ninja.USER_PROFILE_CACHE.stats()["stale_fill_count"]
+
+    response = do_get_user(client, content_team_headers, user_id)
+    assert response.status_code == 200
+    assert response.get_json()["data"]["last_name_en"] == "Doe-1"
+
+    assert user_ninja.USER_PROFILE_CACHE.get(cache_key) is None
+    assert user_ninja.USER_PROFILE_CACHE.stats()["stale_fill_count"] == stale_fill_count + 1
+
+def test_profile_invalidated_by_another_worker_is_not_served(client, content_team_headers):
+    """
+    Test: a local copy is dropped once another process invalidates the profile, or expires quickly without Redis
+    """
+    worker_cache = user_ninja.build_user_profile_cache(get_settings())
+    other_worker_cache = user_ninja.build_user_profile_cache(get_settings())
+
+    cache_key = (1, "cross-worker-test")
+    worker_cache.set_if_generation(cache_key, {"email": "old@something.com"}, worker_cache.get_generation(cache_key))
+    assert worker_cache.get(cache_key) == {"email": "old@something.com"}
+
+    other_worker_cache.invalidate(cache_key)
+    if get_settings().redis_url:
+        assert worker_cache.get(cache_key) is None
+        assert worker_cache.stats()["stale_hit_count"] == 1
+    else:
+        assert worker_cache.stats()["local"]["ttl_seconds"] <= jqcache.LOCAL_ONLY_MAX_TTL_SECONDS
+
 def test_verify_user_otp(client, content_team_headers):
     global user_id
 
     db_engine = jqutils.get_db_engine()
 
     query = text("""
-        SELECT otp, otp_request_count
+        SELECT otp_hash, otp_request_count
         FROM one_time_password
         WHERE user_id = :user_id
     """)
     with db_engine.connect() as conn:
         result = conn.execute(query, user_id=user_id).fetchone()
         assert result, "OTP not found in DB"
+        assert result["otp_hash"]
 
-    otp = result["otp"]
+    otp = get_latest_email_payload("john.doe@something.com", "user_signup")["verification_link"].split("otp=")[1]
     otp_request_count = result["otp_request_count"]
     assert otp_request_count == 1
 
@@ -348,7 +586,7 @@ def test_get_forgot_password_request_successfully(client, content_team_headers):
     intent = 'forgot_password'
 
     query = text("""
-        SELECT otp
+        SELECT one_time_password_id
         FROM one_time_password
         WHERE otp_status = :otp_status
         AND contact_method = :contact_method
@@ -360,7 +598,8 @@ def test_get_forgot_password_request_successfully(client, content_team_headers):
     with db_engine.connect() as conn:
         result = conn.execute(query, otp_status=otp_status, contact_method=contact_method, user_id=user_id, intent=intent, meta_status='active').fetchone()
         assert result, "failed to get otp"
-        otp = result["otp"]
+
+    otp = get_latest_email_payload("john.doe@something.com", "forgot_password")["otp"]
     
     response = do_get_forgot_password_request(client, content_team_headers, otp)
     assert response.status_code == 200
@@ -380,7 +619,7 @@ def test_reset_password_using_otp_successful(client, content_team_headers):
     intent = 'forgot_password'
 
     query = text("""
-        SELECT otp
+        SELECT one_time_password_id
         FROM one_time_password
         WHERE otp_status = :otp_status
         AND contact_method = :contact_method
@@ -392,7 +631,8 @@ def test_reset_password_using_otp_successful(client, content_team_headers):
     with db_engine.connect() as conn:
         result = conn.execute(query, otp_status=otp_status, contact_method=contact_method, user_id=user_id, intent=intent, meta_status='active').fetchone()
         assert result, "failed to get otp"
-        otp = result["otp"]
+
+    otp = get_latest_email_payload("john.doe@something.com", "forgot_password")["otp"]
     
     payload = {
         "otp": otp,
@@ -480,6 +720,97 @@ def test_update_all_brand_access_user(client, content_team_headers):
     assert response_json["status"] == "successful"
     assert response_json["action"] == "update_user"
 
+def test_all_brand_access_is_stored_once(client, content_team_headers):
+    global all_brand_access_user_id
+
+    db_engine = jqutils.get_db_engine()
+
+    query = text("""
+        SELECT brand_profile_id, module_access_id
+        FROM user_brand_profile_module_access
+        WHERE user_id = :user_id
+        AND meta_status = :meta_status
+    """)
+    with db_engine.connect() as conn:
+        result = conn.execute(query, user_id=all_brand_access_user_id, meta_status="active").fetchall()
+
+    assert [(row["brand_profile_id"], row["module_access_id"]) for row in result] == [(None, 2)]
+
+    query = text("""
+        SELECT COUNT(1) AS cnt
+        FROM brand_profile
+        WHERE meta_status = :meta_status
+    """)
+    with db_engine.connect() as conn:
+        brand_profile_count = conn.execute(query, meta_status="active").fetchone()["cnt"]
+
+    response = do_get_user(client, content_team_headers, all_brand_access_user_id)
+    data = response.get_json()["data"]
+    assert len(data["brand_profile_list"]) == brand_profile_count
+    for brand_profile in data["brand_profile_list"]:
+        assert [module_access["module_access_id"] for module_access in brand_profile["module_access_list"]] == [2]
+
+def test_get_all_brand_access_user_effective_access(client, content_team_headers):
+    global all_brand_access_user_id
+
+    response = client.get(base_api_url + f"/user/{all_brand_access_user_id}/effective-access", headers=content_team_headers)
+    assert response.status_code == 200
+
+    response_json = response.get_json()
+    assert response_json["status"] == "successful"
+    assert response_json["action"] == "get_user_effective_access"
+    assert response_json["data"]["all_brand_profiles_bitmask"] == format(1 << 2, "x")
+
+    payload = {
+        "check_list": [
+            {"user_id": all_brand_access_user_id, "brand_profile_id": 1, "module_access_id": 2},
+            {"user_id": all_brand_access_user_id, "brand_profile_id": 1, "module_access_id": 1}
+        ]
+    }
+    response = client.post(base_api_url + "/access/check", json=payload, headers=content_team_headers)
+    assert response.status_code == 200
+
+    response_json = response.get_json()
+    assert response_json["status"] == "successful"
+    assert response_json["data"]["allowed_p_list"] == [True, False]
+
+def test_effective_access_holds_any_module_access_id(client, content_team_headers):
+    """
+    Test: a module_access_id far past a bitmask column's width is granted and revoked, repeated rebuilds upsert the rows
+    """
+    global all_brand_access_user_id
+
+    grant_id = jqutils.bulk_insert_db_entries([{
+        "user_id": all_brand_access_user_id,
+        "brand_profile_id": 1,
+        "module_access_id": 5000,
+        "meta_status": "active"
+    }], "user_brand_profile_module_access", capture_tenant=False)[0]
+    access_ninja.rebuild_user_effective_access([all_brand_access_user_id])
+    access_ninja.rebuild_user_effective_access([all_brand_access_user_id])
+
+    payload = {"check_list": [{"user_id": all_brand_access_user_id, "brand_profile_id": 1, "module_access_id": 5000}]}
+    response = client.post(base_api_url + "/access/check", json=payload, headers=content_team_headers)
+    assert response.get_json()["data"]["allowed_p_list"] == [True]
+
+    response = client.get(base_api_url + f"/user/{all_brand_access_user_id}/effective-access", headers=content_team_headers)
+    assert response.get_json()["data"]["brand_profile_module_access_id_map"]["1"] == [5000]
+
+    query = text("""
+        UPDATE user_brand_profile_module_access
+        SET meta_status = :meta_status
+        WHERE user_brand_profile_module_access_id = :grant_id
+    """)
+    with jqutils.get_db_engine().connect() as conn:
+        conn.execute(query, meta_status="deleted", grant_id=grant_id)
+    access_ninja.rebuild_user_effective_access([all_brand_access_user_id])
+
+    response = client.post(base_api_url + "/access/check", json=payload, headers=content_team_headers)
+    assert response.get_json()["data"]["allowed_p_list"] == [False]
+
+    response = client.get(base_api_url + f"/user/{all_brand_access_user_id}/effective-access", headers=content_team_headers)
+    assert "1" not in response.get_json()["data"]["brand_profile_module_access_id_map"]
+
 def test_get_all_brand_access_user(client, content_team_headers):
     global all_brand_access_user_id
 
@@ -521,4 +852,171 @@ def test_delete_all_brand_access_user(client, content_team_headers, existing_use
     assert response_json["action"] == "get_users"
 
     data = response_json["data"]
-    assert len(data) == existing_user_count, f"User List should have {existing_user_count} item."
\ No newline at end of file
+    assert len(data) == existing_user_count, f"User List should have {existing_user_count} item."
+def test_bulk_add_users(client, content_team_headers, existing_user_count):
+    user_spec = {
+        "first_names_en": "Jane",
+        "last_name_en": "Doe",
+        "first_names_ar": "جين",
+        "last_name_ar": "دو",
+        "phone_nr": "1234567890",
+        "role_id_list": [1],
+        "brand_profile_list": [
+            {
+                "brand_profile_id": 1,
+                "module_access_id_list": [1]
+            }
+        ]
+    }
+    payload = {
+        "user_list": [
+            {**user_spec, "email": "jane.doe.1@something.com"},
+            {**user_spec, "email": "jane.doe.2@something.com"},
+            {**user_spec, "email": "jane.doe.2@something.com"},
+            {**user_spec, "email": "jane.doe.3@something.com", "role_id_list": [999999]}
+        ]
+    }
+    response = do_bulk_add_users(client, content_team_headers, payload)
+    assert response.status_code == 200
+
+    response_json = response.get_json()
+    assert response_json["status"] == "successful"
+    assert response_json["action"] == "bulk_add_users"
+
+    data = response_json["data"]
+    assert data["created_count"] == 2
+    assert data["failed_count"] == 2
+    assert [one_result["status"] for one_result in data["result_list"]] == ["created", "created", "invalid", "invalid"]
+
+    for one_result in data["result_list"][:2]:
+        response = do_get_user(client, content_team_headers, one_result["user_id"])
+        assert response.get_json()["data"]["role_list"][0]["role_id"] == 1
+
+        response = do_delete_user(client, content_team_headers, one_result["user_id"])
+        assert response.get_json()["status"] == "successful"
+
+def test_bulk_add_users_reports_malformed_rows(client, content_team_headers, existing_user_count):
+    user_spec = {
+        "first_names_en": "Joan",
+        "last_name_en": "Doe",
+        "first_names_ar": "جوان",
+        "last_name_ar": "دو",
+        "phone_nr": "1234567890",
+        "email": "joan.doe@something.com",
+        "role_id_list": [1],
+        "brand_profile_list": [
+            {
+                "brand_profile_id": 1,
+                "module_access_id_list": [1]
+            }
+        ]
+    }
+    missing_role_spec = {key: value for key, value in user_spec.items() if key != "role_id_list"}
+    payload = {
+        "user_list": [
+            {**missing_role_spec, "email": "joan.doe.1@something.com"},
+            {**user_spec, "email": "joan.doe.2@something.com", "brand_profile_list": [{"brand_profile_id": 1}]},
+            {**user_spec, "email": "joan.doe.3@something.com", "role_id_list": ["1"]},
+            {**user_spec, "email": "joan.doe.4@something.com", "role_id_list": [[1]]},
+            {**user_spec, "email": "joan.doe.5@something.com", "brand_profile_list": None},
+            "not a user",
+            user_spec
+        ]
+    }
+    response = do_bulk_add_users(client, content_team_headers, payload)
+    assert response.status_code == 200
+
+    data = response.get_json()["data"]
+    assert data["created_count"] == 1
+    assert [one_result["status"] for one_result in data["result_list"]] == ["invalid"] * 6 + ["created"]
+    assert data["result_list"][0]["message"] == "missing fields: role_id_list"
+    assert all(one_result["message"] for one_result in data["result_list"][:6])
+
+    response = do_delete_user(client, content_team_headers, data["result_list"][6]["user_id"])
+    assert response.get_json()["status"] == "successful"
+
+def test_bulk_add_users_hides_database_errors(client, content_team_headers, existing_user_count, monkeypatch):
+    """
+    Test: a failing chunk reports a generic code, and a transaction MySQL already rolled back fails the whole batch
+    """
+    user_spec = {
+        "first_names_en": "June",
+        "last_name_en": "Doe",
+        "first_names_ar": "جون",
+        "last_name_ar": "دو",
+        "phone_nr": "1234567890",
+        "role_id_list": [1],
+        "brand_profile_list": [
+            {
+                "brand_profile_id": 1,
+                "module_access_id_list": [1]
+            }
+        ]
+    }
+    payload = {"user_list": [{**user_spec, "email": f"june.doe.{row_index}@something.com"} for row_index in range(3)]}
+    monkeypatch.setattr(user_management, "USER_BULK_CHUNK_ROWS", 1)
+
+    create_users = user_ninja.create_users
+    def fail_second_chunk(user_spec_list, creation_user_id, conn):
+        if user_spec_list[0]["email"] == "june.doe.1@something.com":
+            raise RuntimeError("Duplicate entry 'june.doe.1@something.com' for key 'user.email'")
+        return create_users(user_spec_list, creation_user_id, conn)
+    monkeypatch.setattr(user_ninja, "create_users", fail_second_chunk)
+
+    data = do_bulk_add_users(client, content_team_headers, payload).get_json()["data"]
+    assert [one_result["status"] for one_result in data["result_list"]] == ["created", "failed", "created"]
+    assert data["result_list"][1]["message"] == user_management.USER_BULK_CREATE_FAILED
+
+    for one_result in data["result_list"][::2]:
+        response = do_delete_user(client, content_team_headers, one_result["user_id"])
+        assert response.get_json()["status"] == "successful"
+
+    payload = {"user_list": [{**user_spec, "email": f"june.roe.{row_index}@something.com"} for row_index in range(3)]}
+    def abort_transaction(user_spec_list, creation_user_id, conn):
+        if user_spec_list[0]["email"] == "june.roe.1@something.com":
+            conn.execute("ROLLBACK")
+            raise RuntimeError("Deadlock found when trying to get lock; try restarting transaction")
+        return create_users(user_spec_list, creation_user_id, conn)
+    monkeypatch.setattr(user_ninja, "create_users", abort_transaction)
+
+    response = do_bulk_add_users(client, content_team_headers, payload)
+    assert response.status_code == 200
+    data = response.get_json()["data"]
+    assert data["created_count"] == 0
+    assert all(one_result["status"] == "failed" and "user_id" not in one_result for one_result in data["result_list"])
+    assert data["result_list"][0]["message"] == user_management.USER_BULK_TRANSACTION_ABORTED
+
+def test_delete_users(client, content_team_headers, existing_user_count):
+    user_spec = {
+        "first_names_en": "Jim",
+        "last_name_en": "Doe",
+        "first_names_ar": "جيم",
+        "last_name_ar": "دو",
+        "phone_nr": "1234567890",
+        "role_id_list": [1],
+        "brand_profile_list": []
+    }
+    payload = {
+        "user_list": [
+            {**user_spec, "email": "jim.doe.1@something.com"},
+            {**user_spec, "email": "jim.doe.2@something.com"}
+        ]
+    }
+    response = do_bulk_add_users(client, content_team_headers, payload)
+    new_user_id_list = [one_result["user_id"] for one_result in response.get_json()["data"]["result_list"]]
+    assert len(new_user_id_list) == 2
+
+    payload = {
+        "user_id_list": new_user_id_list + [999999]
+    }
+    response = do_delete_users(client, content_team_headers, payload)
+    assert response.status_code == 200
+
+    response_json = response.get_json()
+    assert response_json["status"] == "successful"
+    assert response_json["action"] == "delete_users"
+    assert sorted(response_json["data"]["deleted_user_id_list"]) == sorted(new_user_id_list)
+    assert response_json["data"]["skipped_user_id_list"] == [999999]
+
+    response = do_get_users(client, content_team_headers)
+    assert len(response.get_json()["data"]) == existing_user_count
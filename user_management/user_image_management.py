@@ -1,8 +1,8 @@
 import os
 
-from sqlalchemy import text
 from flask import Blueprint, request, jsonify, g
-from utils import jqutils, jqimage_uploader
+from utils import jqutils, jqimage_uploader, settings
+from user_management import user_ninja
 
 user_image_management_blueprint = Blueprint('user_image_management', __name__)
 
@@ -34,27 +34,27 @@ def add_user_image():
     
     assert file_extension in allowed_filename_extension_list, "invalid file extension"
     
-    image_bucket_name = os.getenv("S3_BUCKET_NAME")
+    image_bucket_name = settings.get_settings().s3_bucket_name
     image_object_key = f"user-images/{user_id}/{filename}_{action_timestamp}.{file_extension}"
 
     # Upload image to S3 if not mocking
-    if os.getenv("MOCK_S3_UPLOAD") != '1':    
+    if settings.get_settings().mock_s3_upload != '1':    
         is_uploaded = jqimage_uploader.upload_fileobj(user_image, image_bucket_name, image_object_key)
         assert is_uploaded, "failed to upload item image to S3"
         user_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
     else:
         user_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
 
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
+    query = jqutils.cached_text("""
         INSERT INTO user_image (user_id, image_type, image_bucket_name, image_object_key, meta_status, creation_user_id)
         VALUES (:user_id, :image_type, :image_bucket_name, :image_object_key, :meta_status, :creation_user_id)
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         user_image_id = conn.execute(query, user_id=user_id, image_type=image_type, image_bucket_name=image_bucket_name, image_object_key=image_object_key, meta_status='active', creation_user_id=g.user_id).lastrowid
         assert user_image_id, "failed to insert user image"
 
+    user_ninja.invalidate_user_profile(user_id)
+
     response_body = {
         "data": {
             "user_image_id": user_image_id,
@@ -69,16 +69,14 @@ def add_user_image():
 def get_user_image(user_image_id):
     user_image_id = int(user_image_id)
     
-    db_engine = jqutils.get_db_engine()
-    
     # get existing user image
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT user_image_id, image_bucket_name, image_object_key, image_type
         FROM user_image
         WHERE user_image_id = :user_image_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, user_image_id=user_image_id, meta_status='active').fetchone()
         assert result, "failed to get user_image details"
 
@@ -87,7 +85,7 @@ def get_user_image(user_image_id):
     image_bucket_name = result['image_bucket_name']
     image_object_key = result['image_object_key']
 
-    if os.getenv("MOCK_S3_UPLOAD") != '1':
+    if settings.get_settings().mock_s3_upload != '1':
         user_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
     else:
         user_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
@@ -114,17 +112,15 @@ def get_user_images_by_user(user_id):
     if image_type:
         image_type_filter_statement = f"AND image_type = '{image_type}'"
     
-    db_engine = jqutils.get_db_engine()
-    
     # get user_image details
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT user_image_id, image_bucket_name, image_object_key, image_type
         FROM user_image
         WHERE user_id = :user_id
         {image_type_filter_statement}
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         results = conn.execute(query, user_id=user_id, meta_status='active').fetchall()
     
     user_image_list = []
@@ -134,7 +130,7 @@ def get_user_images_by_user(user_id):
         image_bucket_name = user_image['image_bucket_name']
         image_object_key = user_image['image_object_key']
 
-        if os.getenv("MOCK_S3_UPLOAD") != '1':
+        if settings.get_settings().mock_s3_upload != '1':
             user_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
         else:
             user_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
@@ -162,16 +158,14 @@ def update_user_image(user_image_id):
     image_type = request_dict["image_type"]
     user_image = request.files['user_image']
 
-    db_engine = jqutils.get_db_engine()
-    
     # get existing user image
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT user_id, image_bucket_name, image_object_key
         FROM user_image
         WHERE user_image_id = :user_image_id
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, user_image_id=user_image_id, meta_status='active').fetchone()
         assert result, "failed to get user_image details"
 
@@ -188,11 +182,11 @@ def update_user_image(user_image_id):
     
     assert file_extension in allowed_filename_extension_list, "invalid file extension"
     
-    image_bucket_name = os.getenv("S3_BUCKET_NAME")
+    image_bucket_name = settings.get_settings().s3_bucket_name
     image_object_key = f"user-images/{user_id}/{filename}_{action_timestamp}.{file_extension}"
 
     # Upload image to S3 if not mocking
-    if os.getenv("MOCK_S3_UPLOAD") != '1':
+    if settings.get_settings().mock_s3_upload != '1':
             
         is_uploaded = jqimage_uploader.upload_fileobj(user_image, image_bucket_name, image_object_key)
         assert is_uploaded, "failed to upload item image to S3"
@@ -204,7 +198,7 @@ def update_user_image(user_image_id):
     else:
         user_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
 
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE user_image
         SET image_type = :image_type,
         image_bucket_name = :image_bucket_name,
@@ -212,10 +206,12 @@ def update_user_image(user_image_id):
         modification_user_id = :modification_user_id
         WHERE user_image_id = :user_image_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, image_type=image_type, image_bucket_name=image_bucket_name, image_object_key=image_object_key, modification_user_id=g.user_id, user_image_id=user_image_id).rowcount
         assert result, "failed to update user image"
 
+    user_ninja.invalidate_user_profile(user_id)
+
     response_body = {
         "data": {
             "user_image_id": user_image_id,
@@ -230,39 +226,40 @@ def update_user_image(user_image_id):
 def delete_user_image(user_image_id):
     user_image_id = int(user_image_id)
     
-    db_engine = jqutils.get_db_engine()
-    
     # get existing user image
-    query = text(f"""
-        SELECT image_bucket_name, image_object_key, meta_status
+    query = jqutils.cached_text(f"""
+        SELECT user_id, image_bucket_name, image_object_key, meta_status
         FROM user_image
         WHERE user_image_id = :user_image_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, user_image_id=user_image_id, meta_status='active').fetchone()
         assert result, "failed to get user_image details"
 
     action_timestamp = jqutils.get_utc_datetime()
+    user_id = result['user_id']
     image_bucket_name = result['image_bucket_name']
     image_object_key = result['image_object_key']
     meta_status = result['meta_status']
 
     if meta_status != "deleted":
         
-        if os.getenv("MOCK_S3_UPLOAD") != '1':
+        if settings.get_settings().mock_s3_upload != '1':
             jqimage_uploader.delete_object_from_bucket(image_bucket_name, image_object_key)
         
-        query = text("""
+        query = jqutils.cached_text("""
             UPDATE user_image
             SET meta_status = :meta_status,
             deletion_user_id = :deletion_user_id,
             deletion_timestamp = :deletion_timestamp
             WHERE user_image_id = :user_image_id
         """)
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             result = conn.execute(query, meta_status='deleted', deletion_user_id=g.user_id, user_image_id=user_image_id, deletion_timestamp=action_timestamp).rowcount
             assert result, "failed to update user image"
 
+        user_ninja.invalidate_user_profile(user_id)
+
     response_body = {
         "data": {
             "user_image_id": user_image_id
@@ -1,20 +1,27 @@
 import os
 import uuid
+import logging
+import secrets
 
-from sqlalchemy import text
 from datetime import datetime, timedelta
 from flask import Blueprint, request, jsonify, g
-from utils import keycloak_utils, jqutils, jqimage_uploader, aws_utils
+from utils import keycloak_utils, jqutils, jqimage_uploader, aws_utils, settings, email_outbox, availability_index
 from user_management import user_ninja
+from access_management import access_ninja
 
 user_management_blueprint = Blueprint('user_management', __name__)
 
+USER_BULK_MAX_ROWS = 10000
+USER_BULK_CHUNK_ROWS = 500
+USER_BULK_CREATE_FAILED = "create_failed"
+USER_BULK_TRANSACTION_ABORTED = "transaction_aborted"
+
 @user_management_blueprint.route('/username-availability', methods = ['POST'])
 def check_username_availability():
     request_json = request.get_json()
     username = request_json["username"]
 
-    available_p = user_ninja.check_username_availability(username)
+    available_p = user_ninja.check_username_availability(username, indexed_p=True)
 
     response_body = {
         "data": {
@@ -40,78 +47,23 @@ def add_user():
     all_brand_profile_access_p = request_json.get("all_brand_profile_access_p", False)
     global_module_access_id_list = request_json.get("module_access_id_list", [])
 
-    db_engine = jqutils.get_db_engine()
-    
-    with db_engine.connect() as conn:
-        
-        # create user
-        query = text("""
-            INSERT INTO user (first_names_en, last_name_en, first_names_ar, last_name_ar, phone_nr, email, all_brand_profile_access_p, meta_status, creation_user_id)
-            VALUES (:first_names_en, :last_name_en, :first_names_ar, :last_name_ar, :phone_nr, :email, :all_brand_profile_access_p, :meta_status, :creation_user_id)
-        """)
-        user_id = conn.execute(query, first_names_en=first_names_en, last_name_en=last_name_en, first_names_ar=first_names_ar, last_name_ar=last_name_ar,
-                    phone_nr=phone_nr, email=email, all_brand_profile_access_p=all_brand_profile_access_p, meta_status="active", creation_user_id=g.user_id).lastrowid
-        assert user_id, "failed to create user"
-
-        # create user roles
-        query_params = ""
-        for role_id in role_id_list:
-            query_params += f"({user_id}, {role_id}, 'active', {g.user_id}),"
-        
-        if query_params:
-            query_params = query_params[:-1]
-            
-            query = text(f"""
-                INSERT INTO user_role_map (user_id, role_id, meta_status, creation_user_id)
-                VALUES {query_params}
-            """)
-            results = conn.execute(query).rowcount
-            assert results == len(role_id_list), "failed to create user roles"
-
-        # allow access to user for all modules across all brand profiles
-        if all_brand_profile_access_p:
-            query_params = ""
-            for module_access_id in global_module_access_id_list:
-                query_params += f"({user_id}, NULL, {module_access_id}, 'active', {g.user_id}),"
-
-            if query_params:
-                query_params = query_params[:-1]
-                
-                query = text(f"""
-                    INSERT INTO user_brand_profile_module_access (user_id, brand_profile_id, module_access_id, meta_status, creation_user_id)
-                    VALUES {query_params}
-                """)
-                results = conn.execute(query).rowcount
-                assert results == len(global_module_access_id_list), "failed to create user brand profile module access"
-
-        # allow brand-specific access to user
-        else:
-            query_params = ""
-            for brand_profile in brand_profile_list:
-                brand_profile_id = brand_profile["brand_profile_id"]
-                module_access_id_list = brand_profile["module_access_id_list"]
-
-                for module_access_id in module_access_id_list:
-                    query_params += f"({user_id}, {brand_profile_id}, {module_access_id}, 'active', {g.user_id}),"
-
-            if query_params:
-                query_params = query_params[:-1]
-                
-                query = text(f"""
-                    INSERT INTO user_brand_profile_module_access (user_id, brand_profile_id, module_access_id, meta_status, creation_user_id)
-                    VALUES {query_params}
-                """)
-                results = conn.execute(query).rowcount
-                assert results == len(module_access_id_list), "failed to create user brand profile module access"
-
-        # dispatch email to user for completing signup
-        userdata = {
-            "user_id": user_id,
-            "first_names_en": first_names_en,
-            "last_name_en": last_name_en,
-            "email": email
-        }
-        user_ninja.send_user_signup_email(userdata, g.user_id)
+    user_spec = {
+        "first_names_en": first_names_en,
+        "last_name_en": last_name_en,
+        "first_names_ar": first_names_ar,
+        "last_name_ar": last_name_ar,
+        "phone_nr": phone_nr,
+        "email": email,
+        "role_id_list": role_id_list,
+        "brand_profile_list": brand_profile_list,
+        "all_brand_profile_access_p": all_brand_profile_access_p,
+        "module_access_id_list": global_module_access_id_list
+    }
+
+    # create user with roles and access, and queue the signup email
+    with jqutils.get_db_connection() as conn:
+        user_id = user_ninja.create_users([user_spec], g.user_id, conn)[0]
+        access_ninja.rebuild_user_effective_access([user_id], conn)
 
     response_body = {
         "data": {
@@ -123,6 +75,66 @@ def add_user():
 
     return jsonify(response_body)
 
+@user_management_blueprint.route('/users/bulk', methods=['POST'])
+def bulk_add_users():
+    request_json = request.get_json()
+    user_spec_list = request_json["user_list"]
+
+    assert isinstance(user_spec_list, list), "user_list must be a list"
+    assert len(user_spec_list) <= USER_BULK_MAX_ROWS, f"at most {USER_BULK_MAX_ROWS} users per request"
+
+    error_list = user_ninja.validate_user_spec_list(user_spec_list)
+    result_list = [{
+        "row_index": row_index,
+        "status": "invalid" if error else "pending",
+        "message": error
+    } for row_index, error in enumerate(error_list)]
+
+    # every chunk is all-or-nothing, a failing chunk does not undo the others
+    valid_row_index_list = [row_index for row_index, error in enumerate(error_list) if error is None]
+    for chunk_start in range(0, len(valid_row_index_list), USER_BULK_CHUNK_ROWS):
+        chunk_row_index_list = valid_row_index_list[chunk_start:chunk_start + USER_BULK_CHUNK_ROWS]
+
+        with jqutils.get_db_connection() as conn:
+            savepoint = conn.begin_nested()
+            try:
+                user_id_list = user_ninja.create_users([user_spec_list[row_index] for row_index in chunk_row_index_list], g.user_id, conn)
+                access_ninja.rebuild_user_effective_access(user_id_list, conn)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("bulk_add_users chunk starting at row %s failed", chunk_row_index_list[0])
+                try:
+                    savepoint.rollback()
+                except Exception:  # pylint: disable=broad-except
+                    # MySQL already rolled back the whole transaction (deadlock, lock wait timeout),
+                    # the savepoint is gone and so are the chunks created before this one
+                    logging.exception("bulk_add_users transaction aborted")
+                    jqutils.rollback_request_db_transaction()
+                    for row_index in valid_row_index_list:
+                        result_list[row_index].pop("user_id", None)
+                        result_list[row_index].update({"status": "failed", "message": USER_BULK_TRANSACTION_ABORTED})
+                    break
+
+                for row_index in chunk_row_index_list:
+                    result_list[row_index].update({"status": "failed", "message": USER_BULK_CREATE_FAILED})
+                continue
+            savepoint.commit()
+
+        for row_index, user_id in zip(chunk_row_index_list, user_id_list):
+            result_list[row_index].update({"status": "created", "user_id": user_id})
+
+    created_count = sum(1 for one_result in result_list if one_result["status"] == "created")
+
+    response_body = {
+        "data": {
+            "created_count": created_count,
+            "failed_count": len(result_list) - created_count,
+            "result_list": result_list
+        },
+        "action": "bulk_add_users",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
 @user_management_blueprint.route('/user/<user_id>', methods=['PUT'])
 def update_user(user_id):
 
@@ -158,159 +170,33 @@ def update_user(user_id):
 
     jqutils.update_single_db_entry(one_dict, "user", condition)
 
-    db_engine = jqutils.get_db_engine()
-
-    # delete existing user roles
-    query = text("""
-        SELECT user_role_map_id
-        FROM user_role_map
-        WHERE user_id = :user_id
-        AND meta_status = :meta_status
-    """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-
-    user_role_map_id_list = [row["user_role_map_id"] for row in result]
-
-    for user_role_map_id in user_role_map_id_list:
-
-        one_dict = {
-            "meta_status": "deleted",
-            "deletion_user_id": g.user_id,
-            "deletion_timestamp": jqutils.get_utc_datetime()
-        }
-
-        condition = {
-            "user_role_map_id": str(user_role_map_id)
-        }
-
-        jqutils.update_single_db_entry(one_dict, "user_role_map", condition)
-
-    # add new user roles
-    for role_id in role_id_list:
-        one_dict = {
-            "user_id": user_id,
-            "role_id": role_id,
-            "meta_status": "active",
-            "creation_user_id": g.user_id
-        }
-        jqutils.create_new_single_db_entry(one_dict, "user_role_map")
+    # sync user roles
+    jqutils.sync_mapping("user_role_map", {"user_id": user_id}, role_id_list, ["role_id"])
 
+    # sync user brand profile module access, all brand profile access is stored once as brand_profile_id NULL
+    user_brand_profile_module_access_set = set()
     if all_brand_profile_access_p:
-            
-            # delete existing user brand profile module access
-            query = text("""
-                SELECT user_brand_profile_module_access_id
-                FROM user_brand_profile_module_access
-                WHERE user_id = :user_id
-                AND meta_status = :meta_status
-            """)
-            with db_engine.connect() as conn:
-                result = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-    
-            user_brand_profile_module_access_id_list = [row["user_brand_profile_module_access_id"] for row in result]
-    
-            for user_brand_profile_module_access_id in user_brand_profile_module_access_id_list:
-            
-                one_dict = {
-                    "meta_status": "deleted",
-                    "deletion_user_id": g.user_id,
-                    "deletion_timestamp": jqutils.get_utc_datetime()
-                }
-    
-                condition = {
-                    "user_brand_profile_module_access_id": str(user_brand_profile_module_access_id)
-                }
-    
-                jqutils.update_single_db_entry(one_dict, "user_brand_profile_module_access", condition)
-    
-            # add new user brand profile module access
-            for module_access_id in module_access_id_list:
-    
-                one_dict = {
-                    "user_id": user_id,
-                    "brand_profile_id": None,
-                    "module_access_id": module_access_id,
-                    "meta_status": "active",
-                    "creation_user_id": g.user_id
-                }
-    
-                jqutils.create_new_single_db_entry(one_dict, "user_brand_profile_module_access")
-    
-            # get all brand profiles
-            db_engine = jqutils.get_db_engine()
-    
-            query = text("""
-                SELECT brand_profile_id
-                FROM brand_profile
-                WHERE meta_status = :meta_status
-            """)
-            with db_engine.connect() as conn:
-                result = conn.execute(query, meta_status="active").fetchall()
-    
-            brand_profile_id_list = [row["brand_profile_id"] for row in result]
-    
-            for brand_profile_id in brand_profile_id_list:
-                for module_access_id in module_access_id_list:
-    
-                    one_dict = {
-                        "user_id": user_id,
-                        "brand_profile_id": brand_profile_id,
-                        "module_access_id": module_access_id,
-                        "meta_status": "active",
-                        "creation_user_id": g.user_id
-                    }
-                    jqutils.create_new_single_db_entry(one_dict, "user_brand_profile_module_access")
+        for module_access_id in module_access_id_list:
+            user_brand_profile_module_access_set.add((None, module_access_id))
 
     else:
-
-        # delete existing user brand profile module access
-        query = text("""
-            SELECT user_brand_profile_module_access_id
-            FROM user_brand_profile_module_access
-            WHERE user_id = :user_id
-            AND meta_status = :meta_status
-        """)
-        with db_engine.connect() as conn:
-            result = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-
-        user_brand_profile_module_access_id_list = [row["user_brand_profile_module_access_id"] for row in result]
-
-        for user_brand_profile_module_access_id in user_brand_profile_module_access_id_list:
-        
-            one_dict = {
-                "meta_status": "deleted",
-                "deletion_user_id": g.user_id,
-                "deletion_timestamp": jqutils.get_utc_datetime()
-            }
-
-            condition = {
-                "user_brand_profile_module_access_id": str(user_brand_profile_module_access_id)
-            }
-
-            jqutils.update_single_db_entry(one_dict, "user_brand_profile_module_access", condition)
-
-        # add new user brand profile module access
         for brand_profile in brand_profile_list:
             brand_profile_id = brand_profile["brand_profile_id"]
-            module_access_id_list = brand_profile["module_access_id_list"]
 
-            for module_access_id in module_access_id_list:
+            for module_access_id in brand_profile["module_access_id_list"]:
+                user_brand_profile_module_access_set.add((brand_profile_id, module_access_id))
 
-                one_dict = {
-                    "user_id": user_id,
-                    "brand_profile_id": brand_profile_id,
-                    "module_access_id": module_access_id,
-                    "meta_status": "active",
-                    "creation_user_id": g.user_id
-                }
-                jqutils.create_new_single_db_entry(one_dict, "user_brand_profile_module_access")
+    jqutils.sync_mapping("user_brand_profile_module_access", {"user_id": user_id}, user_brand_profile_module_access_set,
+                            ["brand_profile_id", "module_access_id"])
+    access_ninja.rebuild_user_effective_access([user_id])
 
-    # update user in keycloak
+    # update user in keycloak once the rows are committed, the update is idempotent and only logged on failure
     keycloak_user_id = jqutils.get_column_by_id(user_id, "keycloak_user_id", "user")
-        
+
     if keycloak_user_id:
-        keycloak_utils.update_user(keycloak_user_id, first_names_en, last_name_en, email)
+        jqutils.run_after_commit(lambda: keycloak_utils.update_user(keycloak_user_id, first_names_en, last_name_en, email))
+
+    user_ninja.invalidate_user_profile(user_id)
 
     response_body = {
         "action": "update_user",
@@ -321,126 +207,12 @@ def update_user(user_id):
 @user_management_blueprint.route('/user/<user_id>', methods=['GET'])
 def get_user(user_id):
     user_id = int(user_id)
-    
-    db_engine = jqutils.get_db_engine()
 
-    # get user details
-    query = text("""
-        SELECT keycloak_user_id, username, first_names_en, last_name_en, first_names_ar,
-            last_name_ar, phone_nr, email, all_brand_profile_access_p
-        FROM user
-        WHERE user_id = :user_id
-        AND meta_status = :meta_status
-    """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, user_id=user_id, meta_status="active").fetchone()
-        assert result, "failed to get user details"
+    # optional projection, e.g. ?fields=username,email&include=role_list
+    field_list = user_ninja.parse_projection(request.args.get("fields"), user_ninja.USER_FIELD_LIST, "field")
+    include_list = user_ninja.parse_projection(request.args.get("include"), user_ninja.USER_RELATION_LIST, "include")
 
-    user_dict = {
-        "user_id": user_id,
-        "keycloak_user_id": result["keycloak_user_id"],
-        "username": result["username"],
-        "first_names_en": result["first_names_en"],
-        "last_name_en": result["last_name_en"],
-        "first_names_ar": result["first_names_ar"],
-        "last_name_ar": result["last_name_ar"],
-        "phone_nr": result["phone_nr"],
-        "email": result["email"],
-        "all_brand_profile_access_p": result["all_brand_profile_access_p"],
-        "role_list": [],
-        "user_image_list": [],
-        "module_access_list": [],
-        "brand_profile_list": []
-    }
-
-    # get user roles
-    query = text("""
-        SELECT urm.user_role_map_id, urm.role_id, r.role_name
-        FROM user_role_map urm
-        JOIN role r ON urm.role_id = r.role_id
-        WHERE urm.user_id = :user_id
-        AND urm.meta_status = :meta_status
-    """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-        user_dict["role_list"] = [dict(row) for row in results]
-
-    # get user images
-    query = text("""
-        SELECT user_image_id, image_type, image_bucket_name, image_object_key
-        FROM user_image
-        WHERE user_id = :user_id
-        AND meta_status = :meta_status
-    """)
-    with db_engine.connect() as conn:
-        results = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-        
-        for one_image in results:
-            image_bucket_name = one_image["image_bucket_name"]
-            image_object_key = one_image["image_object_key"]
-                
-            if os.getenv("MOCK_S3_UPLOAD") != '1':
-                user_image_url = jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
-            else:
-                user_image_url = f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
-            
-            user_dict["user_image_list"].append({
-                "user_image_id": one_image["user_image_id"],
-                "image_type": one_image["image_type"],
-                "user_image_url": user_image_url
-            })
-
-    # get all brand profiles module access
-    if user_dict["all_brand_profile_access_p"]:
-        query = text("""
-            SELECT ubpma.module_access_id, m.module_id, m.module_name, ma.module_access_id, ma.access_level
-            FROM user_brand_profile_module_access ubpma
-            JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
-            JOIN module m ON ma.module_id = m.module_id
-            WHERE ubpma.user_id = :user_id
-            AND ubpma.brand_profile_id IS NULL
-            AND ubpma.meta_status = :meta_status
-        """)
-        with db_engine.connect() as conn:
-            results = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-            user_dict["module_access_list"] = [dict(row) for row in results]
-
-    # get brand profile and specific module access
-    query = text("""
-        SELECT ubpma.brand_profile_id, ubpma.module_access_id, bp.brand_profile_name as brand_profile_name, m.module_id, m.module_name, ma.module_access_id, ma.access_level
-        FROM user_brand_profile_module_access ubpma
-        JOIN brand_profile bp ON ubpma.brand_profile_id = bp.brand_profile_id
-        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
-        JOIN module m ON ma.module_id = m.module_id
-        WHERE ubpma.user_id = :user_id
-        AND ubpma.brand_profile_id IS NOT NULL
-        AND ubpma.meta_status = :meta_status
-    """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
-
-    brand_profile_list = []
-    for row in result:
-        brand_profile_id = row["brand_profile_id"]
-
-        brand_profile = next((item for item in brand_profile_list if item["brand_profile_id"] == brand_profile_id), None)
-        if not brand_profile:
-            brand_profile = {
-                "brand_profile_id": brand_profile_id,
-                "brand_profile_name": row["brand_profile_name"],
-                "module_access_list": []
-            }
-            brand_profile_list.append(brand_profile)
-
-        module_access = {
-            "module_id": row["module_id"],
-            "module_name": row["module_name"],
-            "module_access_id": row["module_access_id"],
-            "access_level": row["access_level"]
-        }
-        brand_profile["module_access_list"].append(module_access)
-
-    user_dict["brand_profile_list"] = brand_profile_list
+    user_dict = user_ninja.get_user_profile(user_id, field_list, include_list)
 
     response_body = {
         "data": user_dict,
@@ -452,37 +224,29 @@ def get_user(user_id):
 
 @user_management_blueprint.route('/users', methods=['GET'])
 def get_users():
-    db_engine = jqutils.get_db_engine()
+    limit, after_id, include_total_p = jqutils.get_page_args(request.args)
 
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT user_id, keycloak_user_id, username, first_names_en, last_name_en,
             first_names_ar, last_name_ar, phone_nr, email
         FROM user
         WHERE meta_status = :meta_status
+        AND user_id > :after_id
+        ORDER BY user_id
+        LIMIT :limit
     """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, meta_status="active").fetchall()
-
-    user_list = [dict(row) for row in result]
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, meta_status="active", after_id=after_id, limit=limit + 1).fetchall()
 
-    # get role list for each user
-    for one_user in user_list:
-        user_id = one_user["user_id"]
+    user_list, pagination = jqutils.paginate([dict(row) for row in result], limit, "user_id", "user", include_total_p)
 
-        query = text("""
-            SELECT urm.role_id, r.role_name
-            FROM user_role_map urm
-            JOIN role r ON urm.role_id = r.role_id
-            WHERE urm.user_id = :user_id
-            AND urm.meta_status = :meta_status
-        """)
-        with db_engine.connect() as conn:
-            role_result = conn.execute(query, user_id=user_id, meta_status="active").fetchall()
+    # hydrate relations with one query each, e.g. ?include=role_list,user_image_list
+    include_list = user_ninja.parse_projection(request.args.get("include", "role_list"), user_ninja.USER_RELATION_LIST, "include")
+    user_ninja.hydrate_user_list(user_list, include_list)
 
-        one_user["role_list"] = [dict(role) for role in role_result]
-        
     response_body = {
         "data": user_list,
+        "pagination": pagination,
         "action": "get_users",
         "status": "successful"
     }
@@ -490,81 +254,20 @@ def get_users():
 
 @user_management_blueprint.route('/user/<user_id>', methods=['DELETE'])
 def delete_user(user_id):
-    db_engine = jqutils.get_db_engine()
-
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         
         # Get user details
-        query = text("""
-            SELECT keycloak_user_id, meta_status
+        query = jqutils.cached_text("""
+            SELECT meta_status
             FROM user u
             WHERE user_id = :user_id
         """)
-        result = conn.execute(query, user_id=user_id, meta_status="active").fetchone()
+        result = conn.execute(query, user_id=user_id).fetchone()
         assert result, "failed to get user details"
 
-        if result["meta_status"] != "deleted":
-            action_timestamp = jqutils.get_utc_datetime()
-    
-            # Delete user from keycloak
-            keycloak_user_id = result["keycloak_user_id"]
-            if keycloak_user_id:
-                keycloak_utils.disassociate_user_from_policies(keycloak_user_id)
-                keycloak_utils.delete_user(keycloak_user_id)
-                
-                # Remove keycloak id from database to prevent re-deletion on keycloak
-                query = text("""
-                    UPDATE user
-                    SET keycloak_user_id = :keycloak_user_id,
-                    modification_user_id = :modification_user_id
-                    WHERE user_id = :user_id
-                """)
-                result = conn.execute(query, keycloak_user_id=None, modification_user_id=g.user_id, user_id=user_id).rowcount
-                assert result, "failed to remove user keycloak id"
-
-            # Delete user from DB
-            query = text("""
-                UPDATE user
-                SET meta_status = :meta_status,
-                deletion_user_id = :deletion_user_id,
-                deletion_timestamp = :deletion_timestamp
-                WHERE user_id = :user_id
-            """)
-            result = conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, user_id=user_id).rowcount
-            assert result, "failed to delete user"
-
-            # Delete user role mappings
-            query = text("""
-                UPDATE user_role_map
-                SET meta_status = :meta_status,
-                deletion_user_id = :deletion_user_id,
-                deletion_timestamp = :deletion_timestamp
-                WHERE user_id = :user_id
-                AND meta_status = :meta_status_active
-            """)
-            conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, user_id=user_id, meta_status_active="active")
-
-            # Delete user brand profile module access
-            query = text("""
-                UPDATE user_brand_profile_module_access
-                SET meta_status = :meta_status,
-                deletion_user_id = :deletion_user_id,
-                deletion_timestamp = :deletion_timestamp
-                WHERE user_id = :user_id
-                AND meta_status = :meta_status_active
-            """)
-            conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, user_id=user_id, meta_status_active="active")
-
-            # Delete user images
-            query = text("""
-                UPDATE user_image
-                SET meta_status = :meta_status,
-                deletion_user_id = :deletion_user_id,
-                deletion_timestamp = :deletion_timestamp
-                WHERE user_id = :user_id
-                AND meta_status = :meta_status_active
-            """)
-            conn.execute(query, meta_status="deleted", deletion_user_id=g.user_id, deletion_timestamp=action_timestamp, user_id=user_id, meta_status_active="active")
+        # keycloak removal is queued, see keycloak_cleanup_queue
+        deleted_user_id_list = user_ninja.delete_users([int(user_id)], g.user_id, conn)
+        access_ninja.rebuild_user_effective_access(deleted_user_id_list, conn)
 
     response_body = {
         "action": "delete_user",
@@ -572,6 +275,58 @@ def delete_user(user_id):
     }
     return jsonify(response_body)
 
+@user_management_blueprint.route('/users', methods=['DELETE'])
+def delete_users():
+    request_json = request.get_json()
+    user_id_list = list(dict.fromkeys(int(user_id) for user_id in request_json["user_id_list"]))
+    assert user_id_list, "user_id_list should not be empty"
+    assert len(user_id_list) <= USER_BULK_MAX_ROWS, f"at most {USER_BULK_MAX_ROWS} users per request"
+
+    with jqutils.get_db_connection() as conn:
+        deleted_user_id_list = []
+        for index in range(0, len(user_id_list), USER_BULK_CHUNK_ROWS):
+            deleted_user_id_list += user_ninja.delete_users(user_id_list[index:index + USER_BULK_CHUNK_ROWS], g.user_id, conn)
+        access_ninja.rebuild_user_effective_access(deleted_user_id_list, conn)
+
+    deleted_user_id_set = set(deleted_user_id_list)
+    response_body = {
+        "data": {
+            "deleted_user_id_list": deleted_user_id_list,
+            "skipped_user_id_list": [user_id for user_id in user_id_list if user_id not in deleted_user_id_set]
+        },
+        "action": "delete_users",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
+@user_management_blueprint.route('/user/<user_id>/effective-access', methods=['GET'])
+def get_user_effective_access(user_id):
+    user_id = int(user_id)
+
+    brand_access_map = access_ninja.get_effective_access_map([user_id])[user_id]
+    active_brand_profile_id_set = access_ninja.get_active_brand_profile_id_set()
+    all_brand_profiles_access_set = brand_access_map.get(access_ninja.ALL_BRAND_PROFILES_ID, access_ninja.EMPTY_MODULE_ACCESS_ID_SET)
+    brand_profile_access_map = {brand_profile_id: module_access_id_set for brand_profile_id, module_access_id_set in brand_access_map.items()
+                                if brand_profile_id in active_brand_profile_id_set}
+
+    # bit n of a bitmask is set when module_access_id n is granted
+    response_body = {
+        "data": {
+            "user_id": user_id,
+            "all_brand_profiles_module_access_id_list": sorted(all_brand_profiles_access_set),
+            "brand_profile_module_access_id_map": {
+                str(brand_profile_id): sorted(module_access_id_set) for brand_profile_id, module_access_id_set in brand_profile_access_map.items()
+            },
+            "all_brand_profiles_bitmask": access_ninja.encode_bitmask(all_brand_profiles_access_set),
+            "brand_profile_bitmask_map": {
+                str(brand_profile_id): access_ninja.encode_bitmask(module_access_id_set) for brand_profile_id, module_access_id_set in brand_profile_access_map.items()
+            }
+        },
+        "action": "get_user_effective_access",
+        "status": "successful"
+    }
+    return jsonify(response_body)
+
 # OTP verification
 #--------------------------------------------
 @user_management_blueprint.route('/user/<user_id>/verify-otp', methods=['POST'])
@@ -584,11 +339,9 @@ def verify_user_otp(user_id):
     otp = request_json["otp"]
     intent = request_json["intent"]
 
-    db_engine = jqutils.get_db_engine()
-    
     if intent == "user_signup":
-        query = text("""
-            SELECT one_time_password_id, user_id, intent, contact_method, otp, otp_request_count,
+        query = jqutils.cached_text("""
+            SELECT one_time_password_id, user_id, intent, contact_method, otp_hash, otp_request_count,
             otp_requested_timestamp, otp_expiry_timestamp, otp_verified_timestamp, otp_status
             FROM one_time_password
             WHERE user_id = :user_id
@@ -596,14 +349,14 @@ def verify_user_otp(user_id):
             AND contact_method = :contact_method
             AND meta_status = :meta_status
         """)
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             result = conn.execute(query, user_id=user_id, intent=intent, contact_method="email", meta_status="active").fetchone()
 
         if result:
-            otp_db = result["otp"]
+            otp_hash_db = result["otp_hash"]
             otp_expiry_timestamp = result["otp_expiry_timestamp"]
 
-            if otp_db == otp:
+            if otp_hash_db and secrets.compare_digest(otp_hash_db, user_ninja.hash_otp(otp)):
                 # convert str to datetime
                 current_timestamp_str = jqutils.get_utc_datetime()
                 current_timestamp = datetime.strptime(current_timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
@@ -619,22 +372,22 @@ def verify_user_otp(user_id):
                         }
                         return jsonify(response_body)
                     
-                    query = text("""
+                    query = jqutils.cached_text("""
                         UPDATE one_time_password
                         SET otp_status = :otp_status
                         WHERE one_time_password_id = :one_time_password_id
                     """)
-                    with db_engine.connect() as conn:
+                    with jqutils.get_db_connection() as conn:
                         conn.execute(query, otp_status="verified", one_time_password_id=one_time_password_id)
 
                     # get user details
-                    query = text("""
+                    query = jqutils.cached_text("""
                         SELECT first_names_en, last_name_en, email
                         FROM user
                         WHERE user_id = :user_id
                         AND meta_status = :meta_status
                     """)
-                    with db_engine.connect() as conn:
+                    with jqutils.get_db_connection() as conn:
                         result = conn.execute(query, user_id=user_id, meta_status="active").fetchone()
                         assert result, "failed to get user details"
 
@@ -642,19 +395,24 @@ def verify_user_otp(user_id):
                     last_name_en = result["last_name_en"]
                     email = result["email"]
 
-                    # create keycloak user
+                    # create keycloak user, the user row needs its id, so it is deleted again if the request rolls back
                     keycloak_user_id = keycloak_utils.create_user(username, password, first_names_en, last_name_en, email)
+                    jqutils.run_after_rollback(lambda: keycloak_utils.delete_user(keycloak_user_id, missing_ok=True))
 
                     # update user details
-                    query = text("""
+                    query = jqutils.cached_text("""
                         UPDATE user
                         SET keycloak_user_id = :keycloak_user_id,
                         username = :username
                         WHERE user_id = :user_id
                     """)
-                    with db_engine.connect() as conn:
+                    with jqutils.get_db_connection() as conn:
                         conn.execute(query, keycloak_user_id=keycloak_user_id, username=username, user_id=user_id)
 
+                    availability_index.USERNAME_INDEX.add(username)
+
+                    user_ninja.invalidate_user_profile(user_id)
+
                     response_body = {
                         "data": {
                             "username": username,
@@ -665,12 +423,12 @@ def verify_user_otp(user_id):
                     }
                     return jsonify(response_body)
                 else:
-                    query = text("""
+                    query = jqutils.cached_text("""
                         UPDATE one_time_password
                         SET otp_status = :otp_status
                         WHERE one_time_password_id = :one_time_password_id
                     """)
-                    with db_engine.connect() as conn:
+                    with jqutils.get_db_connection() as conn:
                         conn.execute(query, otp_status="expired", one_time_password_id=one_time_password_id)
 
                     response_body = {
@@ -746,17 +504,15 @@ def initiate_forgot_password_request():
     username = request_json["username"]
     email = request_json["email"]
 
-    db_engine = jqutils.get_db_engine()
-    
     # check if user exists
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT user_id, username, keycloak_user_id, email
         FROM user
         WHERE username = :username
         AND email = :email
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, username=username, email=email, meta_status='active').fetchone()
     
     if not result:
@@ -782,7 +538,7 @@ def initiate_forgot_password_request():
         }
     
     # check if OTP already exists for user
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT one_time_password_id, otp_status
         FROM one_time_password
         WHERE user_id = :user_id
@@ -790,7 +546,7 @@ def initiate_forgot_password_request():
         AND meta_status = :meta_status
         ORDER BY otp_requested_timestamp DESC
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, user_id=user_id, intent='forgot_password', meta_status='active').fetchone()
     
     if result:
@@ -814,39 +570,30 @@ def initiate_forgot_password_request():
     otp_expiry_timestamp = otp_requested_timestamp + timedelta(days=7)
     otp_status = "pending"
 
-    query = text("""
-        INSERT INTO one_time_password (user_id, otp, intent, contact_method, otp_request_count, otp_requested_timestamp, otp_expiry_timestamp, otp_status, meta_status)
-        VALUES(:user_id, :otp, :intent, :contact_method, :otp_request_count, :otp_requested_timestamp, :otp_expiry_timestamp, :otp_status, :meta_status)
+    query = jqutils.cached_text("""
+        INSERT INTO one_time_password (user_id, otp_hash, intent, contact_method, otp_request_count, otp_requested_timestamp, otp_expiry_timestamp, otp_status, meta_status)
+        VALUES(:user_id, :otp_hash, :intent, :contact_method, :otp_request_count, :otp_requested_timestamp, :otp_expiry_timestamp, :otp_status, :meta_status)
     """)
-    with db_engine.connect() as conn:
-        one_time_password_id = conn.execute(query, user_id=user_id, otp=otp, intent=intent, contact_method=contact_method, otp_request_count=otp_request_count,
+    with jqutils.get_db_connection() as conn:
+        one_time_password_id = conn.execute(query, user_id=user_id, otp_hash=user_ninja.hash_otp(otp), intent=intent, contact_method=contact_method, otp_request_count=otp_request_count,
                                 otp_requested_timestamp=otp_requested_timestamp, otp_expiry_timestamp=otp_expiry_timestamp, otp_status=otp_status, meta_status='active').lastrowid
         assert one_time_password_id, "otp request insert error"
     
-    # send otp
-    if os.getenv("MOCK_AWS_NOTIFICATIONS") != "1":
-        if contact_method == 'email':
-            aws_utils.publish_email(
-                source="haseeb.ahmed@globalvertices.com",
-                destination={
-                    "ToAddresses": [email],
-                },
-            subject=f"Forgot Password",
-                text=f"Hi,\n\nYou can reset your password. Your OTP is: {otp}\n\nRegards,\nThank you,\nMealPlanet",
-                html=f"Hi,<br><br>You can reset your password. Your OTP is: {otp}<br><br>Regards,<br>Thank you,<br>MealPlanet"
-            )
+    # send otp through the outbox, it is delivered after this request commits
+    if contact_method == 'email':
+        email_outbox.enqueue_email("forgot_password", email, {"otp": otp})
 
     # update otp status
     otp_status = 'sent'
     otp_requested_timestamp = datetime.now()
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE one_time_password
         SET otp_status = :otp_status,
         otp_request_count = :otp_request_count,
         otp_requested_timestamp = :otp_requested_timestamp
         WHERE one_time_password_id = :one_time_password_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, one_time_password_id=one_time_password_id, otp_status=otp_status, otp_request_count=otp_request_count,
                                 otp_requested_timestamp=otp_requested_timestamp).rowcount
         assert result, "otp status update error"
@@ -863,20 +610,17 @@ def initiate_forgot_password_request():
 
 @user_management_blueprint.route('/forgot-password/<otp>', methods = ['GET'])
 def get_forgot_password_request(otp):
-    db_engine = jqutils.get_db_engine()
-
     intent = "forgot_password"
 
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT one_time_password_id, otp_status
         FROM one_time_password
-        WHERE otp = :otp
+        WHERE otp_hash = :otp_hash
         AND intent = :intent
         AND meta_status = :meta_status
-        ORDER BY otp_requested_timestamp DESC
     """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, otp=otp, intent=intent, meta_status='active').fetchone()
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, otp_hash=user_ninja.hash_otp(otp), intent=intent, meta_status='active').fetchone()
     
     if not result:
         response_body = {
@@ -915,19 +659,16 @@ def reset_user_password():
     password = request_json["password"]
     intent = 'forgot_password'
 
-    db_engine = jqutils.get_db_engine()
-
     # check if otp is valid
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT one_time_password_id, user_id, otp_status
         FROM one_time_password
-        WHERE otp = :otp
+        WHERE otp_hash = :otp_hash
         AND intent = :intent
         AND meta_status = :meta_status
-        ORDER BY otp_requested_timestamp DESC
     """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, otp=otp, intent=intent, meta_status='active').fetchone()
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, otp_hash=user_ninja.hash_otp(otp), intent=intent, meta_status='active').fetchone()
         assert result, "invalid otp code provided"
     
     one_time_password_id = result["one_time_password_id"]
@@ -947,17 +688,18 @@ def reset_user_password():
     otp_status = 'verified'
     otp_verified_timestamp = datetime.now()
 
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE one_time_password
         SET otp_status = :otp_status,
         otp_verified_timestamp = :otp_verified_timestamp
         WHERE one_time_password_id = :one_time_password_id
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, one_time_password_id=one_time_password_id, otp_status=otp_status, otp_verified_timestamp=otp_verified_timestamp).rowcount
         assert result, "otp status update error"
 
-    # update keycloak user password
+    # update keycloak user password last: if it fails the request rolls back and the otp stays usable.
+    # A failing commit after it leaves the new password with an unused otp, which is accepted.
     keycloak_user_id = jqutils.get_column_by_id(user_id, "keycloak_user_id", "user")
 
     keycloak_utils.update_user_password(keycloak_user_id, password)
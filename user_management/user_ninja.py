@@ -1,26 +1,31 @@
 import os
 import re
+import json
 import uuid
+import hashlib
 
 from datetime import datetime, timedelta
-from utils import jqutils, aws_utils
-from sqlalchemy import text
+from flask import g
+from utils import jqutils, jqcache, aws_utils, settings, jqimage_uploader, email_outbox, background_worker, availability_index
+from utils import keycloak_cleanup_queue, access_token
+
+def check_username_availability(username, user_id=None, indexed_p=False):
+    # indexed_p answers typeahead checks from the worker's availability index, writes check the table
+    if indexed_p and not user_id:
+        return availability_index.USERNAME_INDEX.check(username, lambda: check_username_availability(username))
 
-def check_username_availability(username, user_id=None):
     user_id_filter = ""
     if user_id:
         user_id_filter = "AND user_id != :user_id"
     
-    db_engine = jqutils.get_db_engine()
-    
-    query = text(f"""
+    query = jqutils.cached_text(f"""
         SELECT user_id
         FROM user
         WHERE username = :username
         {user_id_filter}
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, username=username, user_id=user_id, meta_status="active").fetchone()
 
     return False if result else True
@@ -31,16 +36,20 @@ def check_username_validity(username):
      
     return True if validity else False
 
+EMAIL_TEMPLATE_CACHE = jqcache.LRUCache(64, settings.get_settings().email_template_cache_seconds)
+
 def get_email_templates(email_template_type):
-    db_engine = jqutils.get_db_engine()
-    
-    query = text("""
+    # templates live in S3, the outbox worker renders every e-mail from this cache
+    return EMAIL_TEMPLATE_CACHE.get_or_build(email_template_type, lambda: load_email_templates(email_template_type))
+
+def load_email_templates(email_template_type):
+    query = jqutils.cached_text("""
         SELECT email_template_format, email_subject, bucket_name, object_key
         FROM email_template
         WHERE email_template_type = :email_template_type
         AND meta_status = :meta_status
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, email_template_type=email_template_type, meta_status="active").fetchall()
         assert result, f"Template not found for type: {email_template_type}"
 
@@ -50,7 +59,7 @@ def get_email_templates(email_template_type):
         bucket_name = one_row['bucket_name']
         object_key = one_row['object_key']
         
-        if os.getenv("MOCK_AWS_NOTIFICATIONS") != "1":
+        if settings.get_settings().mock_aws_notifications != "1":
             template = aws_utils.get_file_data_from_s3(bucket_name, object_key)
         else:
             with open(f"tests/testdata/templates/user-signup/{object_key}", "r") as text_data:
@@ -63,78 +72,61 @@ def get_email_templates(email_template_type):
 
     return templates
 
-def send_user_signup_email(userdata, creation_user_id):
+# One time passwords
+#--------------------------------------------
+# Only the sha256 of a token is stored, under a unique index, so a token is
+# looked up with one index probe and a database leak does not expose live
+# tokens. The token itself only travels in the e-mail.
+def hash_otp(otp):
+    return hashlib.sha256(otp.encode("utf8")).hexdigest()
 
-    user_id = userdata["user_id"]
+def build_user_signup_email(user_id, otp, first_names_en, last_name_en, email):
+    fe_base_url = settings.get_settings().fe_portal_web_url
 
-    # create OTP request
-    otp = str(uuid.uuid4())
-    otp_requested_timestamp_str = jqutils.get_utc_datetime()
-    otp_requested_timestamp = datetime.strptime(otp_requested_timestamp_str, "%Y-%m-%d %H:%M:%S.%f")
-    otp_expiry_timestamp = otp_requested_timestamp + timedelta(days=7)
-    
-    intent = "user_signup"
-    contact_method = "email"
-
-    db_engine = jqutils.get_db_engine()
-
-    query = text("""
-        INSERT INTO one_time_password (
-            user_id, intent, contact_method, otp, otp_request_count, otp_requested_timestamp,
-            otp_expiry_timestamp, otp_status, meta_status, creation_user_id
-        )
-        VALUES (
-            :user_id, :intent, :contact_method, :otp, :otp_request_count, :otp_requested_timestamp,
-            :otp_expiry_timestamp, :otp_status, :meta_status, :creation_user_id
-        )
-    """)
-    with db_engine.connect() as conn:
-        one_time_password_id = conn.execute(query, user_id=user_id, intent=intent, contact_method=contact_method, otp=otp,
-                                otp_request_count=0, otp_requested_timestamp=otp_requested_timestamp, otp_expiry_timestamp=otp_expiry_timestamp,
-                                otp_status="pending", meta_status="active", creation_user_id=creation_user_id).lastrowid
-        assert one_time_password_id, "failed to create OTP request"
-
-    # generate verification link
-    fe_base_url = os.getenv("FE_PORTAL_WEB_URL")
-    verification_link = f"{fe_base_url}/user-signup/{user_id}?otp={otp}"
-    
-    name = userdata["first_names_en"]
-    if userdata["last_name_en"]:
-        name += " " + userdata["last_name_en"]
+    name = first_names_en
+    if last_name_en:
+        name += " " + last_name_en
+
+    return {
+        "email_type": "user_signup",
+        "recipient_email": email,
+        "payload": {
+            "name": name.title(),
+            "verification_link": f"{fe_base_url}/user-signup/{user_id}?otp={otp}"
+        }
+    }
 
-    # send OTP to user email
+def enqueue_user_signup_email(user_id, otp, first_names_en, last_name_en, email, creation_user_id):
+    one_email = build_user_signup_email(user_id, otp, first_names_en, last_name_en, email)
+    return email_outbox.enqueue_email(one_email["email_type"], one_email["recipient_email"], one_email["payload"], creation_user_id)
+
+@email_outbox.register_email_renderer("user_signup")
+def render_user_signup_email(payload):
     email_templates = get_email_templates("user_signup")
 
     html_template = email_templates['html']['body']
     text_template = email_templates['txt']['body']
 
-    html_template = html_template.replace("[NAME]", name.title())
-    html_template = html_template.replace("[LINK]", verification_link)
+    html_template = html_template.replace("[NAME]", payload["name"])
+    html_template = html_template.replace("[LINK]", payload["verification_link"])
 
-    text_template = text_template.replace("[NAME]", name.title())
-    text_template = text_template.replace("[LINK]", verification_link)
+    text_template = text_template.replace("[NAME]", payload["name"])
+    text_template = text_template.replace("[LINK]", payload["verification_link"])
 
-    if contact_method == 'email':
-        aws_utils.publish_email(
-            source="haseeb.ahmed@globalvertices.com",
-            destination={
-                "ToAddresses": [userdata["email"]],
-            },
-            subject=email_templates['html']['subject'],
-            text=text_template,
-            html=html_template
-        )
-
-    # update OTP status to sent
-    query = text("""
-        UPDATE one_time_password
-        SET otp_status = :otp_status,
-        modification_user_id = :modification_user_id
-        WHERE one_time_password_id = :one_time_password_id
-    """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, otp_status="sent", one_time_password_id=one_time_password_id, modification_user_id=creation_user_id).rowcount
-        assert result, "failed to update OTP status"
+    return {
+        "subject": email_templates['html']['subject'],
+        "text": text_template,
+        "html": html_template
+    }
+
+@email_outbox.register_email_renderer("forgot_password")
+def render_forgot_password_email(payload):
+    otp = payload["otp"]
+    return {
+        "subject": "Forgot Password",
+        "text": f"Hi,\n\nYou can reset your password. Your OTP is: {otp}\n\nRegards,\nThank you,\nMealPlanet",
+        "html": f"Hi,<br><br>You can reset your password. Your OTP is: {otp}<br><br>Regards,<br>Thank you,<br>MealPlanet"
+    }
 
 def resend_one_time_password(user_id, intent, modification_user_id, contact_method="email"):
     # create OTP request
@@ -145,10 +137,8 @@ def resend_one_time_password(user_id, intent, modification_user_id, contact_meth
     
     otp_status_list = ["expired", "pending", "sent"]
 
-    db_engine = jqutils.get_db_engine()
-
     # get existing user signup details
-    query = text("""
+    query = jqutils.cached_text("""
         SELECT otp.one_time_password_id, u.first_names_en, u.last_name_en, u.email
         FROM one_time_password otp
         JOIN user u ON otp.user_id = u.user_id
@@ -159,7 +149,7 @@ def resend_one_time_password(user_id, intent, modification_user_id, contact_meth
         AND u.meta_status = :meta_status
         ORDER BY otp_requested_timestamp DESC
     """)
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, user_id=user_id, otp_status_list=otp_status_list, intent=intent, meta_status="active").fetchone()
     
     if not result:
@@ -170,48 +160,715 @@ def resend_one_time_password(user_id, intent, modification_user_id, contact_meth
     last_name_en = result["last_name_en"]
     email = result["email"]
 
-    # generate verification link
-    fe_base_url = os.getenv("FE_PORTAL_WEB_URL")
-    verification_link = f"{fe_base_url}/user-signup/{user_id}?otp={otp}"
-    
-    name = first_names_en
-    if last_name_en:
-        name += " " + last_name_en
-
-    # send OTP to user email
-    email_templates = get_email_templates("user_signup")
-
-    html_template = email_templates['html']['body']
-    text_template = email_templates['txt']['body']
-
-    html_template = html_template.replace("[NAME]", name.title())
-    html_template = html_template.replace("[LINK]", verification_link)
-
-    text_template = text_template.replace("[NAME]", name.title())
-    text_template = text_template.replace("[LINK]", verification_link)
-
     if contact_method == 'email':
-        aws_utils.publish_email(
-            source="haseeb.ahmed@globalvertices.com",
-            destination={
-                "ToAddresses": [email],
-            },
-            subject=email_templates['html']['subject'],
-            text=text_template,
-            html=html_template
-        )
+        enqueue_user_signup_email(user_id, otp, first_names_en, last_name_en, email, modification_user_id)
 
     # update OTP to sent
-    query = text("""
+    query = jqutils.cached_text("""
         UPDATE one_time_password
-        SET otp = :otp, otp_request_count = otp_request_count + 1, otp_requested_timestamp = :otp_requested_timestamp,
+        SET otp_hash = :otp_hash, otp_request_count = otp_request_count + 1, otp_requested_timestamp = :otp_requested_timestamp,
         otp_status = :otp_status, otp_expiry_timestamp = :otp_expiry_timestamp,
         modification_user_id = :modification_user_id
         WHERE one_time_password_id = :one_time_password_id
     """)
-    with db_engine.connect() as conn:
-        result = conn.execute(query, otp=otp, otp_requested_timestamp=otp_requested_timestamp, otp_status="sent",
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, otp_hash=hash_otp(otp), otp_requested_timestamp=otp_requested_timestamp, otp_status="sent",
                             otp_expiry_timestamp=otp_expiry_timestamp, one_time_password_id=one_time_password_id, modification_user_id=modification_user_id).rowcount
         assert result, "failed to update OTP"
     
-    return True, one_time_password_id
\ No newline at end of file
+    return True, one_time_password_id
+# User aggregate
+#--------------------------------------------
+# The whole profile of a user is read in one round-trip: every relation is a
+# JSON_ARRAYAGG subquery next to the user columns, and only the relations in
+# include_list are selected.
+USER_FIELD_LIST = ["keycloak_user_id", "username", "first_names_en", "last_name_en", "first_names_ar",
+                    "last_name_ar", "phone_nr", "email", "all_brand_profile_access_p"]
+USER_RELATION_LIST = ["role_list", "user_image_list", "module_access_list", "brand_profile_list"]
+
+USER_RELATION_SUBQUERIES = {
+    "role_list": """
+        SELECT JSON_ARRAYAGG(JSON_OBJECT('user_role_map_id', urm.user_role_map_id, 'role_id', urm.role_id, 'role_name', r.role_name))
+        FROM user_role_map urm
+        JOIN role r ON urm.role_id = r.role_id
+        WHERE urm.user_id = u.user_id
+        AND urm.meta_status = :meta_status
+    """,
+    "user_image_list": """
+        SELECT JSON_ARRAYAGG(JSON_OBJECT('user_image_id', ui.user_image_id, 'image_type', ui.image_type,
+            'image_bucket_name', ui.image_bucket_name, 'image_object_key', ui.image_object_key))
+        FROM user_image ui
+        WHERE ui.user_id = u.user_id
+        AND ui.meta_status = :meta_status
+    """,
+    "module_access_list": """
+        SELECT JSON_ARRAYAGG(JSON_OBJECT('module_access_id', ma.module_access_id, 'module_id', m.module_id,
+            'module_name', m.module_name, 'access_level', ma.access_level))
+        FROM user_brand_profile_module_access ubpma
+        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
+        JOIN module m ON ma.module_id = m.module_id
+        WHERE ubpma.user_id = u.user_id
+        AND u.all_brand_profile_access_p
+        AND ubpma.brand_profile_id IS NULL
+        AND ubpma.meta_status = :meta_status
+    """,
+    "brand_profile_list": """
+        SELECT JSON_ARRAYAGG(JSON_OBJECT('brand_profile_id', bp.brand_profile_id, 'brand_profile_name', bp.brand_profile_name,
+            'module_id', m.module_id, 'module_name', m.module_name, 'module_access_id', ma.module_access_id, 'access_level', ma.access_level))
+        FROM user_brand_profile_module_access ubpma
+        JOIN brand_profile bp ON ubpma.brand_profile_id = bp.brand_profile_id
+        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
+        JOIN module m ON ma.module_id = m.module_id
+        WHERE ubpma.user_id = u.user_id
+        AND ubpma.brand_profile_id IS NOT NULL
+        AND ubpma.meta_status = :meta_status
+    """
+}
+
+def parse_projection(value, allowed_list, name):
+    if not value:
+        return list(allowed_list)
+
+    projection_list = [item.strip() for item in value.split(",") if item.strip()]
+    for item in projection_list:
+        assert item in allowed_list, f"invalid {name}: {item}"
+    return projection_list
+
+def get_user_image_url(image_bucket_name, image_object_key):
+    if settings.get_settings().mock_s3_upload != '1':
+        return jqimage_uploader.create_presigned_url(image_bucket_name, image_object_key)
+    return f"https://s3.amazonaws.com/{image_bucket_name}/{image_object_key}"
+
+def group_brand_profile_module_access(row_list):
+    brand_profile_map = {}
+    for row in row_list:
+        brand_profile_id = row["brand_profile_id"]
+
+        if brand_profile_id not in brand_profile_map:
+            brand_profile_map[brand_profile_id] = {
+                "brand_profile_id": brand_profile_id,
+                "brand_profile_name": row["brand_profile_name"],
+                "module_access_list": []
+            }
+
+        brand_profile_map[brand_profile_id]["module_access_list"].append({
+            "module_id": row["module_id"],
+            "module_name": row["module_name"],
+            "module_access_id": row["module_access_id"],
+            "access_level": row["access_level"]
+        })
+
+    return list(brand_profile_map.values())
+
+def load_user_aggregate(user_id, field_list=None, include_list=None, read_only=None):
+    field_list = USER_FIELD_LIST if field_list is None else field_list
+    include_list = USER_RELATION_LIST if include_list is None else include_list
+
+    # columns follow USER_FIELD_LIST and USER_RELATION_LIST whatever order the client asked in, so a
+    # projection has one statement cache entry; all_brand_profile_access_p is needed for module_access_list
+    select_field_set = set(field_list) | {"all_brand_profile_access_p"}
+    column_list = [f"u.{field}" for field in USER_FIELD_LIST if field in select_field_set]
+    column_list += [f"({USER_RELATION_SUBQUERIES[relation]}) AS {relation}" for relation in USER_RELATION_LIST if relation in include_list]
+
+    query = jqutils.cached_text(f"""
+        SELECT {', '.join(column_list)}
+        FROM user u
+        WHERE u.user_id = :user_id
+        AND u.meta_status = :meta_status
+    """)
+    with jqutils.get_db_connection(read_only) as conn:
+        result = conn.execute(query, user_id=user_id, meta_status="active").fetchone()
+        assert result, "failed to get user details"
+
+    user_dict = {"user_id": user_id}
+    for field in field_list:
+        user_dict[field] = result[field]
+
+    # user_image_list keeps bucket and key and brand_profile_list stays flat,
+    # get_user_profile() signs the urls and resolves wildcard brand access
+    for relation in include_list:
+        user_dict[relation] = json.loads(result[relation]) if result[relation] else []
+
+    return user_dict
+
+def sign_user_image_list(row_list):
+    return [{
+        "user_image_id": one_image["user_image_id"],
+        "image_type": one_image["image_type"],
+        "user_image_url": get_user_image_url(one_image["image_bucket_name"], one_image["image_object_key"])
+    } for one_image in row_list]
+
+# Access resolver
+#--------------------------------------------
+# A user with all_brand_profile_access_p is granted module access with one
+# brand_profile_id IS NULL row per module access, never one row per brand
+# profile. The wildcard rows are expanded over the active brand profiles when
+# access is read or checked, so brand profiles created later are covered
+# without rewriting any grants.
+ACTIVE_BRAND_PROFILE_CACHE = jqcache.LRUCache(1, 60)
+
+def load_active_brand_profile_list():
+    query = jqutils.cached_text("""
+        SELECT brand_profile_id, brand_profile_name
+        FROM brand_profile
+        WHERE meta_status = :meta_status
+        ORDER BY brand_profile_id
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, meta_status="active").fetchall()
+
+    return [dict(row) for row in result]
+
+def get_active_brand_profile_list():
+    return ACTIVE_BRAND_PROFILE_CACHE.get_or_build("active", load_active_brand_profile_list)
+
+def invalidate_active_brand_profile_list():
+    jqutils.run_after_commit(lambda: ACTIVE_BRAND_PROFILE_CACHE.clear())
+
+def resolve_brand_profile_list(brand_row_list, wildcard_module_access_list):
+    """
+    Groups flat brand access rows by brand profile, adding every active brand
+    profile for the wildcard (brand_profile_id IS NULL) module access rows.
+    """
+    row_list = list(brand_row_list)
+
+    if wildcard_module_access_list:
+        granted_set = {(row["brand_profile_id"], row["module_access_id"]) for row in row_list}
+
+        for brand_profile in get_active_brand_profile_list():
+            for module_access in wildcard_module_access_list:
+                if (brand_profile["brand_profile_id"], module_access["module_access_id"]) in granted_set:
+                    continue
+
+                row_list.append({
+                    "brand_profile_id": brand_profile["brand_profile_id"],
+                    "brand_profile_name": brand_profile["brand_profile_name"],
+                    "module_id": module_access["module_id"],
+                    "module_name": module_access["module_name"],
+                    "module_access_id": module_access["module_access_id"],
+                    "access_level": module_access["access_level"]
+                })
+
+    return group_brand_profile_module_access(row_list)
+
+def has_module_access(user_id, brand_profile_id, module_id, access_level_list=None):
+    """
+    Permission check for one brand profile and module, honouring wildcard grants.
+    """
+    access_level_filter = "AND ma.access_level IN :access_level_list" if access_level_list else ""
+
+    query = jqutils.cached_text(f"""
+        SELECT 1
+        FROM user_brand_profile_module_access ubpma
+        JOIN user u ON ubpma.user_id = u.user_id
+        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
+        JOIN brand_profile bp ON bp.brand_profile_id = :brand_profile_id
+        WHERE ubpma.user_id = :user_id
+        AND (ubpma.brand_profile_id = bp.brand_profile_id OR (ubpma.brand_profile_id IS NULL AND u.all_brand_profile_access_p))
+        AND ma.module_id = :module_id
+        {access_level_filter}
+        AND ubpma.meta_status = :meta_status
+        AND u.meta_status = :meta_status
+        AND bp.meta_status = :meta_status
+        LIMIT 1
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, user_id=user_id, brand_profile_id=brand_profile_id, module_id=module_id,
+                            access_level_list=access_level_list, meta_status="active").fetchone()
+
+    return result is not None
+
+# User profile cache
+#--------------------------------------------
+# The full get_user payload is cached per (tenant_id, user_id) without the
+# presigned image urls, which expire, so they are signed on every read.
+# Projected requests are served from a cached profile, and on a miss read
+# only their projection without filling the cache.
+# Writers call invalidate_user_profile(); the entry is dropped after commit.
+# Fills read the primary and are guarded by the cache generation, so a reader
+# that loaded before the commit cannot store its rows after the invalidation.
+def build_user_profile_cache(settings):
+    return jqcache.TieredCache("user-profile", settings.user_profile_cache_size, settings.user_profile_cache_ttl_seconds, settings.redis_url)
+
+USER_PROFILE_CACHE = build_user_profile_cache(settings.get_settings())
+
+@settings.register_reload_callback
+def reset_user_profile_cache(new_settings):
+    global USER_PROFILE_CACHE
+    USER_PROFILE_CACHE = build_user_profile_cache(new_settings)
+
+def get_user_profile(user_id, field_list=None, include_list=None):
+    field_list = USER_FIELD_LIST if field_list is None else field_list
+    include_list = USER_RELATION_LIST if include_list is None else include_list
+
+    cache_key = (g.tenant_id, user_id)
+    user_profile = USER_PROFILE_CACHE.get(cache_key)
+    if user_profile is None and set(field_list) == set(USER_FIELD_LIST) and set(include_list) == set(USER_RELATION_LIST):
+        # the fill reads the primary, a lagging replica could hand out rows from before the last invalidation,
+        # and it is dropped if the profile is invalidated while it loads
+        generation = USER_PROFILE_CACHE.get_generation(cache_key)
+        user_profile = load_user_aggregate(user_id, read_only=False)
+        USER_PROFILE_CACHE.set_if_generation(cache_key, user_profile, generation)
+    elif user_profile is None:
+        # a partial profile is not cached, only the projection is read
+        load_include_list = list(include_list)
+        if "brand_profile_list" in include_list and "module_access_list" not in include_list:
+            # wildcard brand access is resolved from module_access_list
+            load_include_list.append("module_access_list")
+        user_profile = load_user_aggregate(user_id, field_list, load_include_list)
+
+    user_dict = {"user_id": user_id}
+    for field in field_list:
+        user_dict[field] = user_profile[field]
+
+    for relation in include_list:
+        row_list = user_profile[relation]
+
+        if relation == "user_image_list":
+            row_list = sign_user_image_list(row_list)
+        elif relation == "brand_profile_list":
+            row_list = resolve_brand_profile_list(row_list, user_profile["module_access_list"])
+
+        user_dict[relation] = row_list
+
+    return user_dict
+
+def invalidate_user_profile(user_id):
+    # anonymous requests, e.g. OTP verification, have no tenant of their own
+    tenant_id = g.tenant_id if g.tenant_id is not None else jqutils.get_column_by_id(int(user_id), "tenant_id", "user")
+    cache_key = (tenant_id, int(user_id))
+    jqutils.run_after_commit(lambda: USER_PROFILE_CACHE.invalidate(cache_key))
+
+def clear_user_profile_cache():
+    # brand profile, role or module names are part of every cached profile
+    jqutils.run_after_commit(lambda: USER_PROFILE_CACHE.clear())
+
+def get_user_profile_cache_stats():
+    return USER_PROFILE_CACHE.stats()
+
+# User list hydration
+#--------------------------------------------
+# Relations of a page of users are read with one IN query per relation and
+# grouped by user_id in memory, so listing costs O(relations) queries.
+USER_LIST_RELATION_QUERIES = {
+    "role_list": """
+        SELECT urm.user_id, urm.role_id, r.role_name
+        FROM user_role_map urm
+        JOIN role r ON urm.role_id = r.role_id
+        WHERE urm.user_id IN :user_id_list
+        AND urm.meta_status = :meta_status
+    """,
+    "user_image_list": """
+        SELECT user_id, user_image_id, image_type, image_bucket_name, image_object_key
+        FROM user_image
+        WHERE user_id IN :user_id_list
+        AND meta_status = :meta_status
+    """,
+    "module_access_list": """
+        SELECT ubpma.user_id, ma.module_access_id, m.module_id, m.module_name, ma.access_level
+        FROM user_brand_profile_module_access ubpma
+        JOIN user u ON ubpma.user_id = u.user_id
+        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
+        JOIN module m ON ma.module_id = m.module_id
+        WHERE ubpma.user_id IN :user_id_list
+        AND u.all_brand_profile_access_p
+        AND ubpma.brand_profile_id IS NULL
+        AND ubpma.meta_status = :meta_status
+    """,
+    "brand_profile_list": """
+        SELECT ubpma.user_id, bp.brand_profile_id, bp.brand_profile_name, m.module_id, m.module_name, ma.module_access_id, ma.access_level
+        FROM user_brand_profile_module_access ubpma
+        JOIN brand_profile bp ON ubpma.brand_profile_id = bp.brand_profile_id
+        JOIN module_access ma ON ubpma.module_access_id = ma.module_access_id
+        JOIN module m ON ma.module_id = m.module_id
+        WHERE ubpma.user_id IN :user_id_list
+        AND ubpma.brand_profile_id IS NOT NULL
+        AND ubpma.meta_status = :meta_status
+    """
+}
+
+def hydrate_user_list(user_list, include_list):
+    user_id_list = [one_user["user_id"] for one_user in user_list]
+
+    # wildcard brand access is resolved from the global module access rows
+    load_relation_list = list(include_list)
+    if "brand_profile_list" in include_list and "module_access_list" not in include_list:
+        load_relation_list.insert(0, "module_access_list")
+
+    relation_map_dict = {}
+    for relation in load_relation_list:
+        relation_map = {user_id: [] for user_id in user_id_list}
+
+        if user_id_list:
+            query = jqutils.cached_text(USER_LIST_RELATION_QUERIES[relation])
+            with jqutils.get_db_connection() as conn:
+                result = conn.execute(query, user_id_list=user_id_list, meta_status="active").fetchall()
+
+            for row in result:
+                row = dict(row)
+                relation_map[row.pop("user_id")].append(row)
+
+        relation_map_dict[relation] = relation_map
+
+    for one_user in user_list:
+        user_id = one_user["user_id"]
+
+        for relation in include_list:
+            row_list = relation_map_dict[relation][user_id]
+
+            if relation == "user_image_list":
+                row_list = sign_user_image_list(row_list)
+            elif relation == "brand_profile_list":
+                row_list = resolve_brand_profile_list(row_list, relation_map_dict["module_access_list"][user_id])
+
+            one_user[relation] = row_list
+
+    return user_list
+
+# User onboarding
+#--------------------------------------------
+# create_users() writes any number of users with multi-row inserts: the users,
+# then their roles, module access, signup OTPs and outbox e-mails, one INSERT
+# per table per chunk instead of one per row.
+USER_SPEC_TEXT_FIELD_LIST = ["first_names_en", "last_name_en", "first_names_ar", "last_name_ar", "phone_nr", "email"]
+USER_SPEC_REQUIRED_FIELD_LIST = USER_SPEC_TEXT_FIELD_LIST + ["role_id_list"]
+EMAIL_REGEX = r'^[^@\s]+@[^@\s]+\.[^@\s]+$'
+
+def get_active_id_set(table_name, id_list):
+    if not id_list:
+        return set()
+
+    query = jqutils.cached_text(f"""
+        SELECT {table_name}_id
+        FROM {table_name}
+        WHERE {table_name}_id IN :id_list
+        AND meta_status = :meta_status
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, id_list=list(id_list), meta_status="active").fetchall()
+
+    return {row[f"{table_name}_id"] for row in result}
+
+def is_id_list(value):
+    # bool is an int subclass, but never a valid id
+    return isinstance(value, list) and all(isinstance(one_id, int) and not isinstance(one_id, bool) for one_id in value)
+
+def get_user_spec_structure_error(user_spec):
+    """
+    Checks the presence and type of every field create_users reads.
+    Returns an error message, or None when the spec is well-formed.
+    """
+    if not isinstance(user_spec, dict):
+        return "user spec must be an object"
+
+    missing_field_list = [field for field in USER_SPEC_REQUIRED_FIELD_LIST if field not in user_spec]
+    all_brand_profile_access_p = user_spec.get("all_brand_profile_access_p", False)
+    if not all_brand_profile_access_p and "brand_profile_list" not in user_spec:
+        missing_field_list.append("brand_profile_list")
+    if missing_field_list:
+        return f"missing fields: {', '.join(missing_field_list)}"
+
+    invalid_field_list = [field for field in USER_SPEC_TEXT_FIELD_LIST if not isinstance(user_spec[field], str)]
+    if invalid_field_list:
+        return f"fields must be strings: {', '.join(invalid_field_list)}"
+    if not isinstance(all_brand_profile_access_p, bool):
+        return "all_brand_profile_access_p must be a boolean"
+    if not is_id_list(user_spec["role_id_list"]):
+        return "role_id_list must be a list of integer ids"
+    if not is_id_list(user_spec.get("module_access_id_list", [])):
+        return "module_access_id_list must be a list of integer ids"
+
+    brand_profile_list = user_spec.get("brand_profile_list", [])
+    if not isinstance(brand_profile_list, list):
+        return "brand_profile_list must be a list"
+    for brand_profile in brand_profile_list:
+        if not isinstance(brand_profile, dict) or not is_id_list([brand_profile.get("brand_profile_id")]):
+            return "brand_profile_list entries must have an integer brand_profile_id"
+        if not is_id_list(brand_profile.get("module_access_id_list")):
+            return "brand_profile_list entries must have a module_access_id_list of integer ids"
+
+    return None
+
+def validate_user_spec_list(user_spec_list):
+    """
+    Validates all specs with one query per referenced table.
+    Returns one error message per spec, None for valid specs.
+    """
+    # malformed specs are reported as is and never reach the id lookups
+    structure_error_list = [get_user_spec_structure_error(user_spec) for user_spec in user_spec_list]
+    well_formed_spec_list = [user_spec for user_spec, structure_error in zip(user_spec_list, structure_error_list) if structure_error is None]
+
+    role_id_set = set()
+    brand_profile_id_set = set()
+    module_access_id_set = set()
+    for user_spec in well_formed_spec_list:
+        role_id_set.update(user_spec["role_id_list"])
+        module_access_id_set.update(user_spec.get("module_access_id_list", []))
+        for brand_profile in user_spec.get("brand_profile_list", []):
+            brand_profile_id_set.add(brand_profile["brand_profile_id"])
+            module_access_id_set.update(brand_profile["module_access_id_list"])
+
+    valid_role_id_set = get_active_id_set("role", role_id_set)
+    valid_brand_profile_id_set = get_active_id_set("brand_profile", brand_profile_id_set)
+    valid_module_access_id_set = get_active_id_set("module_access", module_access_id_set)
+
+    error_list = []
+    seen_email_set = set()
+    for user_spec, structure_error in zip(user_spec_list, structure_error_list):
+        if structure_error is not None:
+            error_list.append(structure_error)
+            continue
+
+        email = user_spec["email"]
+        role_id_list = user_spec["role_id_list"]
+        brand_profile_list = user_spec.get("brand_profile_list", [])
+        module_access_id_list = user_spec.get("module_access_id_list", []) + [
+            module_access_id for brand_profile in brand_profile_list for module_access_id in brand_profile["module_access_id_list"]]
+
+        if not re.fullmatch(EMAIL_REGEX, email):
+            error_list.append(f"invalid email: {email}")
+        elif email.lower() in seen_email_set:
+            error_list.append(f"duplicate email in request: {email}")
+        elif not set(role_id_list) <= valid_role_id_set:
+            error_list.append(f"invalid role_id_list: {sorted(set(role_id_list) - valid_role_id_set)}")
+        elif not {brand_profile["brand_profile_id"] for brand_profile in brand_profile_list} <= valid_brand_profile_id_set:
+            error_list.append("invalid brand_profile_id in brand_profile_list")
+        elif not set(module_access_id_list) <= valid_module_access_id_set:
+            error_list.append(f"invalid module_access_id: {sorted(set(module_access_id_list) - valid_module_access_id_set)}")
+        else:
+            error_list.append(None)
+
+        seen_email_set.add(email.lower())
+
+    return error_list
+
+def build_user_brand_profile_module_access_list(user_id, user_spec, creation_user_id):
+    user_brand_profile_module_access_list = []
+
+    # allow access to user for all modules across all brand profiles
+    if user_spec.get("all_brand_profile_access_p", False):
+        for module_access_id in user_spec.get("module_access_id_list", []):
+            user_brand_profile_module_access_list.append({
+                "user_id": user_id,
+                "brand_profile_id": None,
+                "module_access_id": module_access_id,
+                "meta_status": "active",
+                "creation_user_id": creation_user_id
+            })
+
+    # allow brand-specific access to user
+    else:
+        for brand_profile in user_spec["brand_profile_list"]:
+            for module_access_id in brand_profile["module_access_id_list"]:
+                user_brand_profile_module_access_list.append({
+                    "user_id": user_id,
+                    "brand_profile_id": brand_profile["brand_profile_id"],
+                    "module_access_id": module_access_id,
+                    "meta_status": "active",
+                    "creation_user_id": creation_user_id
+                })
+
+    return user_brand_profile_module_access_list
+
+def create_users(user_spec_list, creation_user_id, conn):
+    """
+    Creates users with their roles, module access and signup e-mail.
+    Returns the user_id of every spec in order.
+    """
+    user_list = [{
+        "first_names_en": user_spec["first_names_en"],
+        "last_name_en": user_spec["last_name_en"],
+        "first_names_ar": user_spec["first_names_ar"],
+        "last_name_ar": user_spec["last_name_ar"],
+        "phone_nr": user_spec["phone_nr"],
+        "email": user_spec["email"],
+        "all_brand_profile_access_p": user_spec.get("all_brand_profile_access_p", False),
+        "meta_status": "active",
+        "creation_user_id": creation_user_id
+    } for user_spec in user_spec_list]
+    user_id_list = jqutils.bulk_insert_db_entries(user_list, "user", capture_tenant=False, conn=conn)
+    assert len(user_id_list) == len(user_spec_list), "failed to create users"
+
+    # create user roles
+    user_role_map_list = [{
+        "user_id": user_id,
+        "role_id": role_id,
+        "meta_status": "active",
+        "creation_user_id": creation_user_id
+    } for user_id, user_spec in zip(user_id_list, user_spec_list) for role_id in user_spec["role_id_list"]]
+    user_role_map_id_list = jqutils.bulk_insert_db_entries(user_role_map_list, "user_role_map", capture_tenant=False, conn=conn)
+    assert len(user_role_map_id_list) == len(user_role_map_list), "failed to create user roles"
+
+    # create user brand profile module access
+    user_brand_profile_module_access_list = [one_access for user_id, user_spec in zip(user_id_list, user_spec_list)
+                                                for one_access in build_user_brand_profile_module_access_list(user_id, user_spec, creation_user_id)]
+    user_brand_profile_module_access_id_list = jqutils.bulk_insert_db_entries(user_brand_profile_module_access_list, "user_brand_profile_module_access", capture_tenant=False, conn=conn)
+    assert len(user_brand_profile_module_access_id_list) == len(user_brand_profile_module_access_list), "failed to create user brand profile module access"
+
+    # create signup OTPs, they count as sent because their e-mails are queued in the same transaction
+    otp_requested_timestamp = datetime.strptime(jqutils.get_utc_datetime(), "%Y-%m-%d %H:%M:%S.%f")
+    otp_expiry_timestamp = otp_requested_timestamp + timedelta(days=7)
+    otp_list = [str(uuid.uuid4()) for _ in user_id_list]
+
+    one_time_password_list = [{
+        "user_id": user_id,
+        "intent": "user_signup",
+        "contact_method": "email",
+        "otp_hash": hash_otp(otp),
+        "otp_request_count": 0,
+        "otp_requested_timestamp": otp_requested_timestamp,
+        "otp_expiry_timestamp": otp_expiry_timestamp,
+        "otp_status": "sent",
+        "meta_status": "active",
+        "creation_user_id": creation_user_id
+    } for user_id, otp in zip(user_id_list, otp_list)]
+    one_time_password_id_list = jqutils.bulk_insert_db_entries(one_time_password_list, "one_time_password", capture_tenant=False, conn=conn)
+    assert len(one_time_password_id_list) == len(user_id_list), "failed to create OTP request"
+
+    email_list = [build_user_signup_email(user_id, otp, user_spec["first_names_en"], user_spec["last_name_en"], user_spec["email"])
+                    for user_id, otp, user_spec in zip(user_id_list, otp_list, user_spec_list)]
+    email_outbox.enqueue_email_list(email_list, creation_user_id, conn)
+
+    return user_id_list
+
+# User offboarding
+#--------------------------------------------
+# delete_users() soft-deletes any number of users and their roles, module
+# access and images with one UPDATE per table, and queues their Keycloak
+# removal, so the caller's transaction covers everything but the admin calls.
+USER_DELETE_TABLE_LIST = ["user_role_map", "user_brand_profile_module_access", "user_image"]
+
+def delete_users(user_id_list, deletion_user_id, conn):
+    """
+    Returns the user_id of every user that was active and is now deleted.
+    """
+    query = jqutils.cached_text("""
+        SELECT user_id, keycloak_user_id
+        FROM user
+        WHERE user_id IN :user_id_list
+        AND meta_status != :meta_status
+        FOR UPDATE
+    """)
+    result = conn.execute(query, user_id_list=list(user_id_list), meta_status="deleted").fetchall()
+    deleted_user_id_list = [row["user_id"] for row in result]
+    if not deleted_user_id_list:
+        return []
+
+    deletion_timestamp = jqutils.get_utc_datetime()
+
+    # keycloak_user_id is cleared here and kept in the queue, so nothing deletes the keycloak user twice
+    query = jqutils.cached_text("""
+        UPDATE user
+        SET meta_status = :meta_status,
+        keycloak_user_id = NULL,
+        deletion_user_id = :deletion_user_id,
+        deletion_timestamp = :deletion_timestamp
+        WHERE user_id IN :user_id_list
+    """)
+    row_count = conn.execute(query, meta_status="deleted", deletion_user_id=deletion_user_id, deletion_timestamp=deletion_timestamp,
+                        user_id_list=deleted_user_id_list).rowcount
+    assert row_count == len(deleted_user_id_list), "failed to delete users"
+
+    for table_name in USER_DELETE_TABLE_LIST:
+        query = jqutils.cached_text(f"""
+            UPDATE {table_name}
+            SET meta_status = :meta_status,
+            deletion_user_id = :deletion_user_id,
+            deletion_timestamp = :deletion_timestamp
+            WHERE user_id IN :user_id_list
+            AND meta_status = :meta_status_active
+        """)
+        conn.execute(query, meta_status="deleted", deletion_user_id=deletion_user_id, deletion_timestamp=deletion_timestamp,
+                    user_id_list=deleted_user_id_list, meta_status_active="active")
+
+    keycloak_cleanup_queue.enqueue_keycloak_user_cleanup([{
+        "user_id": row["user_id"],
+        "keycloak_user_id": row["keycloak_user_id"]
+    } for row in result if row["keycloak_user_id"]], deletion_user_id, conn)
+
+    for user_id in deleted_user_id_list:
+        invalidate_user_profile(user_id)
+
+    # deleted users' access tokens stop authenticating
+    for row in result:
+        if row["keycloak_user_id"]:
+            jqutils.run_after_commit(lambda keycloak_user_id=row["keycloak_user_id"]: access_token.invalidate_token_user(keycloak_user_id))
+
+    return deleted_user_id_list
+
+# OTP sweeper
+#--------------------------------------------
+# Expires unused tokens past their expiry and moves finished tokens older than
+# otp_archive_retention_days to archive_one_time_password, in batches that are
+# safe to run from several processes at once.
+def expire_one_time_passwords(batch_size):
+    query = jqutils.cached_text("""
+        UPDATE one_time_password
+        SET otp_status = :otp_status_expired
+        WHERE otp_status IN :otp_status_list
+        AND otp_expiry_timestamp < :current_timestamp
+        AND meta_status = :meta_status
+        LIMIT :batch_size
+    """)
+    with jqutils.get_db_connection() as conn:
+        return conn.execute(query, otp_status_expired="expired", otp_status_list=["pending", "sent"], current_timestamp=datetime.utcnow(),
+                            meta_status="active", batch_size=batch_size).rowcount
+
+def archive_one_time_passwords(batch_size, retention_days):
+    query = jqutils.cached_text("""
+        SELECT one_time_password_id
+        FROM one_time_password
+        WHERE otp_status IN :otp_status_list
+        AND otp_expiry_timestamp < :archive_timestamp
+        ORDER BY otp_expiry_timestamp
+        LIMIT :batch_size
+    """)
+    with jqutils.get_db_transaction() as conn:
+        result = conn.execute(query, otp_status_list=["expired", "verified"], archive_timestamp=datetime.utcnow() - timedelta(days=retention_days),
+                            batch_size=batch_size).fetchall()
+        one_time_password_id_list = [row["one_time_password_id"] for row in result]
+        if not one_time_password_id_list:
+            return 0
+
+        # INSERT IGNORE, another process may have archived the same batch
+        query = jqutils.cached_text("""
+            INSERT IGNORE INTO archive_one_time_password (
+                one_time_password_id, user_id, intent, contact_method, otp_hash, otp_request_count, otp_requested_timestamp,
+                otp_expiry_timestamp, otp_verified_timestamp, otp_status, meta_status, tenant_id, creation_user_id, modification_user_id,
+                modification_timestamp
+            )
+            SELECT one_time_password_id, user_id, intent, contact_method, otp_hash, otp_request_count, otp_requested_timestamp,
+                otp_expiry_timestamp, otp_verified_timestamp, otp_status, meta_status, COALESCE(tenant_id, 1), COALESCE(creation_user_id, 0),
+                modification_user_id, modification_timestamp
+            FROM one_time_password
+            WHERE one_time_password_id IN :one_time_password_id_list
+        """)
+        conn.execute(query, one_time_password_id_list=one_time_password_id_list)
+
+        query = jqutils.cached_text("""
+            DELETE FROM one_time_password
+            WHERE one_time_password_id IN :one_time_password_id_list
+        """)
+        return conn.execute(query, one_time_password_id_list=one_time_password_id_list).rowcount
+
+def sweep_one_time_passwords():
+    sweep_settings = settings.get_settings()
+    batch_size = sweep_settings.otp_sweep_batch_size
+
+    stats = {"expired_count": 0, "archived_count": 0}
+    while True:
+        row_count = expire_one_time_passwords(batch_size)
+        stats["expired_count"] += row_count
+        if row_count < batch_size:
+            break
+
+    while True:
+        row_count = archive_one_time_passwords(batch_size, sweep_settings.otp_archive_retention_days)
+        stats["archived_count"] += row_count
+        if row_count < batch_size:
+            break
+
+    return stats
+
+def start_one_time_password_sweeper():
+    return background_worker.start_periodic_task("otp-sweeper", settings.get_settings().otp_sweep_interval_seconds, sweep_one_time_passwords)
@@ -0,0 +1,165 @@
+import json
+import time
+import logging
+import threading
+
+from jwcrypto import jwk, jwt
+from jwcrypto.common import JWException, base64url_decode
+from keycloak.exceptions import KeycloakError
+from utils import jqutils, jqcache, keycloak_utils
+from utils.settings import get_settings, register_reload_callback
+
+# Access token verification
+#--------------------------------------------
+# Bearer tokens are verified locally instead of being introspected by
+# Keycloak: the realm's signing keys (JWKS) are fetched once and cached, and a
+# token signed with a key id the cache does not know triggers one refetch, so
+# key rotation needs no restart. Unknown key ids refetch at most every
+# JWKS_MIN_REFETCH_SECONDS, so forged tokens cannot hammer Keycloak. When the
+# keys cannot be fetched, authenticate_access_token() raises KeycloakError so
+# the caller can answer 503 instead of rejecting a possibly valid token.
+#
+# The token's sub is the Keycloak user id. It is mapped to user_id and
+# tenant_id through an LRU cache backed by user.keycloak_user_id. Deleting a
+# user drops its entry after commit; other processes keep accepting the
+# user's tokens for at most auth_user_cache_ttl_seconds.
+
+# only asymmetric algorithms, a symmetric one would let the public key sign tokens
+ALLOWED_ALGORITHM_LIST = ["RS256", "RS384", "RS512", "PS256", "PS384", "PS512", "ES256", "ES384", "ES512"]
+JWKS_MIN_REFETCH_SECONDS = 10
+
+JWKS_LOCK = threading.Lock()
+JWK_SET = None
+JWKS_FETCHED_AT = 0
+JWKS_FETCH_COUNT = 0
+
+VERIFIED_COUNT = 0
+REJECTED_COUNT = 0
+UNAVAILABLE_COUNT = 0
+
+def build_user_cache(settings):
+    return jqcache.LRUCache(settings.auth_user_cache_size, settings.auth_user_cache_ttl_seconds)
+
+USER_CACHE = build_user_cache(get_settings())
+
+@register_reload_callback
+def reset_access_token_caches(settings):
+    global USER_CACHE, JWK_SET
+
+    USER_CACHE = build_user_cache(settings)
+    # the realm may have changed
+    with JWKS_LOCK:
+        JWK_SET = None
+
+def fetch_jwk_set():
+    global JWK_SET, JWKS_FETCHED_AT, JWKS_FETCH_COUNT
+
+    certs = keycloak_utils.get_keycloak_client_openid().certs()
+    JWK_SET = jwk.JWKSet.from_json(json.dumps(certs))
+    JWKS_FETCHED_AT = time.monotonic()
+    JWKS_FETCH_COUNT += 1
+
+def is_jwk_set_stale():
+    return JWK_SET is None or time.monotonic() - JWKS_FETCHED_AT >= get_settings().keycloak_jwks_max_age_seconds
+
+def get_signing_key(key_id):
+    """
+    Returns the realm key for key_id, refetching the JWKS when it is stale or does not know the key.
+    """
+    jwk_set = JWK_SET
+    if jwk_set is not None and not is_jwk_set_stale():
+        key = jwk_set.get_key(key_id)
+        if key is not None:
+            return key
+
+    with JWKS_LOCK:
+        # another thread may have fetched while this one waited
+        if is_jwk_set_stale() or (JWK_SET.get_key(key_id) is None and time.monotonic() - JWKS_FETCHED_AT >= JWKS_MIN_REFETCH_SECONDS):
+            fetch_jwk_set()
+        return JWK_SET.get_key(key_id)
+
+def get_token_audience():
+    settings = get_settings()
+    return settings.keycloak_token_audience or settings.keycloak_client_id
+
+def get_token_issuer():
+    # tokens name the realm by the URL clients reach Keycloak on, which may differ from keycloak_server_url
+    settings = get_settings()
+    return settings.keycloak_token_issuer or f"{settings.keycloak_server_url.rstrip('/')}/realms/{settings.keycloak_realm_name}"
+
+def verify_access_token(token):
+    """
+    Verifies the signature, expiry, issuer and audience of a bearer token and returns its claims.
+    """
+    part_list = token.split(".")
+    assert len(part_list) == 3, "malformed token"
+    header = json.loads(base64url_decode(part_list[0]))
+    assert isinstance(header, dict) and header.get("kid"), "token has no key id"
+    assert header.get("alg") in ALLOWED_ALGORITHM_LIST, "unsupported token algorithm"
+
+    key = get_signing_key(header.get("kid"))
+    assert key is not None, "unknown token signing key"
+
+    # exp is required and checked with jwcrypto's default leeway
+    verified_token = jwt.JWT(jwt=token, key=key, algs=ALLOWED_ALGORITHM_LIST, expected_type="JWS",
+                            check_claims={"exp": None, "iss": get_token_issuer(), "aud": get_token_audience()})
+    claims = json.loads(verified_token.claims)
+    assert claims.get("sub"), "token has no subject"
+    return claims
+
+def load_token_user(keycloak_user_id):
+    query = jqutils.cached_text("""
+        SELECT user_id, tenant_id
+        FROM user
+        WHERE keycloak_user_id = :keycloak_user_id
+        AND meta_status = :meta_status
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, keycloak_user_id=keycloak_user_id, meta_status="active").fetchone()
+
+    return dict(result) if result else None
+
+def get_token_user(keycloak_user_id):
+    token_user = USER_CACHE.get(keycloak_user_id)
+    if token_user is None:
+        # unknown subjects are not cached, the user may be created any moment
+        token_user = load_token_user(keycloak_user_id)
+        if token_user is not None:
+            USER_CACHE.set(keycloak_user_id, token_user)
+    return token_user
+
+def authenticate_access_token(token):
+    """
+    Returns a dict with user_id, tenant_id and keycloak_user_id, or None for an invalid token.
+    Raises KeycloakError when the realm keys cannot be fetched.
+    """
+    global VERIFIED_COUNT, REJECTED_COUNT, UNAVAILABLE_COUNT
+
+    try:
+        claims = verify_access_token(token)
+        token_user = get_token_user(claims["sub"])
+        assert token_user is not None, "token subject is not an active user"
+    except (AssertionError, JWException, ValueError) as e:
+        REJECTED_COUNT += 1
+        logging.info("rejected access token: %s", e)
+        return None
+    except KeycloakError:
+        UNAVAILABLE_COUNT += 1
+        logging.exception("unable to fetch the realm signing keys")
+        raise
+
+    VERIFIED_COUNT += 1
+    return dict(token_user, keycloak_user_id=claims["sub"])
+
+def invalidate_token_user(keycloak_user_id):
+    USER_CACHE.delete(keycloak_user_id)
+
+def get_access_token_stats():
+    return {
+        "verified_count": VERIFIED_COUNT,
+        "rejected_count": REJECTED_COUNT,
+        "unavailable_count": UNAVAILABLE_COUNT,
+        "jwks_fetch_count": JWKS_FETCH_COUNT,
+        "jwks_key_count": len(JWK_SET["keys"]) if JWK_SET is not None else None,
+        "user_cache": USER_CACHE.stats()
+    }
@@ -0,0 +1,156 @@
+import time
+import threading
+import unicodedata
+
+from datetime import timedelta
+from utils import jqutils
+
+# Availability index
+#--------------------------------------------
+# The admin UI checks name availability on every keystroke. Each worker keeps
+# the taken names of a table in memory as a set: a name that is not in it is
+# answered without a query, and only names that are in it are checked against
+# MySQL.
+#
+# Names are normalised more coarsely than the case and accent insensitive
+# column collation, so a name the database would treat as equal always
+# collides in the index. Over-matching only costs a database check.
+#
+# Other workers insert and rename rows too, so the index pulls rows whose
+# modification_timestamp passed its watermark every refresh_seconds and is
+# rebuilt from scratch every rebuild_seconds, which also drops names that were
+# deleted or renamed away. A name taken by another worker can therefore be
+# reported available for up to refresh_seconds: the availability endpoints are
+# advisory and the write paths keep their exact database check.
+
+# rows committed late can carry an older modification_timestamp than the watermark
+WATERMARK_OVERLAP_SECONDS = 5
+
+def normalize_name(name):
+    name = unicodedata.normalize("NFKD", str(name))
+    name = "".join(char for char in name if not unicodedata.combining(char))
+    return " ".join(name.casefold().split())
+
+class AvailabilityIndex:
+    """
+    Taken names of one table column, optionally scoped by another column
+    (e.g. plan names per brand profile).
+    """
+
+    def __init__(self, table_name, name_column, scope_column=None, refresh_seconds=2, rebuild_seconds=300):
+        self.table_name = table_name
+        self.name_column = name_column
+        self.scope_column = scope_column
+        self.refresh_seconds = refresh_seconds
+        self.rebuild_seconds = rebuild_seconds
+
+        self.built_p = False
+        self.name_set = set()
+        self.watermark = None
+        self.refreshed_at = 0
+        self.rebuilt_at = 0
+
+        self.definitely_available_count = 0
+        self.database_check_count = 0
+        self._lock = threading.Lock()
+
+    def get_key(self, name, scope_id=None):
+        name = normalize_name(name)
+        if not self.scope_column:
+            return name
+        return f"{int(scope_id) if scope_id is not None else ''}:{name}"
+
+    def load_rows(self, watermark=None):
+        scope_select = f", {self.scope_column}" if self.scope_column else ""
+        watermark_filter = "AND modification_timestamp >= :watermark" if watermark else ""
+        query = jqutils.cached_text(f"""
+            SELECT {self.name_column} AS name{scope_select}, modification_timestamp
+            FROM {self.table_name}
+            WHERE meta_status = :meta_status
+            AND {self.name_column} IS NOT NULL
+            {watermark_filter}
+        """)
+        with jqutils.get_db_connection() as conn:
+            return conn.execute(query, meta_status="active", watermark=watermark).fetchall()
+
+    def apply_rows(self, row_list):
+        for row in row_list:
+            self.name_set.add(self.get_key(row["name"], row[self.scope_column] if self.scope_column else None))
+
+        # the watermark is MAX(modification_timestamp) of the rows read, it never comes from a
+        # clock of this process, so it cannot pass rows that were stamped by another one
+        if row_list:
+            max_modification_timestamp = max(row["modification_timestamp"] for row in row_list)
+            if self.watermark is None or max_modification_timestamp > self.watermark:
+                self.watermark = max_modification_timestamp
+
+    def rebuild(self):
+        row_list = self.load_rows()
+        with self._lock:
+            self.name_set = set()
+            self.watermark = None
+            self.apply_rows(row_list)
+            self.built_p = True
+            self.refreshed_at = self.rebuilt_at = time.monotonic()
+
+    def refresh(self):
+        current_time = time.monotonic()
+        if not self.built_p or current_time - self.rebuilt_at >= self.rebuild_seconds:
+            self.rebuild()
+        elif current_time - self.refreshed_at >= self.refresh_seconds:
+            watermark = self.watermark - timedelta(seconds=WATERMARK_OVERLAP_SECONDS) if self.watermark else None
+            row_list = self.load_rows(watermark)
+            with self._lock:
+                self.apply_rows(row_list)
+                self.refreshed_at = current_time
+
+    def add(self, name, scope_id=None):
+        """
+        Record a name written by this worker so it collides before the next refresh.
+        Safe before commit, a rolled back name only costs a database check.
+        """
+        if not self.built_p or not name:
+            return
+
+        key = self.get_key(name, scope_id)
+        with self._lock:
+            self.name_set.add(key)
+
+    def check(self, name, check_database, scope_id=None):
+        """
+        Returns True when the name is free. check_database() is only called on a possible hit.
+        """
+        self.refresh()
+
+        key = self.get_key(name, scope_id)
+        with self._lock:
+            possible_hit_p = key in self.name_set
+
+        if not possible_hit_p:
+            self.definitely_available_count += 1
+            return True
+
+        self.database_check_count += 1
+        return check_database()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "name_count": len(self.name_set),
+                "watermark": self.watermark.isoformat() if self.watermark else None,
+                "definitely_available_count": self.definitely_available_count,
+                "database_check_count": self.database_check_count
+            }
+
+USERNAME_INDEX = AvailabilityIndex("user", "username")
+BRAND_PROFILE_NAME_INDEX = AvailabilityIndex("brand_profile", "brand_profile_name")
+PLAN_NAME_INDEX = AvailabilityIndex("plan", "plan_name", scope_column="brand_profile_id")
+MENU_GROUP_NAME_INDEX = AvailabilityIndex("menu_group", "menu_group_name")
+
+def get_availability_index_stats():
+    return {
+        "username": USERNAME_INDEX.stats(),
+        "brand_profile_name": BRAND_PROFILE_NAME_INDEX.stats(),
+        "plan_name": PLAN_NAME_INDEX.stats(),
+        "menu_group_name": MENU_GROUP_NAME_INDEX.stats()
+    }
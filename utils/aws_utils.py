@@ -3,6 +3,7 @@ import os
 
 import boto3
 from botocore.exceptions import ClientError
+from utils.settings import get_settings
 
 logger = logging.getLogger(__name__)
 
@@ -239,13 +240,13 @@ def publish_text_message(phone_nr, message):
     sns_publisher.publish_text_message(phone_nr, message)
 
 def publish_email(source, destination, subject, text, html):
-    if os.getenv("MOCK_AWS_NOTIFICATIONS") != "1":
+    if get_settings().mock_aws_notifications != "1":
         ses_publisher = get_aws_publisher("email")
         ses_publisher.send_email(source, destination, subject, text, html)
 
 def extract_text_from_image(image_file):
     # EXTRACT using aws textract
-    if os.getenv("MOCK_AWS_TEXTRACT") == "0":
+    if get_settings().mock_aws_textract == "0":
         textract_client = boto3.client('textract')
         api_response = textract_client.detect_document_text(
             Document={"Bytes": image_file.read()}
@@ -0,0 +1,68 @@
+import logging
+import threading
+
+# Periodic tasks
+#--------------------------------------------
+# Housekeeping jobs (sweepers, cleanup queues) run on daemon threads inside
+# every worker process. The jobs work in small batches with statements that are
+# safe to run concurrently, so several processes may run the same task.
+PERIODIC_TASKS = {}
+PERIODIC_TASKS_LOCK = threading.Lock()
+
+class PeriodicTask:
+    def __init__(self, task_name, interval_seconds, task):
+        self.task_name = task_name
+        self.interval_seconds = interval_seconds
+        self.task = task
+        self.run_count = 0
+        self.error_count = 0
+        self.last_result = None
+        self.wake_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name=task_name, daemon=True)
+
+    def run(self):
+        while True:
+            self.wake_event.wait(self.interval_seconds)
+            self.wake_event.clear()
+
+            try:
+                self.last_result = self.task()
+                self.run_count += 1
+            except Exception:  # pylint: disable=broad-except
+                self.error_count += 1
+                logging.exception("periodic task %s failed", self.task_name)
+
+    def wake(self):
+        self.wake_event.set()
+
+    def stats(self):
+        return {
+            "interval_seconds": self.interval_seconds,
+            "running_p": self.thread.is_alive(),
+            "run_count": self.run_count,
+            "error_count": self.error_count,
+            "last_result": self.last_result
+        }
+
+def start_periodic_task(task_name, interval_seconds, task):
+    """
+    Runs task() every interval_seconds on a daemon thread, once per process.
+    A non-positive interval disables the task.
+    """
+    if interval_seconds <= 0:
+        return None
+
+    with PERIODIC_TASKS_LOCK:
+        if task_name not in PERIODIC_TASKS:
+            periodic_task = PeriodicTask(task_name, interval_seconds, task)
+            periodic_task.thread.start()
+            PERIODIC_TASKS[task_name] = periodic_task
+    return PERIODIC_TASKS[task_name]
+
+def wake_periodic_task(task_name):
+    periodic_task = PERIODIC_TASKS.get(task_name)
+    if periodic_task:
+        periodic_task.wake()
+
+def get_periodic_task_stats():
+    return {task_name: periodic_task.stats() for task_name, periodic_task in PERIODIC_TASKS.items()}
@@ -0,0 +1,153 @@
+import time
+import threading
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from utils.settings import get_settings
+
+# Pool sizing
+#--------------------------------------------
+# Every gunicorn worker is a separate process with its own pools, so the
+# connections MySQL has to hold are workers * (pool_size + max_overflow) per
+# engine. DB_CONNECTION_BUDGET is what this service may use in total: each
+# worker gets an equal share, split over the primary and the replica engines.
+# An engine keeps one pooled connection per request thread and a small
+# overflow for bursts, so requests reuse connections instead of opening and
+# closing overflow connections. The primary also keeps one for every thread
+# start_background_tasks() runs with a database connection.
+CHECKOUT_WAIT_BUCKETS_MS = [1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+MIN_MAX_OVERFLOW = 2
+
+def get_background_db_thread_count(settings):
+    if not settings.background_tasks_enabled:
+        return 0
+
+    # the keycloak token refresher and executor threads do not use the database
+    thread_count = 0
+    if settings.email_outbox_worker_count > 0:
+        # the dispatcher claims batches, its workers mark the e-mails sent
+        thread_count += 1 + settings.email_outbox_worker_count
+    if settings.otp_sweep_interval_seconds > 0:
+        thread_count += 1
+    if settings.keycloak_cleanup_poll_seconds > 0:
+        thread_count += 1
+    if settings.keycloak_permission_mirror_refresh_seconds > 0:
+        thread_count += 1
+    return thread_count
+
+def get_engine_kwargs(background_p=False):
+    """
+    Pool arguments for an engine, background_p for the primary the background tasks use.
+    """
+    settings = get_settings()
+    engine_count = 1 + len(settings.mysql_replica_ip_address_list)
+    engine_budget = max(1, settings.db_connection_budget // settings.web_concurrency // engine_count)
+    thread_count = settings.gunicorn_threads + (get_background_db_thread_count(settings) if background_p else 0)
+    pool_size = min(thread_count, engine_budget)
+
+    return {
+        "pool_size": pool_size,
+        "max_overflow": min(engine_budget - pool_size, max(MIN_MAX_OVERFLOW, pool_size // 4)),
+        "pool_timeout": settings.db_pool_timeout
+    }
+
+# Pool telemetry
+#--------------------------------------------
+class PoolTelemetry:
+    def __init__(self, engine):
+        self.engine = engine
+        # kept so the listener can be removed again
+        self.connect_listener = lambda dbapi_connection, connection_record: self.record_new_connection()
+        self.checkout_count = 0
+        self.checkout_timeout_count = 0
+        self.overflow_connection_count = 0
+        self.checkout_wait_ms_total = 0.0
+        self.checkout_wait_ms_max = 0.0
+        self.checkout_wait_histogram = [0] * (len(CHECKOUT_WAIT_BUCKETS_MS) + 1)
+        self._lock = threading.Lock()
+
+    def record_checkout_wait(self, wait_ms):
+        bucket_index = len(CHECKOUT_WAIT_BUCKETS_MS)
+        for index, upper_bound_ms in enumerate(CHECKOUT_WAIT_BUCKETS_MS):
+            if wait_ms <= upper_bound_ms:
+                bucket_index = index
+                break
+
+        with self._lock:
+            self.checkout_count += 1
+            self.checkout_wait_ms_total += wait_ms
+            self.checkout_wait_ms_max = max(self.checkout_wait_ms_max, wait_ms)
+            self.checkout_wait_histogram[bucket_index] += 1
+
+    def record_checkout_timeout(self):
+        with self._lock:
+            self.checkout_timeout_count += 1
+
+    def record_new_connection(self):
+        # a connection opened while the pool is already full is an overflow connection
+        if self.engine.pool.overflow() > 0:
+            with self._lock:
+                self.overflow_connection_count += 1
+
+    def stats(self):
+        pool = self.engine.pool
+        with self._lock:
+            histogram = {f"le_{upper_bound_ms}ms": count for upper_bound_ms, count in zip(CHECKOUT_WAIT_BUCKETS_MS, self.checkout_wait_histogram)}
+            histogram["gt_{0}ms".format(CHECKOUT_WAIT_BUCKETS_MS[-1])] = self.checkout_wait_histogram[-1]
+
+            return {
+                "pool_size": pool.size(),
+                "max_overflow": pool._max_overflow,
+                "checked_out": pool.checkedout(),
+                "checked_in": pool.checkedin(),
+                "overflow": max(0, pool.overflow()),
+                "checkout_count": self.checkout_count,
+                "checkout_timeout_count": self.checkout_timeout_count,
+                "overflow_connection_count": self.overflow_connection_count,
+                "checkout_wait_ms_avg": round(self.checkout_wait_ms_total / self.checkout_count, 3) if self.checkout_count else None,
+                "checkout_wait_ms_max": round(self.checkout_wait_ms_max, 3),
+                "checkout_wait_histogram": histogram
+            }
+
+POOL_TELEMETRY = {}
+ENGINE_TELEMETRY = {}
+
+def register_engine(engine_name, engine):
+    telemetry = PoolTelemetry(engine)
+    event.listen(engine.pool, "connect", telemetry.connect_listener)
+    POOL_TELEMETRY[engine_name] = telemetry
+    ENGINE_TELEMETRY[engine] = telemetry
+    return engine
+
+def unregister_engine(engine_name):
+    """
+    Removes the telemetry listener and disposes the pool. Connections still
+    checked out stay usable and are closed when they are returned.
+    """
+    telemetry = POOL_TELEMETRY.pop(engine_name, None)
+    if telemetry is None:
+        return
+
+    ENGINE_TELEMETRY.pop(telemetry.engine, None)
+    event.remove(telemetry.engine.pool, "connect", telemetry.connect_listener)
+    telemetry.engine.dispose()
+
+def connect(engine):
+    """
+    engine.connect() that records how long the caller waited for a pooled connection.
+    """
+    telemetry = ENGINE_TELEMETRY.get(engine)
+    start_time = time.perf_counter()
+    try:
+        conn = engine.connect()
+    except PoolTimeoutError:
+        if telemetry:
+            telemetry.record_checkout_timeout()
+        raise
+
+    if telemetry:
+        telemetry.record_checkout_wait((time.perf_counter() - start_time) * 1000)
+    return conn
+
+def get_pool_stats():
+    return {engine_name: telemetry.stats() for engine_name, telemetry in POOL_TELEMETRY.items()}
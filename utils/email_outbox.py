@@ -0,0 +1,217 @@
+import json
+import uuid
+import random
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from utils import jqutils, aws_utils
+from utils.settings import get_settings
+
+# E-mail outbox
+#--------------------------------------------
+# Request handlers do not talk to SES. enqueue_email() writes a row to
+# email_outbox on the request's connection, so it commits or rolls back with
+# the rest of the request, and a background dispatcher delivers it later.
+#
+# The dispatcher claims due rows with one UPDATE ... LIMIT that stamps them with
+# a claim token, so several processes can poll the same table. Rows claimed by
+# a process that died are reclaimed after email_outbox_claim_timeout_seconds.
+# Failed sends are retried with exponential backoff and full jitter until
+# email_outbox_max_attempts, then left as failed.
+#
+# Rendering happens in the worker too: a row stores an email_type and the
+# payload for the renderer registered for that type. Payloads carry OTPs and
+# verification links, so the UPDATE that marks a row sent or finally failed
+# also clears its payload; only rows still waiting for a retry keep it.
+
+EMAIL_RENDERERS = {}
+
+def register_email_renderer(email_type):
+    """
+    Decorator for fn(payload) -> {"subject", "text", "html"}.
+    """
+    def decorator(renderer):
+        EMAIL_RENDERERS[email_type] = renderer
+        return renderer
+    return decorator
+
+def enqueue_email(email_type, recipient_email, payload, creation_user_id=None):
+    return enqueue_email_list([{
+        "email_type": email_type,
+        "recipient_email": recipient_email,
+        "payload": payload
+    }], creation_user_id)[0]
+
+def enqueue_email_list(email_list, creation_user_id=None, conn=None):
+    """
+    Queues dicts with email_type, recipient_email and payload with multi-row inserts.
+    Returns the email_outbox_id of every e-mail in order.
+    """
+    current_timestamp = datetime.utcnow()
+    email_outbox_list = [{
+        "email_type": one_email["email_type"],
+        "recipient_email": one_email["recipient_email"],
+        "payload": json.dumps(one_email["payload"]),
+        "outbox_status": "pending",
+        "attempt_count": 0,
+        "next_attempt_timestamp": current_timestamp,
+        "meta_status": "active",
+        "creation_user_id": creation_user_id
+    } for one_email in email_list]
+
+    email_outbox_id_list = jqutils.bulk_insert_db_entries(email_outbox_list, "email_outbox", capture_tenant=False, conn=conn)
+    assert len(email_outbox_id_list) == len(email_list), "failed to enqueue email"
+
+    # deliver as soon as the rows are visible instead of waiting for the next poll
+    jqutils.run_after_commit(wake_email_outbox_dispatcher)
+    return email_outbox_id_list
+
+def get_retry_delay_seconds(attempt_count):
+    settings = get_settings()
+    backoff_seconds = min(settings.email_outbox_backoff_max_seconds, settings.email_outbox_backoff_base_seconds * 2 ** (attempt_count - 1))
+    return random.uniform(0, backoff_seconds)
+
+def claim_email_outbox_batch(batch_size):
+    settings = get_settings()
+    claim_token = uuid.uuid4().hex
+    current_timestamp = datetime.utcnow()
+    stale_claim_timestamp = current_timestamp - timedelta(seconds=settings.email_outbox_claim_timeout_seconds)
+
+    with jqutils.get_db_connection() as conn:
+        query = jqutils.cached_text("""
+            UPDATE email_outbox
+            SET outbox_status = :outbox_status_sending,
+            claim_token = :claim_token,
+            claimed_timestamp = :current_timestamp
+            WHERE meta_status = :meta_status
+            AND ((outbox_status = :outbox_status_pending AND next_attempt_timestamp <= :current_timestamp)
+                OR (outbox_status = :outbox_status_sending AND claimed_timestamp < :stale_claim_timestamp))
+            ORDER BY next_attempt_timestamp
+            LIMIT :batch_size
+        """)
+        claimed_count = conn.execute(query, outbox_status_sending="sending", outbox_status_pending="pending", claim_token=claim_token,
+                            current_timestamp=current_timestamp, stale_claim_timestamp=stale_claim_timestamp, meta_status="active",
+                            batch_size=batch_size).rowcount
+        if not claimed_count:
+            return []
+
+        query = jqutils.cached_text("""
+            SELECT email_outbox_id, email_type, recipient_email, payload, attempt_count, claim_token
+            FROM email_outbox
+            WHERE claim_token = :claim_token
+        """)
+        result = conn.execute(query, claim_token=claim_token).fetchall()
+
+    return [dict(row) for row in result]
+
+def deliver_email(one_email):
+    settings = get_settings()
+    email_outbox_id = one_email["email_outbox_id"]
+    attempt_count = one_email["attempt_count"] + 1
+
+    try:
+        renderer = EMAIL_RENDERERS[one_email["email_type"]]
+        rendered_email = renderer(json.loads(one_email["payload"]))
+        aws_utils.publish_email(
+            source=settings.email_source,
+            destination={
+                "ToAddresses": [one_email["recipient_email"]],
+            },
+            subject=rendered_email["subject"],
+            text=rendered_email["text"],
+            html=rendered_email["html"]
+        )
+    except Exception as e:  # pylint: disable=broad-except
+        logging.exception("failed to deliver email_outbox_id %s", email_outbox_id)
+
+        outbox_status = "failed" if attempt_count >= settings.email_outbox_max_attempts else "pending"
+        next_attempt_timestamp = datetime.utcnow() + timedelta(seconds=get_retry_delay_seconds(attempt_count))
+        query = jqutils.cached_text("""
+            UPDATE email_outbox
+            SET outbox_status = :outbox_status, attempt_count = :attempt_count, next_attempt_timestamp = :next_attempt_timestamp,
+            last_error = :last_error, claim_token = NULL,
+            payload = CASE WHEN :outbox_status = :outbox_status_failed THEN NULL ELSE payload END
+            WHERE email_outbox_id = :email_outbox_id
+            AND claim_token = :claim_token
+        """)
+        with jqutils.get_db_connection() as conn:
+            conn.execute(query, outbox_status=outbox_status, attempt_count=attempt_count, next_attempt_timestamp=next_attempt_timestamp,
+                        last_error=str(e)[:1024], outbox_status_failed="failed", email_outbox_id=email_outbox_id, claim_token=one_email["claim_token"])
+        return False
+
+    query = jqutils.cached_text("""
+        UPDATE email_outbox
+        SET outbox_status = :outbox_status, attempt_count = :attempt_count, sent_timestamp = :sent_timestamp, claim_token = NULL,
+        payload = NULL
+        WHERE email_outbox_id = :email_outbox_id
+        AND claim_token = :claim_token
+    """)
+    with jqutils.get_db_connection() as conn:
+        conn.execute(query, outbox_status="sent", attempt_count=attempt_count, sent_timestamp=datetime.utcnow(),
+                    email_outbox_id=email_outbox_id, claim_token=one_email["claim_token"])
+    return True
+
+def dispatch_email_outbox(executor=None):
+    """
+    Claim and deliver one batch. Returns the number of claimed e-mails.
+    """
+    email_list = claim_email_outbox_batch(get_settings().email_outbox_batch_size)
+    if executor is None:
+        for one_email in email_list:
+            deliver_email(one_email)
+    else:
+        list(executor.map(deliver_email, email_list))
+    return len(email_list)
+
+# Dispatcher thread
+#--------------------------------------------
+EMAIL_OUTBOX_WAKE_EVENT = threading.Event()
+EMAIL_OUTBOX_DISPATCHER = None
+EMAIL_OUTBOX_DISPATCHER_LOCK = threading.Lock()
+
+def wake_email_outbox_dispatcher():
+    EMAIL_OUTBOX_WAKE_EVENT.set()
+
+def run_email_outbox_dispatcher():
+    settings = get_settings()
+    executor = ThreadPoolExecutor(max_workers=settings.email_outbox_worker_count, thread_name_prefix="email-outbox")
+
+    while True:
+        try:
+            # keep draining while full batches come back
+            while dispatch_email_outbox(executor) >= get_settings().email_outbox_batch_size:
+                pass
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("email outbox dispatch failed")
+
+        EMAIL_OUTBOX_WAKE_EVENT.wait(get_settings().email_outbox_poll_seconds)
+        EMAIL_OUTBOX_WAKE_EVENT.clear()
+
+def start_email_outbox_dispatcher():
+    global EMAIL_OUTBOX_DISPATCHER
+
+    if get_settings().email_outbox_worker_count <= 0:
+        return None
+
+    with EMAIL_OUTBOX_DISPATCHER_LOCK:
+        if EMAIL_OUTBOX_DISPATCHER is None:
+            EMAIL_OUTBOX_DISPATCHER = threading.Thread(target=run_email_outbox_dispatcher, name="email-outbox-dispatcher", daemon=True)
+            EMAIL_OUTBOX_DISPATCHER.start()
+    return EMAIL_OUTBOX_DISPATCHER
+
+def get_email_outbox_stats():
+    query = jqutils.cached_text("""
+        SELECT outbox_status, COUNT(*) AS email_count, MIN(next_attempt_timestamp) AS oldest_next_attempt_timestamp
+        FROM email_outbox
+        WHERE meta_status = :meta_status
+        GROUP BY outbox_status
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, meta_status="active").fetchall()
+
+    return {
+        "dispatcher_running_p": EMAIL_OUTBOX_DISPATCHER is not None and EMAIL_OUTBOX_DISPATCHER.is_alive(),
+        "status_list": [dict(row) for row in result]
+    }
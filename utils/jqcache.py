@@ -0,0 +1,293 @@
+import json
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+class LRUCache:
+    """
+    Thread-safe bounded least-recently-used cache with hit/miss/eviction counters.
+    With ttl_seconds set, entries older than that are treated as misses.
+    """
+
+    def __init__(self, maxsize=512, ttl_seconds=None):
+        assert maxsize > 0, "maxsize must be positive"
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                expires_at, value = self._data[key]
+                if expires_at is None or expires_at > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def get_or_build(self, key, build):
+        # building outside the lock is fine, two threads may build the same value once
+        value = self.get(key)
+        if value is None:
+            value = build()
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            expires_at, value = self._data.pop(key, (None, None))
+            return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookup_count = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": round(self.hits / lookup_count, 4) if lookup_count else None
+            }
+
+# sets the value only if neither the namespace epoch nor the key's generation changed since the reader's snapshot
+SET_IF_GENERATION_SCRIPT = """
+if (redis.call('get', KEYS[1]) or '') ~= ARGV[1] or (redis.call('get', KEYS[2]) or '') ~= ARGV[2] then
+    return 0
+end
+if ARGV[4] == '0' then
+    redis.call('set', KEYS[3], ARGV[3])
+else
+    redis.call('set', KEYS[3], ARGV[3], 'EX', ARGV[4])
+end
+return 1
+"""
+# generation keys outlive any load that snapshotted them
+MIN_GENERATION_TTL_SECONDS = 60
+# other processes only learn about invalidations through Redis, without it their local copies live at most this long
+LOCAL_ONLY_MAX_TTL_SECONDS = 5
+
+def decode_generation(raw_generation_list):
+    return [value.decode() if value is not None else "" for value in raw_generation_list]
+
+class TieredCache:
+    """
+    In-process LRUCache in front of an optional shared Redis tier.
+    Values must be JSON serialisable. Redis errors degrade to the local tier only.
+
+    A reader that loads a missing value cannot tell whether an invalidation
+    happened while it was loading, so it takes get_generation() before the
+    load and stores with set_if_generation(), which drops the value if
+    invalidate() or clear() ran in between, in this process or (with Redis)
+    in any other.
+
+    Every process keeps its own local tier. A local copy remembers the Redis
+    generation it was filled under and is only served while that generation is
+    unchanged, so an invalidation in one process reaches all of them at the
+    cost of one small Redis read per local hit. Without Redis nothing reaches
+    the other processes and local copies expire after LOCAL_ONLY_MAX_TTL_SECONDS.
+    """
+
+    def __init__(self, namespace, maxsize=512, ttl_seconds=None, redis_url=None):
+        self.namespace = namespace
+        local_ttl_seconds = ttl_seconds if redis_url else min(ttl_seconds or LOCAL_ONLY_MAX_TTL_SECONDS, LOCAL_ONLY_MAX_TTL_SECONDS)
+        # entries are (value, redis generation, filled at)
+        self.local = LRUCache(maxsize, local_ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.redis_errors = 0
+        self.stale_fill_count = 0
+        self.stale_hit_count = 0
+        # bumped by every local invalidation, a fill only lands if it did not move
+        self.generation = 0
+        self._lock = threading.Lock()
+        self.redis_client = None
+        self.set_if_generation_script = None
+        if redis_url:
+            assert redis is not None, "REDIS_URL is set but the redis package is not installed"
+            self.redis_client = redis.Redis.from_url(redis_url)
+            self.set_if_generation_script = self.redis_client.register_script(SET_IF_GENERATION_SCRIPT)
+
+    def get_redis_key(self, key):
+        if isinstance(key, (tuple, list)):
+            key = ":".join(str(part) for part in key)
+        return f"{self.namespace}:{key}"
+
+    def get_redis_generation_key_list(self, key):
+        # outside the namespace, so clear() keeps the epoch
+        return [f"{self.namespace}-epoch", f"{self.namespace}-generation:{self.get_redis_key(key)}"]
+
+    def get_generation(self, key):
+        with self._lock:
+            local_generation = self.generation
+
+        redis_generation = None
+        if self.redis_client is not None:
+            try:
+                redis_generation = decode_generation(self.redis_client.mget(self.get_redis_generation_key_list(key)))
+            except redis.RedisError:
+                logging.exception("redis generation get failed")
+                self.redis_errors += 1
+        return local_generation, redis_generation
+
+    def set_if_generation(self, key, value, generation):
+        """
+        Stores a freshly loaded value unless the key was invalidated since get_generation(). Returns True if stored.
+        """
+        local_generation, redis_generation = generation
+        with self._lock:
+            if local_generation != self.generation:
+                self.stale_fill_count += 1
+                return False
+            self.local.set(key, (value, redis_generation, time.monotonic()))
+
+        if self.redis_client is not None and redis_generation is not None:
+            try:
+                stored = self.set_if_generation_script(keys=self.get_redis_generation_key_list(key) + [self.get_redis_key(key)],
+                                                    args=redis_generation + [json.dumps(value, default=str), self.ttl_seconds or 0])
+            except redis.RedisError:
+                logging.exception("redis set failed")
+                self.redis_errors += 1
+                stored = 1
+            if not stored:
+                # another process invalidated the key while this one was loading
+                self.local.delete(key)
+                self.stale_fill_count += 1
+                return False
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self.generation += 1
+            self.local.delete(key)
+
+        if self.redis_client is not None:
+            generation_key = self.get_redis_generation_key_list(key)[1]
+            try:
+                pipeline = self.redis_client.pipeline()
+                pipeline.incr(generation_key)
+                pipeline.expire(generation_key, max(self.ttl_seconds or 0, MIN_GENERATION_TTL_SECONDS))
+                pipeline.delete(self.get_redis_key(key))
+                pipeline.execute()
+            except redis.RedisError:
+                logging.exception("redis invalidate failed")
+                self.redis_errors += 1
+
+    def is_local_entry_current(self, key, redis_generation, filled_at):
+        if self.redis_client is None:
+            return True
+
+        if redis_generation is not None:
+            try:
+                return decode_generation(self.redis_client.mget(self.get_redis_generation_key_list(key))) == redis_generation
+            except redis.RedisError:
+                logging.exception("redis generation get failed")
+                self.redis_errors += 1
+        # nothing to compare with, the copy is served like a local-only one
+        return time.monotonic() - filled_at < LOCAL_ONLY_MAX_TTL_SECONDS
+
+    def get(self, key, default=None):
+        entry = self.local.get(key)
+        if entry is not None:
+            value, redis_generation, filled_at = entry
+            if self.is_local_entry_current(key, redis_generation, filled_at):
+                return value
+            # invalidated by another process
+            self.local.delete(key)
+            self.stale_hit_count += 1
+
+        if self.redis_client is None:
+            return default
+
+        try:
+            # one MULTI, so the value and its generation cannot straddle an invalidate()
+            pipeline = self.redis_client.pipeline()
+            pipeline.mget(self.get_redis_generation_key_list(key))
+            pipeline.get(self.get_redis_key(key))
+            raw_generation_list, raw_value = pipeline.execute()
+        except redis.RedisError:
+            logging.exception("redis get failed")
+            self.redis_errors += 1
+            return default
+
+        if raw_value is None:
+            self.redis_misses += 1
+            return default
+
+        self.redis_hits += 1
+        value = json.loads(raw_value)
+        self.local.set(key, (value, decode_generation(raw_generation_list), time.monotonic()))
+        return value
+
+    def set(self, key, value):
+        redis_generation = self.get_generation(key)[1]
+        self.local.set(key, (value, redis_generation, time.monotonic()))
+        if self.redis_client is not None:
+            try:
+                self.redis_client.set(self.get_redis_key(key), json.dumps(value, default=str), ex=self.ttl_seconds)
+            except redis.RedisError:
+                logging.exception("redis set failed")
+                self.redis_errors += 1
+
+    def delete(self, key):
+        self.local.delete(key)
+        if self.redis_client is not None:
+            try:
+                self.redis_client.delete(self.get_redis_key(key))
+            except redis.RedisError:
+                logging.exception("redis delete failed")
+                self.redis_errors += 1
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self.local.clear()
+        if self.redis_client is not None:
+            try:
+                self.redis_client.incr(f"{self.namespace}-epoch")
+                for redis_key in self.redis_client.scan_iter(match=f"{self.namespace}:*"):
+                    self.redis_client.delete(redis_key)
+            except redis.RedisError:
+                logging.exception("redis clear failed")
+                self.redis_errors += 1
+
+    def stats(self):
+        return {
+            "local": self.local.stats(),
+            "stale_fill_count": self.stale_fill_count,
+            "stale_hit_count": self.stale_hit_count,
+            "redis": {
+                "enabled_p": self.redis_client is not None,
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "errors": self.redis_errors
+            }
+        }
@@ -1,9 +1,9 @@
-import os
 import boto3
 import botocore
 import logging
 
 from botocore.exceptions import ClientError
+from utils.settings import get_settings
 
 def upload_fileobj(file, bucket, object_name=None):
     """Upload a file to an S3 bucket
@@ -14,7 +14,7 @@ def upload_fileobj(file, bucket, object_name=None):
     :return: True if file was uploaded, else False
     """
 
-    if os.getenv("MOCK_S3_UPLOAD") != "0":
+    if get_settings().mock_s3_upload != "0":
         return True
     # Upload the file
     s3_client = boto3.client('s3')
@@ -48,7 +48,7 @@ def upload_file(file_name, bucket, object_name=None):
     return True
 
 def put_object(file, bucket, object_name=None):
-    if os.getenv("MOCK_S3_UPLOAD") != "0":
+    if get_settings().mock_s3_upload != "0":
         return True
     # Upload the file
     s3_client = boto3.client('s3')
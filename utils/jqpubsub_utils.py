@@ -53,8 +53,7 @@ def publish_order_level_event(order_event_dict, message_attributes_dict, message
                     :message_deduplication_id_str, :meta_status)
                     """
                 )
-    db_engine = jqutils.get_db_engine()  
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         publishing_queue_id = conn.execute(pub_query, customer_order_id=customer_order_id, message=message_str, message_attributes=message_attributes_str, 
         order_event=order_event, message_deduplication_id_str=message_deduplication_id_str, meta_status="pending").lastrowid
         assert publishing_queue_id,  "could not insert into publishing_queue"
@@ -88,8 +87,7 @@ def publish_order_level_event(order_event_dict, message_attributes_dict, message
                     
                     """
                 )
-        db_engine = jqutils.get_db_engine()  
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             update_publishing_queue_id = conn.execute(pub_update_query, message_id=publish_result, meta_status="published",
             publishing_queue_order_id=publishing_queue_id).rowcount
 
@@ -116,8 +114,7 @@ def publish_line_item_level_event_v2(line_item_event_dict, message_attributes_di
                     values(:order_line_item_id, :message, :message_attributes, :order_line_item_event, :message_deduplication_id_str, :meta_status)
                     """
                 )
-    db_engine = jqutils.get_db_engine()  
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         publishing_queue_id = conn.execute(pub_query, order_line_item_id=order_line_item_id, message=message_str,
         message_attributes=message_attributes_str, order_line_item_event=order_line_item_event, 
         message_deduplication_id_str=message_deduplication_id_str, meta_status="pending").lastrowid
@@ -138,8 +135,7 @@ def publish_line_item_level_event_v2(line_item_event_dict, message_attributes_di
                     
                     """
                 )
-        db_engine = jqutils.get_db_engine()  
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             update_publishing_queue_id = conn.execute(pub_update_query, message_id=publish_result, meta_status="published",
             publishing_queue_line_item_id=publishing_queue_id).rowcount
 
@@ -168,8 +164,7 @@ def publish_line_item_level_step_event(line_item_event_dict, message_attributes_
                     values(:order_line_item_id, :message, :message_attributes, :order_line_item_event, :message_deduplication_id_str, :meta_status)
                     """
                 )
-    db_engine = jqutils.get_db_engine()  
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         publishing_queue_id = conn.execute(pub_query, order_line_item_id=order_line_item_id, message=message_str,
         message_attributes=message_attributes_str, order_line_item_event=order_line_item_event, 
         message_deduplication_id_str=message_deduplication_id_str, meta_status="pending").lastrowid
@@ -190,8 +185,7 @@ def publish_line_item_level_step_event(line_item_event_dict, message_attributes_
                     
                     """
                 )
-        db_engine = jqutils.get_db_engine()  
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             update_publishing_queue_id = conn.execute(pub_update_query, message_id=publish_result, meta_status="published",
             publishing_queue_line_item_id=publishing_queue_id).rowcount
 
@@ -219,8 +213,7 @@ def publish_config_event(config_event_dict, message_attributes_dict, message_ded
                     values(:station_id, :message, :message_attributes, :config_event, :message_deduplication_id_str, :meta_status)
                     """
                 )
-    db_engine = jqutils.get_db_engine()  
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         publishing_queue_id = conn.execute(pub_query, station_id=station_id, message=message_str,
         message_attributes=message_attributes_str, config_event=config_event, 
         message_deduplication_id_str=message_deduplication_id_str, meta_status="pending").lastrowid
@@ -241,8 +234,7 @@ def publish_config_event(config_event_dict, message_attributes_dict, message_ded
                     
                     """
                 )
-        db_engine = jqutils.get_db_engine()  
-        with db_engine.connect() as conn:
+        with jqutils.get_db_connection() as conn:
             update_publishing_queue_id = conn.execute(pub_update_query, message_id=publish_result, meta_status="published",
             publishing_queue_config_id=publishing_queue_id).rowcount
 
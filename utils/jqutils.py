@@ -8,112 +8,321 @@ import logging
 import secrets
 import boto3
 import urllib
+import json
+import base64
+import csv
+import itertools
+import time
 
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
 from botocore.exceptions import ClientError
-from dotenv import load_dotenv
-from flask import g
+from flask import g, has_request_context
 
-from utils import aws_utils
+from utils import aws_utils, jqcache, db_pool_manager
+from utils.settings import get_settings, register_reload_callback
 
 ENGINES = {}
-ENGINE_KWARGS = {'pool_pre_ping': True, 'pool_size': 250, 'pool_recycle': 600, 'isolation_level': 'READ COMMITTED'}
+MYSQL_DUPLICATE_ENTRY_ERROR = 1062
+ENGINE_KWARGS = {'pool_pre_ping': True, 'pool_recycle': 600, 'isolation_level': 'READ COMMITTED'}
 
 def get_db_engine(db_schema=None, connection_name=None):
-    load_dotenv(dotenv_path='./.env')
+    settings = get_settings()
 
     if connection_name:
         assert connection_name in ['DEV'], 'connection name is not correct'
         connection_prefix = "mysql+pymysql://"
-        database_user = os.environ.get(f'{connection_name}_MYSQL_USER')
-        database_password = os.environ.get(f'{connection_name}_MYSQL_PASSWORD')
-        host = os.environ.get(f'{connection_name}_MYSQL_IP_ADDRESS')
-        port = os.environ.get(f'{connection_name}_MYSQL_PORT')
-        db_schema = db_schema if db_schema else os.environ.get(f'{connection_name}_MYSQL_SCHEMA_NAME')
+        database_user = settings.get(f'{connection_name}_MYSQL_USER')
+        database_password = settings.get(f'{connection_name}_MYSQL_PASSWORD')
+        host = settings.get(f'{connection_name}_MYSQL_IP_ADDRESS')
+        port = settings.get(f'{connection_name}_MYSQL_PORT')
+        db_schema = db_schema if db_schema else settings.get(f'{connection_name}_MYSQL_SCHEMA_NAME')
         connect_args = {}
 
         engine_name = 'ENGINE' + db_schema
 
     else:
         connection_prefix = "mysql+pymysql://"
-        database_user = os.environ.get('MYSQL_USER')
-        database_password = os.environ.get('MYSQL_PASSWORD')
-        host = os.environ.get('MYSQL_IP_ADDRESS')
-        port = "3306"
-        db_schema = db_schema if db_schema else os.environ.get('MYSQL_SCHEMA_NAME')
-        connect_args = {}
+        database_user = settings.mysql_user
+        database_password = settings.mysql_password
+        host = settings.mysql_ip_address
+        port = settings.mysql_port
+        db_schema = db_schema if db_schema else settings.mysql_schema_name
+        # LOAD DATA LOCAL INFILE for the csv loader has to be allowed by the client as well
+        connect_args = {'local_infile': True} if settings.mysql_local_infile else {}
 
         engine_name = 'ENGINE' + db_schema
 
     
     if engine_name not in ENGINES:
-        ENGINES[engine_name] = create_engine(connection_prefix + database_user + ":" + database_password + "@" + host + ':' + port + '/' + db_schema, connect_args=connect_args, **ENGINE_KWARGS)
+        # pool_size / max_overflow come from the worker count and the connection budget
+        engine = create_engine(connection_prefix + database_user + ":" + database_password + "@" + host + ':' + port + '/' + db_schema,
+                               connect_args=connect_args, **ENGINE_KWARGS, **db_pool_manager.get_engine_kwargs(background_p=not connection_name))
+        ENGINES[engine_name] = db_pool_manager.register_engine(engine_name, engine)
     return ENGINES[engine_name]
 
+@register_reload_callback
+def reset_db_engines(settings):
+    # engines are rebuilt lazily with the new credentials and pool sizes, connections in use finish on the old ones
+    for engine_name in list(ENGINES):
+        db_pool_manager.unregister_engine(engine_name)
+    ENGINES.clear()
+    REPLICA_LAG_CHECKS.clear()
+
+# Read replicas
+#--------------------------------------------
+# MYSQL_REPLICA_IP_ADDRESSES is a comma separated list of replicas of the
+# primary (same user, schema and port). Read-only connections are spread
+# round-robin over the replicas whose replication lag is at most
+# MYSQL_REPLICA_MAX_LAG_SECONDS; the lag is probed at most every
+# MYSQL_REPLICA_LAG_CHECK_SECONDS per replica. Without healthy replicas
+# reads go to the primary.
+REPLICA_LAG_CHECKS = {}
+REPLICA_ROUND_ROBIN = itertools.count()
+
+def get_db_replica_engines(db_schema=None):
+    settings = get_settings()
+    replica_host_list = settings.mysql_replica_ip_address_list
+    if not replica_host_list:
+        return []
+
+    database_user = settings.mysql_user
+    database_password = settings.mysql_password
+    port = settings.mysql_port
+    db_schema = db_schema if db_schema else settings.mysql_schema_name
+
+    engine_list = []
+    for host in replica_host_list:
+        engine_name = 'REPLICA' + host + db_schema
+        if engine_name not in ENGINES:
+            engine = create_engine("mysql+pymysql://" + database_user + ":" + database_password + "@" + host + ':' + port + '/' + db_schema,
+                                   **ENGINE_KWARGS, **db_pool_manager.get_engine_kwargs())
+            ENGINES[engine_name] = db_pool_manager.register_engine(engine_name, engine)
+        engine_list.append(ENGINES[engine_name])
+    return engine_list
+
+def get_db_replica_lag_seconds(engine):
+    # None means the replica is unusable: replication stopped or the probe failed
+    check_interval_seconds = get_settings().mysql_replica_lag_check_seconds
+    last_check = REPLICA_LAG_CHECKS.get(engine)
+    if last_check and time.monotonic() - last_check[0] < check_interval_seconds:
+        return last_check[1]
+
+    lag_seconds = None
+    try:
+        with engine.connect() as conn:
+            try:
+                result = conn.execute(text("SHOW REPLICA STATUS")).fetchone()
+                lag_column = "Seconds_Behind_Source"
+            except Exception:
+                # MySQL < 8.0.22
+                result = conn.execute(text("SHOW SLAVE STATUS")).fetchone()
+                lag_column = "Seconds_Behind_Master"
+        if result and result[lag_column] is not None:
+            lag_seconds = int(result[lag_column])
+    except Exception as e:
+        logging.warning(f"replica lag probe failed for {engine.url.host}: {e}")
+
+    REPLICA_LAG_CHECKS[engine] = (time.monotonic(), lag_seconds)
+    return lag_seconds
+
+def get_db_read_engine():
+    max_lag_seconds = get_settings().mysql_replica_max_lag_seconds
+    replica_engine_list = get_db_replica_engines()
+
+    for _ in range(len(replica_engine_list)):
+        engine = replica_engine_list[next(REPLICA_ROUND_ROBIN) % len(replica_engine_list)]
+        lag_seconds = get_db_replica_lag_seconds(engine)
+        if lag_seconds is not None and lag_seconds <= max_lag_seconds:
+            return engine
+
+    return get_db_engine()
+
+def get_db_replica_stats():
+    return [{
+        "host": engine.url.host,
+        "lag_seconds": REPLICA_LAG_CHECKS.get(engine, (None, None))[1]
+    } for engine in get_db_replica_engines()]
+
+# Request-scoped unit of work
+#--------------------------------------------
+# Inside a request every helper shares one pooled connection and one transaction
+# stored on flask.g. api.after_request commits it and api.teardown_request rolls
+# back whatever is left (e.g. on an unhandled error) and releases the connection.
+# Outside a request (fixtures, migrations, background jobs) a standalone
+# autocommit connection is used, as before.
+#
+# GET requests are marked read-only in api.before_request and their reads go to
+# a replica. As soon as a request touches the primary (any write, or an explicit
+# read_only=False) the rest of the request is pinned to the primary so it reads
+# its own writes.
+#
+# External side effects (Keycloak) cannot join the transaction. They either
+# run after commit (run_after_commit, or a queue written in the transaction)
+# or, when the rows need their result, run inside the request and register an
+# undo with run_after_rollback.
+
+def get_request_db_connection():
+    if "db_connection" not in g:
+        g.db_connection = db_pool_manager.connect(get_db_engine())
+        g.db_transaction = g.db_connection.begin()
+    g.db_write_p = True
+    return g.db_connection
+
+def get_request_db_read_connection():
+    if g.get("db_write_p"):
+        return g.db_connection
+    if "db_read_connection" not in g:
+        g.db_read_connection = db_pool_manager.connect(get_db_read_engine())
+    return g.db_read_connection
+
+@contextmanager
+def get_db_connection(read_only=None):
+    if has_request_context():
+        if read_only is None:
+            read_only = g.get("db_read_only_p", False)
+        yield get_request_db_read_connection() if read_only else get_request_db_connection()
+    else:
+        engine = get_db_read_engine() if read_only else get_db_engine()
+        with db_pool_manager.connect(engine) as conn:
+            yield conn
+
+@contextmanager
+def get_db_transaction():
+    # same as get_db_connection() but outside a request the statements are grouped in one transaction
+    if has_request_context():
+        yield get_request_db_connection()
+    else:
+        with db_pool_manager.connect(get_db_engine()) as conn:
+            with conn.begin():
+                yield conn
+
+def run_after_commit(callback):
+    """
+    Run callback once the request's unit of work is committed, e.g. cache
+    invalidation that must not race with readers of the old rows. It is dropped
+    on rollback. Outside a request statements autocommit, so it runs right away.
+    """
+    if has_request_context():
+        g.setdefault("db_after_commit_callbacks", []).append(callback)
+    else:
+        callback()
+
+def run_after_rollback(callback):
+    """
+    Run callback if the request's unit of work is rolled back, to undo an
+    external side effect the rows depend on (e.g. a Keycloak user whose id is
+    stored in the transaction). It is dropped on commit. Outside a request
+    statements autocommit and there is nothing to undo.
+    """
+    if has_request_context():
+        g.setdefault("db_after_rollback_callbacks", []).append(callback)
+
+def run_request_db_callbacks(callback_list, name):
+    for callback in callback_list:
+        try:
+            callback()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("%s callback failed", name)
+
+def commit_request_db_transaction():
+    db_transaction = g.pop("db_transaction", None)
+    if db_transaction is not None and db_transaction.is_active:
+        db_transaction.commit()
+
+    g.pop("db_after_rollback_callbacks", None)
+    run_request_db_callbacks(g.pop("db_after_commit_callbacks", []), "after commit")
+
+def rollback_request_db_transaction():
+    g.pop("db_after_commit_callbacks", None)
+    db_transaction = g.pop("db_transaction", None)
+    # an inactive transaction still has to be rolled back to release the connection's state
+    if db_transaction is not None:
+        db_transaction.rollback()
+
+    run_request_db_callbacks(g.pop("db_after_rollback_callbacks", []), "after rollback")
+
+def close_request_db_connection():
+    rollback_request_db_transaction()
+    for connection_name in ["db_connection", "db_read_connection"]:
+        db_connection = g.pop(connection_name, None)
+        if db_connection is not None:
+            db_connection.close()
+
+# Statement registry
+#--------------------------------------------
+# SQL built by the jq_prepare_* helpers only depends on the table and the
+# column names, so it is built once per (kind, table, columns, condition keys)
+# and reused. cached_text() does the same for the text() literals of the
+# blueprints. Both share one bounded LRU whose counters are reported by
+# /api/healthcheck/statement-cache.
+STATEMENT_CACHE = jqcache.LRUCache(get_settings().statement_cache_size)
+
+def get_cached_statement(key, build):
+    return STATEMENT_CACHE.get_or_build(key, build)
+
+def cached_text(query):
+    return STATEMENT_CACHE.get_or_build(("text", query), lambda: text(query))
+
+def get_statement_cache_stats():
+    return STATEMENT_CACHE.stats()
+
 def jq_prepare_insert_statement(table_name, one_row_dict):
     query = """
     INSERT INTO {0} ({1}) VALUES ({2});
     """
     one_dict = dict(one_row_dict)
-    columns = ','.join(one_dict.keys())
-    placeholders = ','.join(['%s'] * len(one_dict))
+    column_tuple = tuple(one_dict.keys())
     values_list = list(one_dict.values())
-    return (query.format(table_name, columns, placeholders), values_list)
+    statement = get_cached_statement(("insert", table_name, column_tuple, ()),
+                    lambda: query.format(table_name, ','.join(column_tuple), ','.join(['%s'] * len(column_tuple))))
+    return (statement, values_list)
 
 def jq_prepare_insert_statement_v2(table_name, one_row_dict, g):
     one_row_dict["meta_status"] = "active"
     one_row_dict["tenant_id"] = g.tenant_id
     one_row_dict["creation_user_id"] = g.user_id
-    query = """
-    INSERT INTO {0} ({1}) VALUES ({2});
-    """
-    one_dict = dict(one_row_dict)
-    columns = ','.join(one_dict.keys())
-    placeholders = ','.join(['%s'] * len(one_dict))
-    values_list = list(one_dict.values())
-    return (query.format(table_name, columns, placeholders), values_list)
+    return jq_prepare_insert_statement(table_name, one_row_dict)
 
 def jq_prepare_insert_statement_multi_rows(table_name, dict_list):
     query = """
     INSERT INTO {0} ({1}) VALUES ({2});
     """
+    column_list = None
     row_list = []
     for one_dict in dict_list:
         one_dict = dict(one_dict)
-        columns = ','.join(one_dict.keys())
-        placeholders = ','.join(['%s'] * len(one_dict))
-        values_list = list(one_dict.values())
-        row_list.append(values_list)
-    
-    # one_dict = dict(one_row_dict)
-    # columns = ','.join(one_dict.keys())
-    
-    # placeholders = ','.join(['%s'] * len(one_dict))
-    # values_list = list(one_dict.values())
-    return (query.format(table_name, columns, placeholders), row_list)
+        if column_list is None:
+            column_list = list(one_dict.keys())
+        assert one_dict.keys() == set(column_list), f"all rows inserted into {table_name} must have the same columns"
+        row_list.append([one_dict[column] for column in column_list])
+
+    assert column_list, f"no rows to insert into {table_name}"
+    column_tuple = tuple(column_list)
+    statement = get_cached_statement(("insert", table_name, column_tuple, ()),
+                    lambda: query.format(table_name, ','.join(column_tuple), ','.join(['%s'] * len(column_tuple))))
+    return (statement, row_list)
 
 def jq_prepare_insert_statement_multi_rows_v2(table_name, dict_list,g):
-    query = """
-    INSERT INTO {0} ({1}) VALUES ({2});
-    """
-    row_list = []
+    tenant_dict_list = []
     for one_dict in dict_list:
         one_dict["meta_status"] = "active"
         one_dict["tenant_id"] = g.tenant_id
         one_dict["creation_user_id"] = g.user_id
-        one_dict = dict(one_dict)
-        columns = ','.join(one_dict.keys())
-        placeholders = ','.join(['%s'] * len(one_dict))
-        values_list = list(one_dict.values())
-        row_list.append(values_list)
-    
-    # one_dict = dict(one_row_dict)
-    # columns = ','.join(one_dict.keys())
-    
-    # placeholders = ','.join(['%s'] * len(one_dict))
-    # values_list = list(one_dict.values())
-    return (query.format(table_name, columns, placeholders), row_list)
+        tenant_dict_list.append(one_dict)
+    return jq_prepare_insert_statement_multi_rows(table_name, tenant_dict_list)
+
+def jq_prepare_bulk_insert_statement(table_name, column_list, row_count):
+    query = """
+    INSERT INTO {0} ({1}) VALUES {2};
+    """
+    column_tuple = tuple(column_list)
+    # only the column part is cached, the row count varies from chunk to chunk
+    columns, placeholders = get_cached_statement(("bulk_insert", table_name, column_tuple, ()),
+                    lambda: (','.join(column_tuple), '(' + ','.join(['%s'] * len(column_tuple)) + ')'))
+    return query.format(table_name, columns, ','.join([placeholders] * row_count))
 
 def jq_prepare_update_statement(table_name, one_row_dict, condition, user_id):
     one_row_dict["modification_user_id"] = user_id
@@ -122,14 +331,16 @@ def jq_prepare_update_statement(table_name, one_row_dict, condition, user_id):
     UPDATE {0} SET {1} WHERE {2};
     """
     one_dict = dict(one_row_dict)
-    columns = ""
-    for i in one_dict.keys():
-        columns = columns + i + " = " + '%s, '
-    where = ''.join(condition.keys()) + " = " + ''.join(['%s'] * len(condition))
+    column_tuple = tuple(one_dict.keys())
+    condition_tuple = tuple(condition.keys())
+    def build():
+        columns = ', '.join([column + " = %s" for column in column_tuple])
+        where = ''.join(condition_tuple) + " = " + ''.join(['%s'] * len(condition_tuple))
+        return query.format(table_name, columns, where)
     values_list = list(one_dict.values())
     values_list.append(''.join(condition.values()))
 
-    return (query.format(table_name, columns[:-2], where), values_list)
+    return (get_cached_statement(("update", table_name, column_tuple, condition_tuple), build), values_list)
 
 def jq_prepare_update_statement_v2(table_name, one_row_dict, condition, g):
     one_row_dict["tenant_id"] = g.tenant_id
@@ -140,17 +351,16 @@ def jq_prepare_update_statement_v2(table_name, one_row_dict, condition, g):
     UPDATE {0} SET {1} WHERE {2};
     """
     one_dict = dict(one_row_dict)
-    columns = ""
-    for i in one_dict.keys():
-        columns = columns + i + " = " + '%s, '
-    where_conditions = []
-    for key, value in condition.items():
-        where_conditions.append(f"{key} = %s")
-    where = ' AND '.join(where_conditions)
+    column_tuple = tuple(one_dict.keys())
+    condition_tuple = tuple(condition.keys())
+    def build():
+        columns = ', '.join([column + " = %s" for column in column_tuple])
+        where = ' AND '.join([f"{key} = %s" for key in condition_tuple])
+        return query.format(table_name, columns, where)
     values_list = list(one_dict.values())
     values_list.extend(list(condition.values()))
 
-    return (query.format(table_name, columns[:-2], where), values_list)
+    return (get_cached_statement(("update_v2", table_name, column_tuple, condition_tuple), build), values_list)
 
 # Random Alphanumeric Generator
 def get_random_alphanumeric(length):
@@ -190,27 +400,137 @@ def get_local_date(timezone_offset_hours):
     return local_date
 
 
-def upload_csv_map(target_table_name, source_filename, table_list):
-    count = 0
-    db_engine = get_db_engine()
+# CSV loading
+#--------------------------------------------
+# CSV files are streamed with the csv module and loaded with chunked multi-row
+# inserts, or with LOAD DATA LOCAL INFILE when MYSQL_LOCAL_INFILE=1 and the
+# server allows it. progress_callback(stats) is called after every chunk and
+# the final stats (rows, seconds, rows per second) are returned.
+CSV_LOAD_CHUNK_ROWS = 5000
+CSV_MAP_CHUNK_ROWS = 1000
+
+def stream_csv_rows(source_filename, delimiter='|', append_dict=None):
+    with open(source_filename, encoding="utf8", newline='') as fp:
+        reader = csv.reader(fp, delimiter=delimiter, quoting=csv.QUOTE_NONE)
+        header_list = [column.strip() for column in next(reader)]
+
+        for one_row in reader:
+            if not one_row or not ''.join(one_row).strip():
+                continue
+            one_dict = {column: (None if value.strip() == 'None' else value.strip()) for column, value in zip(header_list, one_row)}
+            if append_dict:
+                one_dict.update(append_dict)
+            yield one_dict
+
+def get_csv_load_stats(table_name, method, row_count, start_time):
+    seconds = time.perf_counter() - start_time
+    return {
+        "table_name": table_name,
+        "method": method,
+        "row_count": row_count,
+        "seconds": round(seconds, 3),
+        "rows_per_second": round(row_count / seconds) if seconds else None
+    }
+
+def local_infile_available_p(conn):
+    if not get_settings().mysql_local_infile:
+        return False
+    result = conn.execute(text("SELECT @@local_infile AS local_infile")).fetchone()
+    return bool(result and int(result["local_infile"]))
+
+def load_csv_local_infile(conn, target_table_name, source_filename, append_dict):
+    with open(source_filename, encoding="utf8", newline='') as fp:
+        header_list = [column.strip() for column in next(csv.reader(fp, delimiter='|', quoting=csv.QUOTE_NONE))]
+
+    variable_list = [f"@c{index}" for index in range(len(header_list))]
+    set_list = [f"{column} = NULLIF(TRIM(TRAILING '\\r' FROM {variable}), 'None')" for column, variable in zip(header_list, variable_list)]
+    set_list += [f"{column} = %s" for column in append_dict]
+
+    query = f"""
+        LOAD DATA LOCAL INFILE %s
+        INTO TABLE {target_table_name}
+        CHARACTER SET utf8mb4
+        FIELDS TERMINATED BY '|'
+        LINES TERMINATED BY '\\n'
+        IGNORE 1 LINES
+        ({','.join(variable_list)})
+        SET {', '.join(set_list)}
+    """
+    return conn.execute(query, [os.path.abspath(source_filename)] + list(append_dict.values())).rowcount
+
+def upload_csv(target_table_name, source_filename, progress_callback=None, chunk_rows=CSV_LOAD_CHUNK_ROWS):
+    append_dict = {"creation_user_id": 1}
+    start_time = time.perf_counter()
+
+    with get_db_transaction() as conn:
+        if local_infile_available_p(conn):
+            row_count = load_csv_local_infile(conn, target_table_name, source_filename, append_dict)
+            stats = get_csv_load_stats(target_table_name, "load_data_local_infile", row_count, start_time)
+            if progress_callback:
+                progress_callback(stats)
+            return stats
+
+        row_count = 0
+        chunk = []
+        for one_dict in stream_csv_rows(source_filename, append_dict=append_dict):
+            chunk.append(one_dict)
+            if len(chunk) >= chunk_rows:
+                row_count += len(bulk_insert_db_entries(chunk, target_table_name, capture_tenant=False, conn=conn))
+                chunk = []
+                if progress_callback:
+                    progress_callback(get_csv_load_stats(target_table_name, "bulk_insert", row_count, start_time))
+
+        if chunk:
+            row_count += len(bulk_insert_db_entries(chunk, target_table_name, capture_tenant=False, conn=conn))
+
+    stats = get_csv_load_stats(target_table_name, "bulk_insert", row_count, start_time)
+    if progress_callback:
+        progress_callback(stats)
+    return stats
+
+def upload_csv_map(target_table_name, source_filename, table_list, progress_callback=None, chunk_rows=CSV_MAP_CHUNK_ROWS):
+    """
+    Loads a map table from a csv of natural keys, e.g. brand_profile_name,plan_name
+    for table_list ["brand_profile", "plan"]: the ids are resolved with one
+    INSERT ... SELECT per chunk of rows.
+    """
+    start_time = time.perf_counter()
+    row_count = 0
+
     with open(source_filename) as fp:
-        header = fp.readline().strip()
-        header_list = header.split(',')
-        for line in fp:
-            count += 1
-            one_row = line.strip()
-            one_row_list = one_row.split(',')
-            res1 = [i + "." + j for i, j in zip(table_list, header_list)]
-            res = [i + "='" + j + "'" for i, j in zip(res1, one_row_list)]
-            where_line = """ where """ + ' and '.join(res) + ')'
-            key_ids = [table + '.' + table + '_id' for table in table_list]
-            field_list = [table + '_id' for table in table_list]
-            insert_line = """ insert into """ + target_table_name + """ (""" + ','.join(field_list) + ') '
-            select_line = """(select """ + ','.join(key_ids)
-            from_line = """ from """ + ','.join(table_list)
-            query = insert_line + select_line + from_line + where_line
-            with db_engine.connect() as conn:
-                conn.execute(query)
+        header_list = fp.readline().strip().split(',')
+
+    column_list = [table + "." + column for table, column in zip(table_list, header_list)]
+    key_ids = [table + '.' + table + '_id' for table in table_list]
+    field_list = [table + '_id' for table in table_list]
+
+    def insert_chunk(conn, chunk):
+        row_placeholders = '(' + ','.join(['%s'] * len(column_list)) + ')'
+        query = f"""
+            INSERT INTO {target_table_name} ({','.join(field_list)})
+            SELECT {','.join(key_ids)}
+            FROM {','.join(table_list)}
+            WHERE ({','.join(column_list)}) IN ({','.join([row_placeholders] * len(chunk))})
+        """
+        return conn.execute(query, [value for one_row in chunk for value in one_row]).rowcount
+
+    with get_db_transaction() as conn:
+        chunk = []
+        for one_dict in stream_csv_rows(source_filename, delimiter=','):
+            chunk.append([one_dict[column] for column in header_list])
+            if len(chunk) >= chunk_rows:
+                row_count += insert_chunk(conn, chunk)
+                chunk = []
+                if progress_callback:
+                    progress_callback(get_csv_load_stats(target_table_name, "insert_select", row_count, start_time))
+
+        if chunk:
+            row_count += insert_chunk(conn, chunk)
+
+    stats = get_csv_load_stats(target_table_name, "insert_select", row_count, start_time)
+    if progress_callback:
+        progress_callback(stats)
+    return stats
 
 def jq_prepare_insert_statement_from_csv(table_name, header, one_row):
     query = """
@@ -226,26 +546,6 @@ def jq_prepare_insert_statement_from_csv(table_name, header, one_row):
     return (query.format(table_name, header, placeholders), param_list)
 
 
-def upload_csv(target_table_name, source_filename):
-    # table_name = 'brand'
-    count = 0
-    db_engine = get_db_engine()
-
-    with open(source_filename, encoding="utf8") as fp:
-        header = fp.readline()
-        header += "|creation_user_id"
-        header = header.replace('|', ',')
-
-        for line in fp:
-            count += 1
-            one_row = line.strip()
-            one_row += "|1"
-
-            query, param_list = jq_prepare_insert_statement_from_csv(target_table_name, header, one_row)
-            with db_engine.connect() as conn:
-                conn.execute(query, param_list).lastrowid
-
-
 def result_proxy_to_dict_list(result_proxy):
     x = {}
     y = []
@@ -274,8 +574,7 @@ def upload_one_row_from_csv_append_column(csv_path, column_value, column_name, t
             INSERT INTO {0} ({1}) VALUES ({2})
             """
             query = query.format(table_name, header, placeholders)
-            db_engine = get_db_engine()
-            with db_engine.connect() as conn:
+            with get_db_connection() as conn:
                 row_id = conn.execute(query, param_list).lastrowid
     return row_id
 
@@ -303,8 +602,7 @@ def upload_multiple_rows_from_csv_append_column(csv_path, column_value, column_n
 
             query = query.format(table_name, header, placeholders)
 
-            db_engine = get_db_engine()
-            with db_engine.connect() as conn:
+            with get_db_connection() as conn:
                 row_id = conn.execute(query, param_list).lastrowid
                 id_list.append(row_id)
 
@@ -323,8 +621,7 @@ def insert_one_row_from_csv(file_path, table_name):
         INSERT INTO {0} ({1}) VALUES ({2})
         """
         query = query.format(table_name, header, value_placeholders)
-        db_engine = get_db_engine()
-        with db_engine.connect() as conn:
+        with get_db_connection() as conn:
             last_row_id = conn.execute(query, param_list).lastrowid
     return last_row_id
 
@@ -339,8 +636,7 @@ def get_id_by_name(input_value, column_name, table_name):
         """ORDER BY insertion_timestamp DESC """+
         """LIMIT 1"""
     )
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         last_row_id = conn.execute(query).fetchone()[0]
         assert last_row_id, "no data"
     return last_row_id
@@ -354,8 +650,7 @@ def get_id_of_map_by_names(input_value_1, column_name_1, table_name_1, input_val
         table_name_2 + " t2 on t2." + table_name_2 + "_id = " + "mtn." + table_name_2 + "_id " +
         " WHERE t1." + column_name_1 + " = '" + input_value_1 + "' and t2." + column_name_2 + " = '" + input_value_2 + "'"
     )
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query).fetchone()
         assert result, "no data"
         last_row_id = result[0]
@@ -368,8 +663,7 @@ def get_column_by_id(input_value, column_name, table_name):
         """ FROM """ + table_name +
         """ WHERE """ + primary_id + """ = """ + str(input_value)
     )
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query).fetchone()
         assert result, "no data"
         last_row_id = result[0]
@@ -383,8 +677,7 @@ def get_record_by_id(input_value, table_name, undeleted=True):
     """
     if undeleted:
         query += " AND meta_status <> 'deleted'"
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         record = conn.execute(text(query)).fetchone()
     return record
 
@@ -395,8 +688,7 @@ def get_record_list_by_column(input_value, column_name, table_name, undeleted=Tr
     """
     if undeleted:
         query += " AND meta_status <> 'deleted'"
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         records = conn.execute(text(query), input_value=input_value).fetchall()
     return [dict(_) for _ in records]
 
@@ -417,8 +709,7 @@ def check_record_by_id(input_value, table_name):
         SELECT {primary_id} FROM {table_name}
         WHERE {primary_id} = {str(input_value)}
     """)
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         return conn.execute(query).rowcount
 
 def delete_record_by_id(input_value, table_name, user_id):
@@ -427,8 +718,7 @@ def delete_record_by_id(input_value, table_name, user_id):
     condition = {primary_id: str(input_value)}
     query, params = jq_prepare_update_statement(table_name, change, condition, user_id)
 
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query, params).rowcount
 
     return result
@@ -444,8 +734,7 @@ def delete_record_by_id_v2(input_value, table_name,g):
     condition = {primary_id: str(input_value)}
     query, params = jq_prepare_update_statement_v2(table_name, change, condition,g)
 
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query, params).rowcount
 
     return result
@@ -461,30 +750,75 @@ def create_code_from_title(name, random_count):
     random_code = q + "_" + ''.join([str(secrets.choice(string.digits)) for _ in range(random_count)])
     return random_code
 
-def create_unique_code_from_title(name, random_count, table_name, column_name, retries=50, append_hard_coded_string=None):
-    db_engine = get_db_engine()
-    
-    unique_p = False
-    try_count = 0
+# Unique codes
+#--------------------------------------------
+# Candidates are generated in batches and checked with a single IN (...) query,
+# so a collision-heavy keyword costs one round-trip per batch instead of one
+# per candidate. UNIQUE_CODE_STATS keeps the collision rate per column to help
+# size random_count / length.
+UNIQUE_CODE_BATCH_SIZE = 10
+UNIQUE_CODE_STATS = {}
+
+def record_unique_code_stats(table_name, column_name, candidate_count=0, collision_count=0, query_count=0, exhausted_p=False):
+    stats = UNIQUE_CODE_STATS.setdefault(f"{table_name}.{column_name}", {
+        "request_count": 0,
+        "candidate_count": 0,
+        "collision_count": 0,
+        "query_count": 0,
+        "exhausted_count": 0
+    })
+    stats["candidate_count"] += candidate_count
+    stats["collision_count"] += collision_count
+    stats["query_count"] += query_count
+    stats["exhausted_count"] += 1 if exhausted_p else 0
+    return stats
+
+def get_unique_code_stats():
+    stats_dict = {}
+    for key, stats in UNIQUE_CODE_STATS.items():
+        stats_dict[key] = dict(stats)
+        stats_dict[key]["collision_rate"] = round(stats["collision_count"] / stats["candidate_count"], 4) if stats["candidate_count"] else None
+    return stats_dict
+
+def pick_unique_code(table_name, column_name, build_candidate, retries=50, active_only_p=False, batch_size=UNIQUE_CODE_BATCH_SIZE):
+    meta_status_filter = "AND meta_status = :meta_status" if active_only_p else ""
+    query = cached_text(f"""
+        SELECT {column_name}
+        FROM {table_name}
+        WHERE {column_name} IN :candidate_code_list
+        {meta_status_filter}
+    """)
+    record_unique_code_stats(table_name, column_name)["request_count"] += 1
 
-    while not unique_p and try_count < retries:
-        candidate_code = create_code_from_title(name, random_count)
+    candidate_count = 0
+    while candidate_count < retries:
+        # dict keeps the generation order and drops candidates repeated within the batch
+        candidate_code_list = list(dict.fromkeys(build_candidate() for _ in range(min(batch_size, retries - candidate_count))))
+        candidate_count += len(candidate_code_list)
+
+        with get_db_connection() as conn:
+            result = conn.execute(query, candidate_code_list=candidate_code_list, meta_status="active").fetchall()
+        taken_code_set = {row[column_name] for row in result}
 
+        for index, candidate_code in enumerate(candidate_code_list):
+            if candidate_code not in taken_code_set:
+                record_unique_code_stats(table_name, column_name, candidate_count=index + 1, collision_count=index, query_count=1)
+                return candidate_code
+
+        record_unique_code_stats(table_name, column_name, candidate_count=len(candidate_code_list), collision_count=len(candidate_code_list), query_count=1)
+
+    record_unique_code_stats(table_name, column_name, exhausted_p=True)
+    return None
+
+def create_unique_code_from_title(name, random_count, table_name, column_name, retries=50, append_hard_coded_string=None):
+    def build_candidate():
+        candidate_code = create_code_from_title(name, random_count)
         if append_hard_coded_string:
             candidate_code = candidate_code + "_" + append_hard_coded_string
+        return candidate_code
 
-        query = text(f"""
-            SELECT {column_name}
-            FROM {table_name}
-            WHERE {column_name} = :candidate_code
-        """)
-        with db_engine.connect() as conn:
-            result = conn.execute(query, candidate_code=candidate_code).rowcount
-            try_count += 1
-            if not result:
-                unique_p = True
-    
-    assert unique_p, "Unable to generate unique code"
+    candidate_code = pick_unique_code(table_name, column_name, build_candidate, retries)
+    assert candidate_code, "Unable to generate unique code"
 
     return candidate_code
 
@@ -559,7 +893,7 @@ def cleanse_for_db(value):
 
 def create_s3_public_url(bucket_name, object_key, region_name=None):
     if not region_name:
-        region_name = os.getenv('AWS_DEFAULT_REGION')
+        region_name = get_settings().aws_default_region
     
     object_url = None
     if region_name and bucket_name and object_key:
@@ -653,39 +987,56 @@ def cleanse_string(input_string):
     
     return re.sub(r"[\s]+", " ", input_string)
 
+def build_unique_code_candidate(keyword, length=10, method="basic"):
+    if method == "sha256":
+        # generate random seed to encode
+        seed = ''.join([str(secrets.choice(string.digits)) for _ in range(length)])
+        return cleanse_string(hashlib.sha256(seed.encode()).hexdigest()[:length])
+    return cleanse_string(create_code_from_title(keyword, length))
+
 def generate_unique_code(table_name, column_name, keyword, length=10, method="basic"):
-    
-    db_engine = get_db_engine()
-    unique_p = False
-    retries = 0
     max_retry_count = 50
-
-    while not unique_p and retries < max_retry_count:
-        
-        if method == "sha256":
-            # generate random seed to encode
-            seed = ''.join([str(secrets.choice(string.digits)) for _ in range(length)])
-            candidate_code = cleanse_string(hashlib.sha256(seed.encode()).hexdigest()[:length])
-        else:
-            candidate_code = cleanse_string(create_code_from_title(keyword, length))
-
-        # check if merchant_transaction_code is unique
-        query = text(f"""
-            SELECT {column_name}
-            FROM {table_name}
-            WHERE {column_name} = :candidate_code
-            AND meta_status = :meta_status
-        """)
-        with db_engine.connect() as conn:
-            result = conn.execute(query, candidate_code=candidate_code, meta_status="active").rowcount
-            retries += 1
-            if not result:
-                unique_p = True
-    
-    assert retries < max_retry_count, f"unable to create unique {column_name}, retries: {retries}."
+    candidate_code = pick_unique_code(table_name, column_name, lambda: build_unique_code_candidate(keyword, length, method),
+                                        max_retry_count, active_only_p=True)
+    assert candidate_code, f"unable to create unique {column_name}, retries: {max_retry_count}."
 
     return candidate_code
 
+def insert_with_unique_code(one_dict, table_name, column_name, keyword, length=10, method="basic", retries=50):
+    """
+    Reservation mode: inserts one_dict with a fresh code in column_name and lets the
+    unique index on that column reject collisions, so no SELECT is needed at all.
+    Returns (code, primary key of the inserted row).
+    """
+    stats = record_unique_code_stats(table_name, column_name)
+    stats["request_count"] += 1
+
+    with get_db_transaction() as conn:
+        for _ in range(retries):
+            candidate_code = build_unique_code_candidate(keyword, length, method)
+            row_dict = dict(one_dict)
+            row_dict[column_name] = candidate_code
+            query, params = jq_prepare_insert_statement(table_name, row_dict)
+            stats["candidate_count"] += 1
+            stats["query_count"] += 1
+
+            # a savepoint keeps the surrounding transaction usable after a duplicate
+            savepoint = conn.begin_nested()
+            try:
+                row_id = conn.execute(query, params).lastrowid
+            except IntegrityError as e:
+                savepoint.rollback()
+                if e.orig.args[0] != MYSQL_DUPLICATE_ENTRY_ERROR:
+                    raise
+                stats["collision_count"] += 1
+                continue
+
+            savepoint.commit()
+            return candidate_code, row_id
+
+    stats["exhausted_count"] += 1
+    assert False, f"unable to create unique {column_name}, retries: {retries}."
+
 def round_half_up(number, decimal_places=2):
     decimal_precision = '0.' + '0' * (decimal_places-1) + '1'
     rounded = decimal.Decimal(str(number)).quantize(decimal.Decimal(decimal_precision), rounding=decimal.ROUND_HALF_UP)
@@ -710,8 +1061,7 @@ def create_new_single_db_entry(one_dict, table_name, capture_tenant = True):
     else:
         one_dict["meta_status"] = 'active'
         query,params = jq_prepare_insert_statement(table_name,one_dict)
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query,params)
     if result:
         last_entry_id = result.lastrowid
@@ -723,14 +1073,230 @@ def update_single_db_entry(one_dict, table_name, condition, capture_tenant = Tru
         query,params = jq_prepare_update_statement_v2(table_name,one_dict,condition,g)
     else:
         query,params = jq_prepare_update_statement(table_name, one_dict, condition, None) 
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result = conn.execute(query,params)
     if result:
         update_status = result.rowcount
         return update_status
     return False
 
+# Bulk inserts
+#--------------------------------------------
+BULK_INSERT_MAX_ROWS = 5000
+DB_SERVER_VARIABLES = {}
+
+def get_db_server_variables(conn):
+    # both only change with a server restart, so they are read once per engine
+    engine_url = str(conn.engine.url)
+    if engine_url not in DB_SERVER_VARIABLES:
+        result = conn.execute(text("SELECT @@max_allowed_packet AS max_allowed_packet, @@auto_increment_increment AS auto_increment_increment")).fetchone()
+        DB_SERVER_VARIABLES[engine_url] = {
+            "max_allowed_packet": int(result["max_allowed_packet"]),
+            "auto_increment_increment": int(result["auto_increment_increment"])
+        }
+    return DB_SERVER_VARIABLES[engine_url]
+
+def execute_bulk_insert_chunk(conn, table_name, column_list, values_list, row_count, auto_increment_increment):
+    query = jq_prepare_bulk_insert_statement(table_name, column_list, row_count)
+    result = conn.execute(query, values_list)
+    assert result.rowcount == row_count, f"failed to insert {row_count} rows into {table_name}"
+
+    # rows that carry their primary key get it back as is
+    primary_key = f"{table_name}_id"
+    if primary_key in column_list:
+        primary_key_index = column_list.index(primary_key)
+        return values_list[primary_key_index::len(column_list)]
+
+    # a multi-row INSERT reports the id of its first row and its ids are consecutive
+    first_id = result.lastrowid
+    if not first_id:
+        return []
+    return list(range(first_id, first_id + row_count * auto_increment_increment, auto_increment_increment))
+
+def bulk_insert_db_entries(dict_list, table_name, capture_tenant=True, conn=None, max_rows=BULK_INSERT_MAX_ROWS):
+    """
+    Inserts an iterable of dicts that all share the same columns with as few
+    multi-row INSERT statements as max_allowed_packet allows.
+    Returns the generated primary keys in the same order as dict_list.
+    """
+    if conn is None:
+        with get_db_transaction() as conn:
+            return bulk_insert_db_entries(dict_list, table_name, capture_tenant, conn, max_rows)
+
+    server_variables = get_db_server_variables(conn)
+    # keep half the packet as headroom for escaping and the statement itself
+    max_chunk_bytes = server_variables["max_allowed_packet"] // 2
+    auto_increment_increment = server_variables["auto_increment_increment"]
+
+    column_list = None
+    column_set = None
+    id_list = []
+    values_list = []
+    row_count = 0
+    chunk_bytes = 0
+
+    for one_dict in dict_list:
+        one_dict = dict(one_dict)
+        if capture_tenant:
+            one_dict["meta_status"] = "active"
+            one_dict["tenant_id"] = g.tenant_id
+            one_dict["creation_user_id"] = g.user_id
+        else:
+            one_dict.setdefault("meta_status", "active")
+
+        if column_list is None:
+            column_list = list(one_dict.keys())
+            column_set = set(column_list)
+        assert one_dict.keys() == column_set, f"all rows inserted into {table_name} must have the same columns"
+        # generated ids are derived from the first one, so either every row or no row carries its primary key
+        assert one_dict.get(f"{table_name}_id", True) is not None, f"{table_name}_id must not be None"
+
+        row_values = [one_dict[column] for column in column_list]
+        row_bytes = sum(len(str(value).encode("utf8")) + 3 for value in row_values)
+
+        if row_count and (row_count >= max_rows or chunk_bytes + row_bytes > max_chunk_bytes):
+            id_list += execute_bulk_insert_chunk(conn, table_name, column_list, values_list, row_count, auto_increment_increment)
+            values_list = []
+            row_count = 0
+            chunk_bytes = 0
+
+        values_list += row_values
+        row_count += 1
+        chunk_bytes += row_bytes
+
+    if row_count:
+        id_list += execute_bulk_insert_chunk(conn, table_name, column_list, values_list, row_count, auto_increment_increment)
+
+    return id_list
+
+# Mapping tables
+#--------------------------------------------
+def sync_mapping(table_name, owner_key, desired_set, member_keys, user_id=None, conn=None, primary_id=None):
+    """
+    Makes the active rows of a soft-deleted mapping table owned by owner_key,
+    e.g. {"user_id": 7}, match desired_set. Members are tuples of member_keys
+    values, or plain values when there is a single member key.
+    Only the delta is written: one bulk soft-delete and one bulk insert.
+    primary_id defaults to {table_name}_id. New rows get the request's tenant,
+    outside a request the column default.
+    Returns (added_id_list, removed_id_list).
+    """
+    if conn is None:
+        with get_db_transaction() as conn:
+            return sync_mapping(table_name, owner_key, desired_set, member_keys, user_id, conn, primary_id)
+
+    if user_id is None:
+        user_id = g.user_id
+    tenant_id = g.get("tenant_id") if has_request_context() else None
+
+    member_keys = list(member_keys)
+    single_member_p = len(member_keys) == 1
+    desired_set = {(member,) if single_member_p else tuple(member) for member in desired_set}
+
+    primary_id = primary_id or f"{table_name}_id"
+    owner_filter = " AND ".join([f"{column} = :{column}" for column in owner_key])
+    query = text(f"""
+        SELECT {primary_id}, {', '.join(member_keys)}
+        FROM {table_name}
+        WHERE {owner_filter}
+        AND meta_status = :meta_status
+        ORDER BY {primary_id}
+    """)
+    result = conn.execute(query, meta_status="active", **owner_key).fetchall()
+
+    # keep the oldest row of every desired member, duplicates are removed as well
+    existing_set = set()
+    removed_id_list = []
+    for row in result:
+        member = tuple(row[column] for column in member_keys)
+        if member in desired_set and member not in existing_set:
+            existing_set.add(member)
+        else:
+            removed_id_list.append(row[primary_id])
+
+    if removed_id_list:
+        query = text(f"""
+            UPDATE {table_name}
+            SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
+            WHERE {primary_id} IN :removed_id_list
+        """)
+        result = conn.execute(query, meta_status="deleted", deletion_user_id=user_id, deletion_timestamp=get_utc_datetime(),
+                                removed_id_list=removed_id_list).rowcount
+        assert result == len(removed_id_list), f"unable to delete {table_name} rows"
+
+    added_list = []
+    for member in desired_set - existing_set:
+        one_dict = dict(owner_key)
+        one_dict.update(zip(member_keys, member))
+        one_dict["meta_status"] = "active"
+        one_dict["creation_user_id"] = user_id
+        if tenant_id is not None:
+            one_dict["tenant_id"] = tenant_id
+        added_list.append(one_dict)
+
+    added_id_list = bulk_insert_db_entries(added_list, table_name, capture_tenant=False, conn=conn)
+    assert len(added_id_list) == len(added_list), f"unable to create {table_name} rows"
+
+    return added_id_list, removed_id_list
+
+# Pagination
+#--------------------------------------------
+# List endpoints page on their primary key: WHERE id > :after_id ORDER BY id
+# LIMIT :limit + 1. The extra row tells whether there is a next page, so a page
+# costs O(limit) whatever the table size. The cursor is opaque to clients.
+PAGE_LIMIT_DEFAULT = 100
+PAGE_LIMIT_MAX = 1000
+
+def encode_page_cursor(last_id):
+    return base64.urlsafe_b64encode(json.dumps({"after": last_id}).encode()).decode()
+
+def decode_page_cursor(cursor):
+    try:
+        after_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())["after"]
+    except Exception:
+        after_id = None
+    assert isinstance(after_id, int), "invalid pagination cursor"
+    return after_id
+
+def get_page_args(request_args):
+    limit = int(request_args.get("limit", PAGE_LIMIT_DEFAULT))
+    assert 0 < limit <= PAGE_LIMIT_MAX, f"limit should be between 1 and {PAGE_LIMIT_MAX}"
+
+    cursor = request_args.get("after")
+    after_id = decode_page_cursor(cursor) if cursor else 0
+
+    include_total_p = request_args.get("include_total", "false").lower() in ["1", "true"]
+    return limit, after_id, include_total_p
+
+def get_approximate_row_count(table_name):
+    # InnoDB's estimate from the table statistics, no scan
+    query = cached_text("""
+        SELECT TABLE_ROWS
+        FROM information_schema.TABLES
+        WHERE TABLE_SCHEMA = DATABASE()
+        AND TABLE_NAME = :table_name
+    """)
+    with get_db_connection() as conn:
+        result = conn.execute(query, table_name=table_name).fetchone()
+    return int(result["TABLE_ROWS"]) if result and result["TABLE_ROWS"] is not None else None
+
+def paginate(row_list, limit, id_key, table_name=None, include_total_p=False):
+    """
+    Trims a page fetched with LIMIT limit + 1 and returns (page_row_list, pagination).
+    """
+    has_more_p = len(row_list) > limit
+    row_list = row_list[:limit]
+
+    pagination = {
+        "limit": limit,
+        "has_more_p": has_more_p,
+        "next_cursor": encode_page_cursor(row_list[-1][id_key]) if has_more_p else None
+    }
+    if include_total_p and table_name:
+        pagination["approximate_total"] = get_approximate_row_count(table_name)
+
+    return row_list, pagination
+
 def get_specific_columns_by_id(entity_id_list,table,column_name_str, capture_tenant = True):
     sub_query = ""
     if capture_tenant:
@@ -746,8 +1312,7 @@ def get_specific_columns_by_id(entity_id_list,table,column_name_str, capture_ten
             meta_status = 'active'
         {sub_query}
     """)
-    db_engine = get_db_engine()
-    with db_engine.connect() as conn:
+    with get_db_connection() as conn:
         result_tuple = conn.execute(query).fetchall()
         return [dict(row) for row in result_tuple]
 
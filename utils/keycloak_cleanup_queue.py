@@ -0,0 +1,141 @@
+import uuid
+import random
+import logging
+
+from datetime import datetime, timedelta
+from utils import jqutils, keycloak_utils, background_worker
+from utils.settings import get_settings
+
+# Keycloak cleanup queue
+#--------------------------------------------
+# Deleting a user in Keycloak takes dozens of admin calls, so user deletion
+# only soft-deletes the rows and queues the Keycloak user id here in the same
+# transaction. A periodic task claims due rows the same way the e-mail outbox
+# does, removes the user from its policies and deletes it, and retries failures
+# with exponential backoff and full jitter until keycloak_cleanup_max_attempts.
+# Both steps are idempotent, so a retried or reclaimed row is safe.
+
+TASK_NAME = "keycloak-cleanup"
+CLAIM_TIMEOUT_SECONDS = 300
+BACKOFF_BASE_SECONDS = 5
+BACKOFF_MAX_SECONDS = 1800
+
+def enqueue_keycloak_user_cleanup(keycloak_user_list, creation_user_id=None, conn=None):
+    """
+    Queues dicts with user_id and keycloak_user_id, processed after the transaction commits.
+    """
+    if not keycloak_user_list:
+        return []
+
+    keycloak_cleanup_queue_list = [{
+        "user_id": one_user["user_id"],
+        "keycloak_user_id": one_user["keycloak_user_id"],
+        "cleanup_status": "pending",
+        "attempt_count": 0,
+        "next_attempt_timestamp": datetime.utcnow(),
+        "meta_status": "active",
+        "creation_user_id": creation_user_id
+    } for one_user in keycloak_user_list]
+
+    keycloak_cleanup_queue_id_list = jqutils.bulk_insert_db_entries(keycloak_cleanup_queue_list, "keycloak_cleanup_queue",
+                                                                    capture_tenant=False, conn=conn)
+    assert len(keycloak_cleanup_queue_id_list) == len(keycloak_user_list), "failed to enqueue keycloak cleanup"
+
+    jqutils.run_after_commit(lambda: background_worker.wake_periodic_task(TASK_NAME))
+    return keycloak_cleanup_queue_id_list
+
+def get_retry_delay_seconds(attempt_count):
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** (attempt_count - 1)))
+
+def claim_keycloak_cleanup_batch(batch_size):
+    claim_token = uuid.uuid4().hex
+    current_timestamp = datetime.utcnow()
+
+    with jqutils.get_db_connection() as conn:
+        query = jqutils.cached_text("""
+            UPDATE keycloak_cleanup_queue
+            SET cleanup_status = :cleanup_status_processing,
+            claim_token = :claim_token,
+            claimed_timestamp = :current_timestamp
+            WHERE meta_status = :meta_status
+            AND ((cleanup_status = :cleanup_status_pending AND next_attempt_timestamp <= :current_timestamp)
+                OR (cleanup_status = :cleanup_status_processing AND claimed_timestamp < :stale_claim_timestamp))
+            ORDER BY next_attempt_timestamp
+            LIMIT :batch_size
+        """)
+        claimed_count = conn.execute(query, cleanup_status_processing="processing", cleanup_status_pending="pending", claim_token=claim_token,
+                            current_timestamp=current_timestamp, stale_claim_timestamp=current_timestamp - timedelta(seconds=CLAIM_TIMEOUT_SECONDS),
+                            meta_status="active", batch_size=batch_size).rowcount
+        if not claimed_count:
+            return []
+
+        query = jqutils.cached_text("""
+            SELECT keycloak_cleanup_queue_id, user_id, keycloak_user_id, attempt_count, claim_token
+            FROM keycloak_cleanup_queue
+            WHERE claim_token = :claim_token
+        """)
+        result = conn.execute(query, claim_token=claim_token).fetchall()
+
+    return [dict(row) for row in result]
+
+def cleanup_keycloak_user(one_cleanup):
+    keycloak_cleanup_queue_id = one_cleanup["keycloak_cleanup_queue_id"]
+    attempt_count = one_cleanup["attempt_count"] + 1
+
+    try:
+        keycloak_utils.disassociate_user_from_policies(one_cleanup["keycloak_user_id"], one_cleanup["user_id"])
+        keycloak_utils.delete_user(one_cleanup["keycloak_user_id"], missing_ok=True)
+    except Exception as e:  # pylint: disable=broad-except
+        logging.exception("failed to clean up keycloak_cleanup_queue_id %s", keycloak_cleanup_queue_id)
+
+        cleanup_status = "failed" if attempt_count >= get_settings().keycloak_cleanup_max_attempts else "pending"
+        next_attempt_timestamp = datetime.utcnow() + timedelta(seconds=get_retry_delay_seconds(attempt_count))
+        query = jqutils.cached_text("""
+            UPDATE keycloak_cleanup_queue
+            SET cleanup_status = :cleanup_status, attempt_count = :attempt_count, next_attempt_timestamp = :next_attempt_timestamp,
+            last_error = :last_error, claim_token = NULL
+            WHERE keycloak_cleanup_queue_id = :keycloak_cleanup_queue_id
+            AND claim_token = :claim_token
+        """)
+        with jqutils.get_db_connection() as conn:
+            conn.execute(query, cleanup_status=cleanup_status, attempt_count=attempt_count, next_attempt_timestamp=next_attempt_timestamp,
+                        last_error=str(e)[:1024], keycloak_cleanup_queue_id=keycloak_cleanup_queue_id, claim_token=one_cleanup["claim_token"])
+        return False
+
+    query = jqutils.cached_text("""
+        UPDATE keycloak_cleanup_queue
+        SET cleanup_status = :cleanup_status, attempt_count = :attempt_count, completed_timestamp = :completed_timestamp, claim_token = NULL
+        WHERE keycloak_cleanup_queue_id = :keycloak_cleanup_queue_id
+        AND claim_token = :claim_token
+    """)
+    with jqutils.get_db_connection() as conn:
+        conn.execute(query, cleanup_status="done", attempt_count=attempt_count, completed_timestamp=datetime.utcnow(),
+                    keycloak_cleanup_queue_id=keycloak_cleanup_queue_id, claim_token=one_cleanup["claim_token"])
+    return True
+
+def process_keycloak_cleanup_queue():
+    """
+    Drains due rows batch by batch. Returns the number of cleaned up users.
+    """
+    batch_size = get_settings().keycloak_cleanup_batch_size
+    done_count = 0
+    while True:
+        cleanup_list = claim_keycloak_cleanup_batch(batch_size)
+        done_count += sum(cleanup_keycloak_user(one_cleanup) for one_cleanup in cleanup_list)
+        if len(cleanup_list) < batch_size:
+            return done_count
+
+def start_keycloak_cleanup_worker():
+    return background_worker.start_periodic_task(TASK_NAME, get_settings().keycloak_cleanup_poll_seconds, process_keycloak_cleanup_queue)
+
+def get_keycloak_cleanup_stats():
+    query = jqutils.cached_text("""
+        SELECT cleanup_status, COUNT(*) AS cleanup_count, MIN(next_attempt_timestamp) AS oldest_next_attempt_timestamp
+        FROM keycloak_cleanup_queue
+        WHERE meta_status = :meta_status
+        GROUP BY cleanup_status
+    """)
+    with jqutils.get_db_connection() as conn:
+        result = conn.execute(query, meta_status="active").fetchall()
+
+    return [dict(row) for row in result]
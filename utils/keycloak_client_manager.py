@@ -0,0 +1,106 @@
+import logging
+import threading
+
+from datetime import datetime, timedelta
+
+# Keycloak client manager
+#--------------------------------------------
+# Admin and OpenID clients are built once per (kind, realm, client) and shared
+# by every thread. Building an admin client is a password grant, so it happens
+# once per process, ideally on the token refresher rather than in a request.
+#
+# python-keycloak refreshes an admin token lazily inside the request that
+# finds it expired, and every thread that sees the same expiry refreshes it
+# again. Managed clients refresh under a per-client lock instead: the first
+# caller refreshes, concurrent callers wait for it and reuse the new token.
+# The refresher task also refreshes tokens that expire within
+# keycloak_token_refresh_ahead_seconds, so requests normally never refresh.
+
+class ManagedClient:
+    def __init__(self, key, client):
+        self.key = key
+        self.client = client
+        self.refresh_lock = threading.Lock()
+        self.refresh_count = 0
+        self.refresh_error_count = 0
+
+        connection = getattr(client, "connection", None)
+        self.connection = connection if hasattr(connection, "_refresh_if_required") else None
+        if self.connection is not None:
+            # route python-keycloak's lazy refresh through the single-flight refresh
+            self.connection._refresh_if_required = self.refresh_if_required  # pylint: disable=protected-access
+
+    def get_expires_at(self):
+        return self.connection.expires_at if self.connection is not None else None
+
+    def refresh_if_required(self, ahead_seconds=0):
+        expires_at = self.get_expires_at()
+        if expires_at is None or datetime.now() + timedelta(seconds=ahead_seconds) < expires_at:
+            return False
+
+        with self.refresh_lock:
+            # another thread may have refreshed while this one waited
+            if datetime.now() + timedelta(seconds=ahead_seconds) < self.get_expires_at():
+                return False
+            try:
+                self.connection.refresh_token()
+            except Exception:
+                self.refresh_error_count += 1
+                raise
+            self.refresh_count += 1
+            return True
+
+    def stats(self):
+        expires_at = self.get_expires_at()
+        return {
+            "kind": self.key[0],
+            "realm_name": self.key[1],
+            "client_id": self.key[2],
+            "expires_at": expires_at.isoformat() if expires_at else None,
+            "refresh_count": self.refresh_count,
+            "refresh_error_count": self.refresh_error_count
+        }
+
+class KeycloakClientManager:
+    def __init__(self):
+        self.clients = {}
+        self.build_locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, kind, realm_name, client_id, build):
+        """
+        Returns the shared client for (kind, realm_name, client_id), calling build() at most once.
+        """
+        key = (kind, realm_name, client_id)
+        managed_client = self.clients.get(key)
+        if managed_client is not None:
+            return managed_client.client
+
+        with self.lock:
+            build_lock = self.build_locks.setdefault(key, threading.Lock())
+
+        # one login per client, other callers wait for it
+        with build_lock:
+            managed_client = self.clients.get(key)
+            if managed_client is None:
+                managed_client = ManagedClient(key, build())
+                with self.lock:
+                    self.clients[key] = managed_client
+        return managed_client.client
+
+    def clear(self):
+        with self.lock:
+            self.clients = {}
+            self.build_locks = {}
+
+    def refresh_expiring(self, ahead_seconds):
+        refreshed_count = 0
+        for managed_client in list(self.clients.values()):
+            try:
+                refreshed_count += int(managed_client.refresh_if_required(ahead_seconds))
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("failed to refresh keycloak token for %s", managed_client.key)
+        return refreshed_count
+
+    def stats(self):
+        return [managed_client.stats() for managed_client in list(self.clients.values())]
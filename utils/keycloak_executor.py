@@ -0,0 +1,166 @@
+import time
+import random
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from keycloak.exceptions import KeycloakError, KeycloakConnectionError
+from utils.settings import get_settings, register_reload_callback
+
+# Keycloak admin fan-out
+#--------------------------------------------
+# Realm-wide operations (mirror builds, permission scans, bulk user removal)
+# run their admin calls on one bounded thread pool instead of one after the
+# other. Every call holds a per-realm semaphore, so a big fan-out cannot take
+# more than keycloak_admin_realm_concurrency connections to one realm, and the
+# admin clients share keep-alive connections through an HTTPAdapter sized to
+# match. Reads are retried on connection errors, 429 and 5xx with exponential
+# backoff and full jitter. Writes are never retried here, the callers'
+# queues own write retries. Latency is recorded per operation.
+
+LATENCY_BUCKETS_MS = [5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+RETRYABLE_RESPONSE_CODE_SET = {429, 500, 502, 503, 504}
+
+EXECUTOR = None
+EXECUTOR_LOCK = threading.Lock()
+REALM_SEMAPHORES = {}
+OPERATION_STATS = {}
+OPERATION_STATS_LOCK = threading.Lock()
+
+@register_reload_callback
+def reset_keycloak_executor(settings):
+    global EXECUTOR, REALM_SEMAPHORES
+
+    with EXECUTOR_LOCK:
+        old_executor = EXECUTOR
+        EXECUTOR = None
+        REALM_SEMAPHORES = {}
+
+    # running and queued calls finish on the old pool, its threads exit after them
+    if old_executor is not None:
+        old_executor.shutdown(wait=False)
+
+def submit(fn, *args, **kwargs):
+    global EXECUTOR
+
+    # under the lock, so a reload cannot shut the pool down between picking it and submitting to it
+    with EXECUTOR_LOCK:
+        if EXECUTOR is None:
+            EXECUTOR = ThreadPoolExecutor(max_workers=get_settings().keycloak_admin_max_workers, thread_name_prefix="keycloak-admin")
+        return EXECUTOR.submit(fn, *args, **kwargs)
+
+def get_realm_semaphore(realm_name):
+    with EXECUTOR_LOCK:
+        if realm_name not in REALM_SEMAPHORES:
+            REALM_SEMAPHORES[realm_name] = threading.BoundedSemaphore(get_settings().keycloak_admin_realm_concurrency)
+        return REALM_SEMAPHORES[realm_name]
+
+def mount_connection_pool(keycloak_client):
+    """
+    Replaces the client's HTTP adapters with one sized for the fan-out, so
+    concurrent calls reuse keep-alive connections instead of opening new ones.
+    """
+    pool_size = get_settings().keycloak_admin_max_workers
+    session = keycloak_client.connection._s  # pylint: disable=protected-access
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=1)
+    for protocol in ["http://", "https://"]:
+        session.mount(protocol, adapter)
+    return keycloak_client
+
+class OperationStats:
+    def __init__(self):
+        self.call_count = 0
+        self.error_count = 0
+        self.retry_count = 0
+        self.total_ms = 0
+        self.max_ms = 0
+        self.latency_histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def record(self, latency_ms, error_p, retry_count):
+        bucket_index = len(LATENCY_BUCKETS_MS)
+        for index, upper_bound_ms in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= upper_bound_ms:
+                bucket_index = index
+                break
+
+        self.call_count += 1
+        self.error_count += int(error_p)
+        self.retry_count += retry_count
+        self.total_ms += latency_ms
+        self.max_ms = max(self.max_ms, latency_ms)
+        self.latency_histogram[bucket_index] += 1
+
+    def stats(self):
+        histogram = {f"le_{upper_bound_ms}ms": count for upper_bound_ms, count in zip(LATENCY_BUCKETS_MS, self.latency_histogram)}
+        histogram[f"gt_{LATENCY_BUCKETS_MS[-1]}ms"] = self.latency_histogram[-1]
+        return {
+            "call_count": self.call_count,
+            "error_count": self.error_count,
+            "retry_count": self.retry_count,
+            "avg_ms": round(self.total_ms / self.call_count, 2) if self.call_count else None,
+            "max_ms": round(self.max_ms, 2),
+            "latency_histogram": histogram
+        }
+
+def record_call(operation_name, latency_ms, error_p, retry_count):
+    with OPERATION_STATS_LOCK:
+        OPERATION_STATS.setdefault(operation_name, OperationStats()).record(latency_ms, error_p, retry_count)
+
+def is_retryable_error(e):
+    return isinstance(e, KeycloakConnectionError) or (isinstance(e, KeycloakError) and e.response_code in RETRYABLE_RESPONSE_CODE_SET)
+
+def call(realm_name, operation_name, fn, *args, idempotent_p=False, **kwargs):
+    """
+    Runs one admin call under the realm's concurrency limit.
+    idempotent_p calls are retried on transient errors.
+    """
+    settings = get_settings()
+    max_attempts = settings.keycloak_admin_max_attempts if idempotent_p else 1
+
+    retry_count = 0
+    start_time = time.perf_counter()
+    try:
+        while True:
+            try:
+                with get_realm_semaphore(realm_name):
+                    result = fn(*args, **kwargs)
+                break
+            except Exception as e:  # pylint: disable=broad-except
+                if retry_count + 1 >= max_attempts or not is_retryable_error(e):
+                    raise
+                retry_count += 1
+                delay_seconds = random.uniform(0, settings.keycloak_admin_backoff_base_seconds * 2 ** (retry_count - 1))
+                logging.warning("retrying keycloak %s in %.2fs: %s", operation_name, delay_seconds, e)
+                time.sleep(delay_seconds)
+    except Exception:
+        record_call(operation_name, (time.perf_counter() - start_time) * 1000, True, retry_count)
+        raise
+
+    record_call(operation_name, (time.perf_counter() - start_time) * 1000, False, retry_count)
+    return result
+
+def map_calls(realm_name, operation_name, fn, arg_list, idempotent_p=False):
+    """
+    Runs fn(arg) for every arg on the executor and returns the results in
+    order. The first error is raised once every call has finished.
+    Do not call it from inside a mapped function, the pool is bounded.
+    """
+    arg_list = list(arg_list)
+    if len(arg_list) <= 1:
+        return [call(realm_name, operation_name, fn, arg, idempotent_p=idempotent_p) for arg in arg_list]
+
+    future_list = [submit(call, realm_name, operation_name, fn, arg, idempotent_p=idempotent_p) for arg in arg_list]
+    error_list = [future.exception() for future in future_list]
+    for error in error_list:
+        if error is not None:
+            raise error
+    return [future.result() for future in future_list]
+
+def get_keycloak_admin_stats():
+    with OPERATION_STATS_LOCK:
+        return {
+            "max_workers": get_settings().keycloak_admin_max_workers,
+            "realm_concurrency": get_settings().keycloak_admin_realm_concurrency,
+            "operation_stats": {operation_name: operation_stats.stats() for operation_name, operation_stats in OPERATION_STATS.items()}
+        }
@@ -1,56 +1,80 @@
 import os
 import json
 
+from datetime import datetime, timedelta
+from flask import g, has_request_context
 from keycloak import KeycloakOpenID, KeycloakAdmin
-from dotenv import load_dotenv
+from keycloak.exceptions import KeycloakError
+from utils import jqutils, keycloak_executor, keycloak_client_manager, background_worker
+from utils.settings import get_settings, register_reload_callback
 
-load_dotenv(override=True)
+server_url = None
+client_id = None
+realm_name = None
+client_secret_key = None
+admin_username = None
+admin_password = None
+client_uuid = None
 
-server_url = os.getenv("KEYCLOAK_SERVER_URL")
-client_id = os.getenv("KEYCLOAK_CLIENT_ID")
-realm_name = os.getenv("KEYCLOAK_REALM_NAME")
-client_secret_key = os.getenv("KEYCLOAK_CLIENT_SECRET_KEY")
-admin_username = os.getenv("KEYCLOAK_ADMIN_USERNAME")
-admin_password = os.getenv("KEYCLOAK_ADMIN_PASSWORD")
-client_uuid = os.getenv("KEYCLOAK_CLIENT_UUID")
+CLIENT_MANAGER = keycloak_client_manager.KeycloakClientManager()
+TOKEN_REFRESH_TASK_NAME = "keycloak-token-refresh"
+PERMISSION_MIRROR_REFRESH_TASK_NAME = "keycloak-permission-mirror-refresh"
 
-keycloak_client_openid = None
-keycloak_admin_openid = None
+@register_reload_callback
+def load_keycloak_settings(settings):
+    global server_url, client_id, realm_name, client_secret_key, admin_username, admin_password, client_uuid
+
+    server_url = settings.keycloak_server_url
+    client_id = settings.keycloak_client_id
+    realm_name = settings.keycloak_realm_name
+    client_secret_key = settings.keycloak_client_secret_key
+    admin_username = settings.keycloak_admin_username
+    admin_password = settings.keycloak_admin_password
+    client_uuid = settings.keycloak_client_uuid
+
+    # clients are recreated on next use with the new settings
+    CLIENT_MANAGER.clear()
+
+load_keycloak_settings(get_settings())
 
 def get_keycloak_client_openid():
-    global keycloak_client_openid
-    
-    if not keycloak_client_openid:
-        keycloak_client_openid = KeycloakOpenID(
-            server_url=server_url,
-            client_id=client_id,
-            realm_name=realm_name,
-            client_secret_key=client_secret_key
-        )
-        
-    return keycloak_client_openid
+    return CLIENT_MANAGER.get("openid", realm_name, client_id, lambda: KeycloakOpenID(
+        server_url=server_url,
+        client_id=client_id,
+        realm_name=realm_name,
+        client_secret_key=client_secret_key
+    ))
 
 def get_keycloak_admin_openid(master_p=False):
-    global keycloak_admin_openid
-    
     if master_p:
-        return KeycloakAdmin(
+        return CLIENT_MANAGER.get("admin", "master", "admin-cli", lambda: keycloak_executor.mount_connection_pool(KeycloakAdmin(
             server_url=server_url,
             username=admin_username,
             password=admin_password
-        )
+        )))
 
-    if not keycloak_admin_openid:
-        keycloak_admin_openid = KeycloakAdmin(
-            server_url=server_url,
-            username=admin_username,
-            password=admin_password,
-            realm_name=realm_name,
-            client_id=client_id,
-            client_secret_key=client_secret_key
-        )
-        
-    return keycloak_admin_openid
+    return CLIENT_MANAGER.get("admin", realm_name, client_id, lambda: keycloak_executor.mount_connection_pool(KeycloakAdmin(
+        server_url=server_url,
+        username=admin_username,
+        password=admin_password,
+        realm_name=realm_name,
+        client_id=client_id,
+        client_secret_key=client_secret_key
+    )))
+
+def refresh_keycloak_tokens():
+    # the first run logs in, so requests find a ready admin client
+    get_keycloak_admin_openid()
+    return CLIENT_MANAGER.refresh_expiring(get_settings().keycloak_token_refresh_ahead_seconds)
+
+def start_keycloak_token_refresher():
+    periodic_task = background_worker.start_periodic_task(TOKEN_REFRESH_TASK_NAME, get_settings().keycloak_token_refresh_interval_seconds,
+                                                        refresh_keycloak_tokens)
+    background_worker.wake_periodic_task(TOKEN_REFRESH_TASK_NAME)
+    return periodic_task
+
+def get_keycloak_client_stats():
+    return CLIENT_MANAGER.stats()
 
 def get_rpt_token(keycloak_client_openid):
     rpt_token = keycloak_client_openid.token(
@@ -59,23 +83,37 @@ def get_rpt_token(keycloak_client_openid):
     )
     return rpt_token
 
+def get_user_policy_user_id_list(policy):
+    try:
+        return json.loads(policy["config"].get("users", "[]"))
+    except (TypeError, ValueError):
+        return []
+
 def delete_all_users(exception_list=["codify-admin"]):
     keycloak_admin_openid = get_keycloak_admin_openid()
     
-    # Delete all existing users
-    users = keycloak_admin_openid.get_users()
-    for user in users:
-        user_id = user["id"]
-        username = user["username"]
-        if username not in exception_list:
-            disassociate_user_from_policies(user_id)
-            keycloak_admin_openid.delete_user(user_id=user_id)
+    # Delete all existing users, every permission is read and updated once for all of them
+    users = keycloak_executor.call(realm_name, "get_users", keycloak_admin_openid.get_users, idempotent_p=True)
+    user_id_set = {user["id"] for user in users if user["username"] not in exception_list}
 
-def delete_user(user_id):
+    policy_list = keycloak_executor.call(realm_name, "get_client_authz_policies", keycloak_admin_openid.get_client_authz_policies, client_uuid,
+                                        idempotent_p=True)
+    user_policy_id_set = {policy["id"] for policy in policy_list if user_id_set.intersection(get_user_policy_user_id_list(policy))}
+    if user_policy_id_set:
+        remove_policies_from_all_permissions(keycloak_admin_openid, user_policy_id_set)
+        delete_user_policies(keycloak_admin_openid, user_policy_id_set)
+
+    keycloak_executor.map_calls(realm_name, "delete_user", lambda user_id: delete_user(user_id, missing_ok=True), user_id_set)
+
+def delete_user(user_id, missing_ok=False):
     keycloak_admin_openid = get_keycloak_admin_openid()
 
-    # Delete a user
-    keycloak_admin_openid.delete_user(user_id=user_id)
+    # Delete a user, missing_ok makes retries of a half finished cleanup idempotent
+    try:
+        keycloak_admin_openid.delete_user(user_id=user_id)
+    except KeycloakError as e:
+        if not (missing_ok and e.response_code == 404):
+            raise
 
 def create_user(username, password, first_name="", last_name="", email="", enabled=True):
     keycloak_admin_openid = get_keycloak_admin_openid()
@@ -143,89 +181,589 @@ def create_user_policy(username):
     
     return keycloak_user_policy_id["id"]
 
-def attach_user_to_policies(associate_policy_id, policy_id_list):
+# Permission mirror
+#--------------------------------------------
+# The resources and applied policies of every Keycloak resource permission are
+# mirrored in policy, policy_resource_map and policy_apply_policy_map, stamped
+# with policy.keycloak_synced_timestamp. Changing the policies of k permissions
+# then reads the mirror and makes k update calls instead of downloading the
+# whole realm. Permissions missing from the mirror or older than
+# keycloak_permission_mirror_max_age_seconds, e.g. after an edit in the admin
+# console, are refreshed from Keycloak first, and every update we make is
+# written through.
+#
+# No row lock is held across a Keycloak call. An update is computed from the
+# mirror and sent to Keycloak, then the mirror rows are locked only to store
+# it. A permission that another writer stored in the meantime may have lost
+# that writer's policies to our update, so it is updated again from the newer
+# mirror, which holds both changes once ours is added.
+#
+# permission_mirror_build records every pass that mirrored all permissions.
+# While the latest one is younger than keycloak_permission_mirror_max_age_seconds
+# the mirror is known to list every permission applying a given policy.
+SYSTEM_USER_ID = 0
+PERMISSION_UPDATE_MAX_ATTEMPTS = 5
+
+def get_modification_user_id():
+    return g.user_id if has_request_context() else SYSTEM_USER_ID
+
+def get_local_id_map(table_name, keycloak_column, keycloak_row_list, build_row, conn, upsert_p=False):
+    """
+    Returns {keycloak id: local id} for the Keycloak representations in
+    keycloak_row_list, inserting build_row(representation) for unknown ones.
+    With upsert_p the keycloak column is a unique key: a row that another
+    transaction inserted meanwhile, or a soft-deleted one, is reactivated
+    instead of being inserted twice.
+    """
+    keycloak_row_map = {one_row["id"]: one_row for one_row in keycloak_row_list}
+    if not keycloak_row_map:
+        return {}
+
+    query = jqutils.cached_text(f"""
+        SELECT {table_name}_id AS local_id, {keycloak_column} AS keycloak_id
+        FROM {table_name}
+        WHERE {keycloak_column} IN :keycloak_id_list
+        AND meta_status = :meta_status
+    """)
+    result = conn.execute(query, keycloak_id_list=list(keycloak_row_map), meta_status="active").fetchall()
+    local_id_map = {row["keycloak_id"]: row["local_id"] for row in result}
+
+    missing_row_list = [{
+        **build_row(one_row),
+        keycloak_column: keycloak_id,
+        "meta_status": "active",
+        "creation_user_id": get_modification_user_id()
+    } for keycloak_id, one_row in keycloak_row_map.items() if keycloak_id not in local_id_map]
+    if missing_row_list and upsert_p:
+        upsert_keycloak_rows(table_name, missing_row_list, conn)
+        result = conn.execute(query, keycloak_id_list=[one_row[keycloak_column] for one_row in missing_row_list], meta_status="active").fetchall()
+        local_id_map.update({row["keycloak_id"]: row["local_id"] for row in result})
+    elif missing_row_list:
+        local_id_list = jqutils.bulk_insert_db_entries(missing_row_list, table_name, capture_tenant=False, conn=conn)
+        local_id_map.update({one_row[keycloak_column]: local_id for one_row, local_id in zip(missing_row_list, local_id_list)})
+
+    return local_id_map
+
+def upsert_keycloak_rows(table_name, row_list, conn):
+    # waits for a concurrent insert of the same key instead of duplicating it, the ids are read back by the caller
+    column_list = list(row_list[0])
+    query = jqutils.jq_prepare_bulk_insert_statement(table_name, column_list, len(row_list)).strip().rstrip(";") + """
+        ON DUPLICATE KEY UPDATE meta_status = VALUES(meta_status), deletion_user_id = NULL, deletion_timestamp = NULL
+    """
+    conn.execute(query, [one_row[column] for one_row in row_list for column in column_list])
+
+def build_policy_row(keycloak_policy):
+    return {
+        "policy_name": keycloak_policy.get("name"),
+        "policy_type": keycloak_policy.get("type"),
+        "logic": keycloak_policy.get("logic"),
+        "decision_strategy": keycloak_policy.get("decisionStrategy")
+    }
+
+def build_resource_row(keycloak_resource):
+    return {
+        "resource_name": keycloak_resource.get("name"),
+        "display_name_en": keycloak_resource.get("displayName") or keycloak_resource.get("name"),
+        "uri": (keycloak_resource.get("uris") or [None])[0]
+    }
+
+def store_permission(permission, conn):
+    """
+    Writes one permission {"id", "name", "resource_list", "policy_list"} to the
+    mirror, the lists hold Keycloak representations with at least an id.
+    """
+    policy_id = get_local_id_map("policy", "keycloak_policy_id", [{"type": "resource", **permission}], build_policy_row, conn, upsert_p=True)[permission["id"]]
+    resource_id_map = get_local_id_map("resource", "keycloak_resource_id", permission["resource_list"], build_resource_row, conn)
+    applied_policy_id_map = get_local_id_map("policy", "keycloak_policy_id", permission["policy_list"], build_policy_row, conn, upsert_p=True)
+
+    modification_user_id = get_modification_user_id()
+    jqutils.sync_mapping("policy_resource_map", {"policy_id": policy_id}, set(resource_id_map.values()), ["resource_id"],
+                        user_id=modification_user_id, conn=conn)
+    jqutils.sync_mapping("policy_apply_policy_map", {"policy_id": policy_id}, set(applied_policy_id_map.values()), ["apply_policy_map_id"],
+                        user_id=modification_user_id, conn=conn, primary_id="policy_apply_policy_map")
+
+    query = jqutils.cached_text("""
+        UPDATE policy
+        SET keycloak_synced_timestamp = :keycloak_synced_timestamp
+        WHERE policy_id = :policy_id
+    """)
+    conn.execute(query, keycloak_synced_timestamp=datetime.utcnow(), policy_id=policy_id)
+
+def fetch_permission(keycloak_admin_openid, permission):
+    """
+    Reads a permission ({"id"}, or a listed representation with its name) with its resources and applied policies.
+    """
+    keycloak_policy_id = permission["id"]
+    if "name" not in permission:
+        permission = keycloak_admin_openid.get_client_authz_policy(client_uuid, keycloak_policy_id)
+    return {
+        "id": permission["id"],
+        "name": permission["name"],
+        "resource_list": [{"id": resource["_id"], **resource} for resource in
+                            keycloak_admin_openid.get_client_authz_policy_resources(client_uuid, keycloak_policy_id)],
+        "policy_list": keycloak_admin_openid.get_client_authz_permission_associated_policies(client_uuid, keycloak_policy_id)
+    }
+
+def load_permission_mirror(keycloak_policy_id_list, conn, lock_p=False):
+    """
+    Returns {keycloak_policy_id: {"id", "name", "resource_id_list", "policy_id_list", "keycloak_synced_timestamp"}}
+    with Keycloak ids, for the mirrored permissions among keycloak_policy_id_list.
+    """
+    if not keycloak_policy_id_list:
+        return {}
+
+    lock_clause = "FOR UPDATE" if lock_p else ""
+    query = jqutils.cached_text(f"""
+        SELECT policy_id, keycloak_policy_id, policy_name, keycloak_synced_timestamp
+        FROM policy
+        WHERE keycloak_policy_id IN :keycloak_policy_id_list
+        AND meta_status = :meta_status
+        {lock_clause}
+    """)
+    result = conn.execute(query, keycloak_policy_id_list=list(keycloak_policy_id_list), meta_status="active").fetchall()
+    permission_map = {row["policy_id"]: {
+        "id": row["keycloak_policy_id"],
+        "name": row["policy_name"],
+        "resource_id_list": [],
+        "policy_id_list": [],
+        "keycloak_synced_timestamp": row["keycloak_synced_timestamp"]
+    } for row in result}
+    if not permission_map:
+        return {}
+
+    query = jqutils.cached_text("""
+        SELECT prm.policy_id, r.keycloak_resource_id
+        FROM policy_resource_map prm
+        JOIN resource r ON prm.resource_id = r.resource_id
+        WHERE prm.policy_id IN :policy_id_list
+        AND prm.meta_status = :meta_status
+        AND r.meta_status = :meta_status
+        ORDER BY prm.policy_resource_map_id
+    """)
+    for row in conn.execute(query, policy_id_list=list(permission_map), meta_status="active").fetchall():
+        permission_map[row["policy_id"]]["resource_id_list"].append(row["keycloak_resource_id"])
+
+    query = jqutils.cached_text("""
+        SELECT papm.policy_id, p.keycloak_policy_id
+        FROM policy_apply_policy_map papm
+        JOIN policy p ON papm.apply_policy_map_id = p.policy_id
+        WHERE papm.policy_id IN :policy_id_list
+        AND papm.meta_status = :meta_status
+        AND p.meta_status = :meta_status
+        ORDER BY papm.policy_apply_policy_map
+    """)
+    for row in conn.execute(query, policy_id_list=list(permission_map), meta_status="active").fetchall():
+        permission_map[row["policy_id"]]["policy_id_list"].append(row["keycloak_policy_id"])
+
+    return {permission["id"]: permission for permission in permission_map.values()}
+
+def get_permission_mirror(keycloak_policy_id_list):
+    """
+    Returns the mirror of the given permissions, refreshing the missing and
+    stale ones from Keycloak first.
+    """
+    with jqutils.get_db_transaction() as conn:
+        permission_mirror = load_permission_mirror(keycloak_policy_id_list, conn)
+
+    stale_timestamp = datetime.utcnow() - timedelta(seconds=get_settings().keycloak_permission_mirror_max_age_seconds)
+    stale_policy_id_list = [keycloak_policy_id for keycloak_policy_id in keycloak_policy_id_list
+                            if keycloak_policy_id not in permission_mirror
+                            or not permission_mirror[keycloak_policy_id]["keycloak_synced_timestamp"]
+                            or permission_mirror[keycloak_policy_id]["keycloak_synced_timestamp"] < stale_timestamp]
+    if stale_policy_id_list:
+        permission_list = fetch_permission_list(get_keycloak_admin_openid(), [{"id": keycloak_policy_id} for keycloak_policy_id in stale_policy_id_list])
+        with jqutils.get_db_transaction() as conn:
+            for permission in permission_list:
+                store_permission(permission, conn)
+            permission_mirror = load_permission_mirror(keycloak_policy_id_list, conn)
+
+    return permission_mirror
+
+def change_permission_policies(keycloak_policy_id_list, change_policy_id_list):
+    """
+    Replaces the applied policies of every given permission with
+    change_policy_id_list(policy_id_list) and returns the number of Keycloak
+    updates. Permissions whose policies do not change are not updated.
+    """
     keycloak_admin_openid = get_keycloak_admin_openid()
-    
-    policy_list = keycloak_admin_openid.get_client_authz_permissions(client_uuid)
-    
-    existing_policy_list = keycloak_admin_openid.get_client_authz_policies(client_uuid)
-    existing_policy_id_list = [policy["id"] for policy in existing_policy_list]
-    assert associate_policy_id in existing_policy_id_list, f"Policy {associate_policy_id} not found"
-    
-    existing_policy_id_list = []
-    for one_policy in policy_list:
-        cand_policy_id = one_policy["id"]
-        cand_policy_name = one_policy["name"]
-        existing_policy_id_list.append(cand_policy_id)
-        if cand_policy_id in policy_id_list:
-            
-            existing_associated_policies = keycloak_admin_openid.get_client_authz_permission_associated_policies(client_uuid, cand_policy_id)
-            existing_associated_resources = keycloak_admin_openid.get_client_authz_policy_resources(client_uuid, cand_policy_id)
-            
-            existing_associated_policy_id_list = [policy["id"] for policy in existing_associated_policies]
-            existing_associated_resource_id_list = [resource["_id"] for resource in existing_associated_resources]
-            
-            if associate_policy_id not in existing_associated_policy_id_list:
-                existing_associated_policy_id_list.append(associate_policy_id)
-
-                payload={
-                    "id": cand_policy_id,
-                    "name": cand_policy_name,
-                    "type": "resource",
-                    "logic": "POSITIVE",
-                    "decisionStrategy": "AFFIRMATIVE",
-                    "resources": existing_associated_resource_id_list,
-                    "scopes": [],
-                    "policies": existing_associated_policy_id_list
-                }
-                
-                keycloak_admin_openid.update_client_authz_resource_permission(payload, client_uuid, cand_policy_id)
-      
-    for one_policy_id in policy_id_list:
-        assert one_policy_id in existing_policy_id_list, f"Policy id {one_policy_id} not found"
-    
-def disassociate_user_from_policies(user_id):
+    update_count = 0
+
+    for _ in range(PERMISSION_UPDATE_MAX_ATTEMPTS):
+        permission_mirror = get_permission_mirror(keycloak_policy_id_list)
+        for keycloak_policy_id in keycloak_policy_id_list:
+            assert keycloak_policy_id in permission_mirror, f"Policy id {keycloak_policy_id} not found"
+
+        update_map = {}
+        for permission in permission_mirror.values():
+            policy_id_list = change_policy_id_list(permission["policy_id_list"])
+            if policy_id_list != permission["policy_id_list"]:
+                update_map[permission["id"]] = (permission, policy_id_list)
+
+        for permission, policy_id_list in update_map.values():
+            put_permission_policies(keycloak_admin_openid, permission, policy_id_list)
+        update_count += len(update_map)
+
+        conflict_policy_id_list = []
+        with jqutils.get_db_transaction() as conn:
+            locked_permission_mirror = load_permission_mirror(list(update_map), conn, lock_p=True)
+            for permission, policy_id_list in update_map.values():
+                locked_permission = locked_permission_mirror.get(permission["id"])
+                if locked_permission and locked_permission["keycloak_synced_timestamp"] == permission["keycloak_synced_timestamp"]:
+                    store_permission_policies(permission, policy_id_list, conn)
+                else:
+                    conflict_policy_id_list.append(permission["id"])
+
+        if not conflict_policy_id_list:
+            return update_count
+        keycloak_policy_id_list = conflict_policy_id_list
+
+    assert False, f"permissions {keycloak_policy_id_list} kept changing while being updated"
+
+def fetch_permission_list(keycloak_admin_openid, permission_list):
+    return keycloak_executor.map_calls(realm_name, "fetch_permission", lambda permission: fetch_permission(keycloak_admin_openid, permission),
+                                        permission_list, idempotent_p=True)
+
+def put_permission_policies(keycloak_admin_openid, permission, policy_id_list):
+    payload={
+        "id": permission["id"],
+        "name": permission["name"],
+        "type": "resource",
+        "logic": "POSITIVE",
+        "decisionStrategy": "AFFIRMATIVE",
+        "resources": permission["resource_id_list"],
+        "scopes": [],
+        "policies": policy_id_list
+    }
+    keycloak_admin_openid.update_client_authz_resource_permission(payload, client_uuid, permission["id"])
+
+def store_permission_policies(permission, policy_id_list, conn):
+    store_permission({
+        "id": permission["id"],
+        "name": permission["name"],
+        "resource_list": [{"id": keycloak_resource_id} for keycloak_resource_id in permission["resource_id_list"]],
+        "policy_list": [{"id": keycloak_policy_id} for keycloak_policy_id in policy_id_list]
+    }, conn)
+
+def get_all_permission_list(keycloak_admin_openid):
+    permission_list = keycloak_executor.call(realm_name, "get_client_authz_permissions", keycloak_admin_openid.get_client_authz_permissions,
+                                            client_uuid, idempotent_p=True)
+    return fetch_permission_list(keycloak_admin_openid, permission_list)
+
+def store_permission_mirror_build(permission_list, built_timestamp):
+    """
+    Mirrors permission_list, the whole list read from Keycloak since built_timestamp.
+    """
+    with jqutils.get_db_transaction() as conn:
+        permission_mirror = load_permission_mirror([permission["id"] for permission in permission_list], conn, lock_p=True)
+        for permission in permission_list:
+            # a writer stored a newer state after the list was read
+            keycloak_synced_timestamp = permission_mirror.get(permission["id"], {}).get("keycloak_synced_timestamp")
+            if keycloak_synced_timestamp and keycloak_synced_timestamp >= built_timestamp:
+                continue
+            store_permission(permission, conn)
+
+        permission_mirror_build_list = [{
+            "keycloak_client_uuid": client_uuid,
+            "permission_count": len(permission_list),
+            "built_timestamp": built_timestamp,
+            "meta_status": "active",
+            "creation_user_id": get_modification_user_id()
+        }]
+        jqutils.bulk_insert_db_entries(permission_mirror_build_list, "permission_mirror_build", capture_tenant=False, conn=conn)
+
+def refresh_permission_mirror():
+    """
+    Mirrors every resource permission of the client and indexes the users of every user policy.
+    """
     keycloak_admin_openid = get_keycloak_admin_openid()
-    
-    existing_policy_list = keycloak_admin_openid.get_client_authz_policies(client_uuid)
-    
-    user_policy = None
-    for policy in existing_policy_list:
-        policy_config = policy["config"]
-    
-        if "users" in policy_config:
-            user_id_list = policy_config["users"]
-            if user_id in user_id_list:
-                user_policy = policy
-                break
-    
-    if user_policy:
-        policy_id = user_policy["id"]
-        policy_list = keycloak_admin_openid.get_client_authz_permissions(client_uuid)
-        
-        for one_policy in policy_list:
-            
-            existing_associated_policies = keycloak_admin_openid.get_client_authz_permission_associated_policies(client_uuid, one_policy["id"])
-            existing_associated_policy_id_list = [policy["id"] for policy in existing_associated_policies]
-            existing_associated_resources = keycloak_admin_openid.get_client_authz_policy_resources(client_uuid, one_policy["id"])
-            existing_associated_resource_id_list = [resource["_id"] for resource in existing_associated_resources]
-            
-            if policy_id in existing_associated_policy_id_list:
-                existing_associated_policy_id_list.remove(policy_id)
-                payload={
-                    "id": one_policy["id"],
-                    "name": one_policy["name"],
-                    "type": "resource",
-                    "logic": "POSITIVE",
-                    "decisionStrategy": "AFFIRMATIVE",
-                    "resources": existing_associated_resource_id_list,
-                    "scopes": [],
-                    "policies": existing_associated_policy_id_list
-                }
-                
-                keycloak_admin_openid.update_client_authz_resource_permission(payload, client_uuid, one_policy["id"])
-                
+
+    # a permission changed while the list is read is only covered from the next build on
+    built_timestamp = datetime.utcnow()
+    permission_list = get_all_permission_list(keycloak_admin_openid)
+    backfill_user_policy_index(keycloak_admin_openid)
+    store_permission_mirror_build(permission_list, built_timestamp)
+    return len(permission_list)
+
+def refresh_stale_permission_mirror():
+    # every worker runs the task, the first one past the interval builds the mirror for all of them
+    with jqutils.get_db_transaction() as conn:
+        if is_permission_mirror_complete(conn, get_settings().keycloak_permission_mirror_refresh_seconds):
+            return 0
+    return refresh_permission_mirror()
+
+def start_permission_mirror_refresher():
+    return background_worker.start_periodic_task(PERMISSION_MIRROR_REFRESH_TASK_NAME, get_settings().keycloak_permission_mirror_refresh_seconds,
+                                                refresh_stale_permission_mirror)
+
+def remove_policies_from_all_permissions(keycloak_admin_openid, removed_policy_id_set):
+    """
+    Full scan fallback: reads every permission and updates the ones applying
+    any of the removed policies, both in parallel. The scan also rebuilds the
+    whole mirror, so the next removals can use the index.
+    """
+    built_timestamp = datetime.utcnow()
+    permission_list = get_all_permission_list(keycloak_admin_openid)
+    backfill_user_policy_index(keycloak_admin_openid)
+
+    update_list = []
+    for permission in permission_list:
+        if removed_policy_id_set.intersection(policy["id"] for policy in permission["policy_list"]):
+            permission["policy_list"] = [policy for policy in permission["policy_list"] if policy["id"] not in removed_policy_id_set]
+            update_list.append(permission)
+
+    keycloak_executor.map_calls(realm_name, "update_client_authz_resource_permission", lambda permission: put_permission_policies(
+        keycloak_admin_openid,
+        {**permission, "resource_id_list": [resource["id"] for resource in permission["resource_list"]]},
+        [policy["id"] for policy in permission["policy_list"]]
+    ), update_list)
+
+    store_permission_mirror_build(permission_list, built_timestamp)
+
+def delete_user_policies(keycloak_admin_openid, keycloak_policy_id_set):
+    def delete_user_policy(keycloak_policy_id):
+        try:
+            keycloak_admin_openid.delete_client_authz_policy(client_uuid, keycloak_policy_id)
+        except KeycloakError as e:
+            if e.response_code != 404:
+                raise
+
+    keycloak_executor.map_calls(realm_name, "delete_client_authz_policy", delete_user_policy, keycloak_policy_id_set)
+    with jqutils.get_db_transaction() as conn:
+        for keycloak_policy_id in keycloak_policy_id_set:
+            delete_user_policy_index(keycloak_policy_id, None, conn)
+
+def attach_user_to_policies(associate_policy_id, policy_id_list, user_id=None):
+    """
+    Applies the user policy associate_policy_id to the permissions in
+    policy_id_list and records its users in the reverse index used by
+    disassociate_user_from_policies. The local users are found from the
+    policy's Keycloak users unless user_id is given.
+    """
+    keycloak_admin_openid = get_keycloak_admin_openid()
+    keycloak_user_policy = keycloak_executor.call(realm_name, "get_client_authz_policy", keycloak_admin_openid.get_client_authz_policy,
+                                                client_uuid, associate_policy_id, idempotent_p=True)
+
+    # the user policy has to exist, it is mirrored on first use
+    with jqutils.get_db_transaction() as conn:
+        get_local_id_map("policy", "keycloak_policy_id", [keycloak_user_policy], build_policy_row, conn, upsert_p=True)
+
+    policy_id_list = list(dict.fromkeys(policy_id_list))
+    change_permission_policies(policy_id_list, lambda applied_policy_id_list:
+                                applied_policy_id_list if associate_policy_id in applied_policy_id_list else applied_policy_id_list + [associate_policy_id])
+
+    with jqutils.get_db_transaction() as conn:
+        if user_id:
+            user_id_list = [user_id]
+        else:
+            user_id_list = list(get_local_user_id_map(get_user_policy_user_id_list(keycloak_user_policy), conn).values())
+        for one_user_id in user_id_list:
+            record_user_policies(one_user_id, [associate_policy_id] + policy_id_list, conn)
+
+# User policy reverse index
+#--------------------------------------------
+# policy_user_map links a local user to their Keycloak user policy, and the
+# permission mirror's policy_apply_policy_map lists the permissions that apply
+# it, so removing a user touches only those permissions. attach_user_to_policies
+# indexes the users it attaches, and every full build indexes the users of all
+# user policies in Keycloak. Every worker refreshes the mirror once it is older
+# than keycloak_permission_mirror_refresh_seconds. Users whose policy is not
+# indexed, or a mirror without a recent full build, fall back to scanning every
+# policy and permission in Keycloak, which builds the mirror again.
+def record_user_policies(user_id, keycloak_policy_id_list, conn):
+    query = jqutils.cached_text("""
+        SELECT p.policy_id
+        FROM policy p
+        LEFT JOIN policy_user_map pum ON pum.policy_id = p.policy_id
+            AND pum.user_id = :user_id
+            AND pum.meta_status = :meta_status
+        WHERE p.keycloak_policy_id IN :keycloak_policy_id_list
+        AND p.meta_status = :meta_status
+        AND pum.policy_user_map_id IS NULL
+    """)
+    result = conn.execute(query, user_id=user_id, keycloak_policy_id_list=list(keycloak_policy_id_list), meta_status="active").fetchall()
+
+    policy_user_map_list = [{
+        "policy_id": row["policy_id"],
+        "user_id": user_id,
+        "meta_status": "active",
+        "creation_user_id": get_modification_user_id()
+    } for row in result]
+    jqutils.bulk_insert_db_entries(policy_user_map_list, "policy_user_map", capture_tenant=False, conn=conn)
+
+def get_local_user_id_map(keycloak_user_id_list, conn):
+    """
+    Returns {keycloak_user_id: user_id} of the active local users, the newest one per Keycloak user.
+    """
+    if not keycloak_user_id_list:
+        return {}
+
+    query = jqutils.cached_text("""
+        SELECT user_id, keycloak_user_id
+        FROM user
+        WHERE keycloak_user_id IN :keycloak_user_id_list
+        AND meta_status = :meta_status
+        ORDER BY user_id
+    """)
+    result = conn.execute(query, keycloak_user_id_list=list(keycloak_user_id_list), meta_status="active").fetchall()
+    return {row["keycloak_user_id"]: row["user_id"] for row in result}
+
+def backfill_user_policy_index(keycloak_admin_openid):
+    """
+    Indexes the users of every user policy in Keycloak, including policies
+    created before the index or outside attach_user_to_policies. Returns the
+    number of policy_user_map rows added.
+    """
+    policy_list = keycloak_executor.call(realm_name, "get_client_authz_policies", keycloak_admin_openid.get_client_authz_policies,
+                                        client_uuid, idempotent_p=True)
+    user_policy_list = [policy for policy in policy_list if policy.get("type") == "user" and get_user_policy_user_id_list(policy)]
+    if not user_policy_list:
+        return 0
+
+    with jqutils.get_db_transaction() as conn:
+        local_policy_id_map = get_local_id_map("policy", "keycloak_policy_id", user_policy_list, build_policy_row, conn, upsert_p=True)
+        local_user_id_map = get_local_user_id_map({keycloak_user_id for policy in user_policy_list
+                                                    for keycloak_user_id in get_user_policy_user_id_list(policy)}, conn)
+
+        query = jqutils.cached_text("""
+            SELECT policy_id, user_id
+            FROM policy_user_map
+            WHERE policy_id IN :policy_id_list
+            AND meta_status = :meta_status
+        """)
+        result = conn.execute(query, policy_id_list=list(local_policy_id_map.values()), meta_status="active").fetchall()
+        indexed_set = {(row["policy_id"], row["user_id"]) for row in result}
+
+        policy_user_map_list = []
+        for policy in user_policy_list:
+            for keycloak_user_id in get_user_policy_user_id_list(policy):
+                policy_user_pair = (local_policy_id_map[policy["id"]], local_user_id_map.get(keycloak_user_id))
+                if policy_user_pair[1] is None or policy_user_pair in indexed_set:
+                    continue
+                indexed_set.add(policy_user_pair)
+                policy_user_map_list.append({
+                    "policy_id": policy_user_pair[0],
+                    "user_id": policy_user_pair[1],
+                    "meta_status": "active",
+                    "creation_user_id": get_modification_user_id()
+                })
+        jqutils.bulk_insert_db_entries(policy_user_map_list, "policy_user_map", capture_tenant=False, conn=conn)
+    return len(policy_user_map_list)
+
+def get_indexed_user_policy(keycloak_user_id, user_id, conn):
+    """
+    Returns the local user_id, policy_id and keycloak_policy_id of the user's user policy, or None.
+    """
+    user_filter = "pum.user_id = :user_id" if user_id else \
+        "pum.user_id = (SELECT user_id FROM user WHERE keycloak_user_id = :keycloak_user_id ORDER BY user_id DESC LIMIT 1)"
+    query = jqutils.cached_text(f"""
+        SELECT pum.user_id, p.policy_id, p.keycloak_policy_id
+        FROM policy_user_map pum
+        JOIN policy p ON pum.policy_id = p.policy_id
+        WHERE {user_filter}
+        AND p.policy_type = :policy_type
+        AND pum.meta_status = :meta_status
+        AND p.meta_status = :meta_status
+    """)
+    return conn.execute(query, user_id=user_id, keycloak_user_id=keycloak_user_id, policy_type="user", meta_status="active").fetchone()
+
+def is_permission_mirror_complete(conn, max_age_seconds=None):
+    if max_age_seconds is None:
+        max_age_seconds = get_settings().keycloak_permission_mirror_max_age_seconds
+    built_timestamp = datetime.utcnow() - timedelta(seconds=max_age_seconds)
+    query = jqutils.cached_text("""
+        SELECT permission_mirror_build_id
+        FROM permission_mirror_build
+        WHERE keycloak_client_uuid = :keycloak_client_uuid
+        AND built_timestamp >= :built_timestamp
+        AND meta_status = :meta_status
+        LIMIT 1
+    """)
+    return conn.execute(query, keycloak_client_uuid=client_uuid, built_timestamp=built_timestamp, meta_status="active").fetchone() is not None
+
+def disassociate_user_from_policies(user_id, local_user_id=None):
+    """
+    Removes the Keycloak user user_id from every permission and deletes their
+    user policy. local_user_id is the user's id in the user table, it is
+    needed once the user row no longer carries the keycloak_user_id.
+    """
+    with jqutils.get_db_transaction() as conn:
+        user_policy = get_indexed_user_policy(user_id, local_user_id, conn)
+        indexed_p = bool(user_policy) and is_permission_mirror_complete(conn)
+
+    if indexed_p:
+        disassociate_indexed_user_policy(get_keycloak_admin_openid(), user_policy)
+    else:
+        scan_disassociate_user_from_policies(user_id)
+
+def disassociate_indexed_user_policy(keycloak_admin_openid, user_policy):
+    query = jqutils.cached_text("""
+        SELECT p.keycloak_policy_id
+        FROM policy_apply_policy_map papm
+        JOIN policy p ON papm.policy_id = p.policy_id
+        WHERE papm.apply_policy_map_id = :policy_id
+        AND papm.meta_status = :meta_status
+        AND p.meta_status = :meta_status
+    """)
+    with jqutils.get_db_transaction() as conn:
+        result = conn.execute(query, policy_id=user_policy["policy_id"], meta_status="active").fetchall()
+
+    policy_id = user_policy["keycloak_policy_id"]
+    change_permission_policies([row["keycloak_policy_id"] for row in result], lambda applied_policy_id_list:
+                                [one_policy_id for one_policy_id in applied_policy_id_list if one_policy_id != policy_id])
+
+    try:
         keycloak_admin_openid.delete_client_authz_policy(client_uuid, policy_id)
+    except KeycloakError as e:
+        if e.response_code != 404:
+            raise
+
+    with jqutils.get_db_transaction() as conn:
+        delete_user_policy_index(policy_id, user_policy["user_id"], conn)
+
+def delete_user_policy_index(keycloak_policy_id, user_id, conn):
+    """
+    Soft-deletes a removed user policy, the permission links to it and the user's policy_user_map rows.
+    """
+    deletion_user_id = get_modification_user_id()
+    deletion_timestamp = datetime.utcnow()
+
+    query = jqutils.cached_text("""
+        UPDATE policy_apply_policy_map
+        SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
+        WHERE apply_policy_map_id IN (SELECT policy_id FROM policy WHERE keycloak_policy_id = :keycloak_policy_id)
+        AND meta_status = :meta_status_active
+    """)
+    conn.execute(query, meta_status="deleted", deletion_user_id=deletion_user_id, deletion_timestamp=deletion_timestamp,
+                keycloak_policy_id=keycloak_policy_id, meta_status_active="active")
+
+    query = jqutils.cached_text("""
+        UPDATE policy_user_map
+        SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
+        WHERE (user_id = :user_id OR policy_id IN (SELECT policy_id FROM policy WHERE keycloak_policy_id = :keycloak_policy_id))
+        AND meta_status = :meta_status_active
+    """)
+    conn.execute(query, meta_status="deleted", deletion_user_id=deletion_user_id, deletion_timestamp=deletion_timestamp,
+                user_id=user_id, keycloak_policy_id=keycloak_policy_id, meta_status_active="active")
+
+    query = jqutils.cached_text("""
+        UPDATE policy
+        SET meta_status = :meta_status, deletion_user_id = :deletion_user_id, deletion_timestamp = :deletion_timestamp
+        WHERE keycloak_policy_id = :keycloak_policy_id
+        AND meta_status = :meta_status_active
+    """)
+    conn.execute(query, meta_status="deleted", deletion_user_id=deletion_user_id, deletion_timestamp=deletion_timestamp,
+                keycloak_policy_id=keycloak_policy_id, meta_status_active="active")
+
+def scan_disassociate_user_from_policies(user_id):
+    keycloak_admin_openid = get_keycloak_admin_openid()
+    
+    existing_policy_list = keycloak_executor.call(realm_name, "get_client_authz_policies", keycloak_admin_openid.get_client_authz_policies,
+                                                client_uuid, idempotent_p=True)
+    user_policy_id_set = {policy["id"] for policy in existing_policy_list if user_id in get_user_policy_user_id_list(policy)}
+    
+    if user_policy_id_set:
+        remove_policies_from_all_permissions(keycloak_admin_openid, user_policy_id_set)
+        delete_user_policies(keycloak_admin_openid, user_policy_id_set)
 
 def assign_realm_roles_to_user(keycloak_user_id, keycloak_realm_role_id_list):
     keycloak_admin_openid = get_keycloak_admin_openid()
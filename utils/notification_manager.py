@@ -257,8 +257,7 @@ def publish_message_on_sns_topic(topic_name, message_json, message_attributes, m
             meta_status = :meta_status
             """
     )
-    db_engine = jqutils.get_db_engine()
-    with db_engine.connect() as conn:
+    with jqutils.get_db_connection() as conn:
         result = conn.execute(query, topic_name=topic_name, meta_status="active").fetchone()
         assert result, "select topic_arn failure."
 
@@ -0,0 +1,237 @@
+import os
+import signal
+import logging
+import threading
+
+from dataclasses import dataclass, field
+from dotenv import load_dotenv
+
+# Settings
+#--------------------------------------------
+# The environment (and .env) is read once into a frozen Settings object.
+# Hot paths call get_settings() instead of load_dotenv()/os.getenv(); a reload
+# (SIGHUP, or reload_settings() in scripts) builds a new object and runs the
+# registered callbacks so modules holding derived state can refresh it.
+
+@dataclass(frozen=True)
+class Settings:
+    env: str = None
+    debug: str = None
+
+    # database
+    mysql_user: str = None
+    mysql_password: str = None
+    mysql_ip_address: str = None
+    mysql_port: str = "3306"
+    mysql_schema_name: str = None
+    mysql_replica_ip_address_list: tuple = ()
+    mysql_replica_max_lag_seconds: float = 2
+    mysql_replica_lag_check_seconds: float = 5
+    statement_cache_size: int = 1024
+    mysql_local_infile: bool = False
+
+    # connection pools
+    db_connection_budget: int = 250
+    web_concurrency: int = 1
+    gunicorn_threads: int = 1
+    db_pool_timeout: int = 30
+
+    # caches
+    redis_url: str = None
+    user_profile_cache_size: int = 4096
+    user_profile_cache_ttl_seconds: int = 300
+    effective_access_cache_seconds: int = 30
+
+    # keycloak
+    keycloak_server_url: str = None
+    keycloak_client_id: str = None
+    keycloak_realm_name: str = None
+    keycloak_client_secret_key: str = None
+    keycloak_admin_username: str = None
+    keycloak_admin_password: str = None
+    keycloak_client_uuid: str = None
+
+    # access tokens
+    auth_enforced: bool = True
+    keycloak_token_audience: str = None
+    keycloak_token_issuer: str = None
+    keycloak_jwks_max_age_seconds: int = 3600
+    auth_user_cache_size: int = 4096
+    auth_user_cache_ttl_seconds: int = 300
+
+    # aws
+    aws_default_region: str = None
+    s3_bucket_name: str = None
+    mock_s3_upload: str = None
+    mock_aws_notifications: str = None
+    mock_aws_textract: str = None
+
+    fe_portal_web_url: str = None
+
+    # background tasks, started per worker by api.start_background_tasks()
+    background_tasks_enabled: bool = True
+
+    # one time passwords
+    otp_sweep_interval_seconds: int = 300
+    otp_sweep_batch_size: int = 1000
+    otp_archive_retention_days: int = 30
+
+    # e-mail outbox
+    email_source: str = "haseeb.ahmed@globalvertices.com"
+    email_template_cache_seconds: int = 300
+    email_outbox_worker_count: int = 4
+    email_outbox_batch_size: int = 20
+    email_outbox_poll_seconds: float = 2
+    email_outbox_max_attempts: int = 8
+    email_outbox_backoff_base_seconds: float = 5
+    email_outbox_backoff_max_seconds: float = 1800
+    email_outbox_claim_timeout_seconds: int = 300
+
+    # keycloak admin fan-out
+    keycloak_admin_max_workers: int = 16
+    keycloak_admin_realm_concurrency: int = 8
+    keycloak_admin_max_attempts: int = 3
+    keycloak_admin_backoff_base_seconds: float = 0.2
+
+    # keycloak client tokens
+    keycloak_token_refresh_interval_seconds: float = 15
+    keycloak_token_refresh_ahead_seconds: float = 60
+
+    # keycloak permission mirror
+    keycloak_permission_mirror_max_age_seconds: int = 3600
+    keycloak_permission_mirror_refresh_seconds: int = 1800
+
+    # keycloak cleanup queue
+    keycloak_cleanup_poll_seconds: float = 5
+    keycloak_cleanup_batch_size: int = 20
+    keycloak_cleanup_max_attempts: int = 8
+
+    # everything else, e.g. the DEV_* connection variables
+    environ: dict = field(default_factory=dict, repr=False)
+
+    def get(self, name, default=None):
+        return self.environ.get(name, default)
+
+def load_settings():
+    load_dotenv(override=True)
+    environ = dict(os.environ)
+
+    return Settings(
+        env=environ.get("ENV"),
+        debug=environ.get("DEBUG"),
+
+        mysql_user=environ.get("MYSQL_USER"),
+        mysql_password=environ.get("MYSQL_PASSWORD"),
+        mysql_ip_address=environ.get("MYSQL_IP_ADDRESS"),
+        mysql_port=environ.get("MYSQL_PORT", "3306"),
+        mysql_schema_name=environ.get("MYSQL_SCHEMA_NAME"),
+        mysql_replica_ip_address_list=tuple(host.strip() for host in environ.get("MYSQL_REPLICA_IP_ADDRESSES", "").split(",") if host.strip()),
+        mysql_replica_max_lag_seconds=float(environ.get("MYSQL_REPLICA_MAX_LAG_SECONDS", "2")),
+        mysql_replica_lag_check_seconds=float(environ.get("MYSQL_REPLICA_LAG_CHECK_SECONDS", "5")),
+        statement_cache_size=int(environ.get("STATEMENT_CACHE_SIZE", "1024")),
+        mysql_local_infile=environ.get("MYSQL_LOCAL_INFILE") == "1",
+
+        db_connection_budget=int(environ.get("DB_CONNECTION_BUDGET", "250")),
+        web_concurrency=max(1, int(environ.get("WEB_CONCURRENCY", "1"))),
+        gunicorn_threads=max(1, int(environ.get("GUNICORN_THREADS", "1"))),
+        db_pool_timeout=int(environ.get("DB_POOL_TIMEOUT", "30")),
+
+        redis_url=environ.get("REDIS_URL"),
+        user_profile_cache_size=int(environ.get("USER_PROFILE_CACHE_SIZE", "4096")),
+        user_profile_cache_ttl_seconds=int(environ.get("USER_PROFILE_CACHE_TTL_SECONDS", "300")),
+        effective_access_cache_seconds=int(environ.get("EFFECTIVE_ACCESS_CACHE_SECONDS", "30")),
+
+        keycloak_server_url=environ.get("KEYCLOAK_SERVER_URL"),
+        keycloak_client_id=environ.get("KEYCLOAK_CLIENT_ID"),
+        keycloak_realm_name=environ.get("KEYCLOAK_REALM_NAME"),
+        keycloak_client_secret_key=environ.get("KEYCLOAK_CLIENT_SECRET_KEY"),
+        keycloak_admin_username=environ.get("KEYCLOAK_ADMIN_USERNAME"),
+        keycloak_admin_password=environ.get("KEYCLOAK_ADMIN_PASSWORD"),
+        keycloak_client_uuid=environ.get("KEYCLOAK_CLIENT_UUID"),
+
+        auth_enforced=environ.get("AUTH_ENFORCED", "1") == "1",
+        keycloak_token_audience=environ.get("KEYCLOAK_TOKEN_AUDIENCE"),
+        keycloak_token_issuer=environ.get("KEYCLOAK_TOKEN_ISSUER"),
+        keycloak_jwks_max_age_seconds=int(environ.get("KEYCLOAK_JWKS_MAX_AGE_SECONDS", "3600")),
+        auth_user_cache_size=int(environ.get("AUTH_USER_CACHE_SIZE", "4096")),
+        auth_user_cache_ttl_seconds=int(environ.get("AUTH_USER_CACHE_TTL_SECONDS", "300")),
+
+        aws_default_region=environ.get("AWS_DEFAULT_REGION"),
+        s3_bucket_name=environ.get("S3_BUCKET_NAME"),
+        mock_s3_upload=environ.get("MOCK_S3_UPLOAD"),
+        mock_aws_notifications=environ.get("MOCK_AWS_NOTIFICATIONS"),
+        mock_aws_textract=environ.get("MOCK_AWS_TEXTRACT"),
+
+        fe_portal_web_url=environ.get("FE_PORTAL_WEB_URL"),
+
+        background_tasks_enabled=environ.get("BACKGROUND_TASKS_ENABLED", "1") == "1",
+
+        otp_sweep_interval_seconds=int(environ.get("OTP_SWEEP_INTERVAL_SECONDS", "300")),
+        otp_sweep_batch_size=int(environ.get("OTP_SWEEP_BATCH_SIZE", "1000")),
+        otp_archive_retention_days=int(environ.get("OTP_ARCHIVE_RETENTION_DAYS", "30")),
+
+        email_source=environ.get("EMAIL_SOURCE", "haseeb.ahmed@globalvertices.com"),
+        email_template_cache_seconds=int(environ.get("EMAIL_TEMPLATE_CACHE_SECONDS", "300")),
+        email_outbox_worker_count=int(environ.get("EMAIL_OUTBOX_WORKER_COUNT", "4")),
+        email_outbox_batch_size=int(environ.get("EMAIL_OUTBOX_BATCH_SIZE", "20")),
+        email_outbox_poll_seconds=float(environ.get("EMAIL_OUTBOX_POLL_SECONDS", "2")),
+        email_outbox_max_attempts=int(environ.get("EMAIL_OUTBOX_MAX_ATTEMPTS", "8")),
+        email_outbox_backoff_base_seconds=float(environ.get("EMAIL_OUTBOX_BACKOFF_BASE_SECONDS", "5")),
+        email_outbox_backoff_max_seconds=float(environ.get("EMAIL_OUTBOX_BACKOFF_MAX_SECONDS", "1800")),
+        email_outbox_claim_timeout_seconds=int(environ.get("EMAIL_OUTBOX_CLAIM_TIMEOUT_SECONDS", "300")),
+
+        keycloak_admin_max_workers=int(environ.get("KEYCLOAK_ADMIN_MAX_WORKERS", "16")),
+        keycloak_admin_realm_concurrency=int(environ.get("KEYCLOAK_ADMIN_REALM_CONCURRENCY", "8")),
+        keycloak_admin_max_attempts=int(environ.get("KEYCLOAK_ADMIN_MAX_ATTEMPTS", "3")),
+        keycloak_admin_backoff_base_seconds=float(environ.get("KEYCLOAK_ADMIN_BACKOFF_BASE_SECONDS", "0.2")),
+
+        keycloak_token_refresh_interval_seconds=float(environ.get("KEYCLOAK_TOKEN_REFRESH_INTERVAL_SECONDS", "15")),
+        keycloak_token_refresh_ahead_seconds=float(environ.get("KEYCLOAK_TOKEN_REFRESH_AHEAD_SECONDS", "60")),
+
+        keycloak_permission_mirror_max_age_seconds=int(environ.get("KEYCLOAK_PERMISSION_MIRROR_MAX_AGE_SECONDS", "3600")),
+        keycloak_permission_mirror_refresh_seconds=int(environ.get("KEYCLOAK_PERMISSION_MIRROR_REFRESH_SECONDS", "1800")),
+
+        keycloak_cleanup_poll_seconds=float(environ.get("KEYCLOAK_CLEANUP_POLL_SECONDS", "5")),
+        keycloak_cleanup_batch_size=int(environ.get("KEYCLOAK_CLEANUP_BATCH_SIZE", "20")),
+        keycloak_cleanup_max_attempts=int(environ.get("KEYCLOAK_CLEANUP_MAX_ATTEMPTS", "8")),
+
+        environ=environ
+    )
+
+SETTINGS = None
+SETTINGS_LOCK = threading.Lock()
+RELOAD_CALLBACKS = []
+
+def get_settings():
+    global SETTINGS
+
+    if SETTINGS is None:
+        with SETTINGS_LOCK:
+            if SETTINGS is None:
+                SETTINGS = load_settings()
+    return SETTINGS
+
+def reload_settings():
+    global SETTINGS
+
+    with SETTINGS_LOCK:
+        SETTINGS = load_settings()
+
+    for callback in RELOAD_CALLBACKS:
+        try:
+            callback(SETTINGS)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception("settings reload callback failed")
+    return SETTINGS
+
+def register_reload_callback(callback):
+    RELOAD_CALLBACKS.append(callback)
+    return callback
+
+def install_reload_signal_handler():
+    # signal handlers can only be installed from the main thread
+    if threading.current_thread() is not threading.main_thread() or not hasattr(signal, "SIGHUP"):
+        return False
+
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_settings())
+    return True